@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+# 并发执行互不依赖的查询
+# 视图中互不依赖的redis读取和数据库查询(如关注状态, 回答列表, 相关问题),
+# 用asyncio.gather提交到线程池同时执行, 耗时从各查询之和降为最慢的一个;
+# django 2.0的视图和ORM只能同步执行, run()为每次调用创建一个事件循环,
+# WSGI(uwsgi)和ASGI(daphne, 见zhihuer/asgi.py)下都可以使用
+# 以下情况在当前线程按顺序执行:
+#   只有一个查询, 或settings.CONCURRENT_LOOKUPS为False
+#   调用者在数据库事务中(包括TestCase), 其他线程的连接看不到未提交的数据
+#   已在工作线程中, 不嵌套提交, 避免线程池占满时互相等待
+# 工作线程的数据库连接保留settings.CONCURRENT_LOOKUP_CONN_MAX_AGE秒,
+# 超时或出错时关闭, 请求线程的连接仍按DATABASES中的CONN_MAX_AGE处理;
+# 抽样统计的请求中, 工作线程的查询和缓存命中计入同一个请求
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection, connections, close_old_connections
+
+from . import metrics
+
+_local = threading.local()
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.CONCURRENT_LOOKUP_WORKERS)
+    return _executor
+
+
+def _close_worker_connections():
+    '''关闭工作线程中超过CONCURRENT_LOOKUP_CONN_MAX_AGE或出错的连接
+
+    新建立的连接按CONN_MAX_AGE设置了关闭时间, 改为按工作线程的保留时间
+    '''
+    max_age = getattr(settings, 'CONCURRENT_LOOKUP_CONN_MAX_AGE', 0)
+    for conn in connections.all():
+        if conn.connection is None:
+            continue
+        if getattr(conn, '_worker_connection', None) is not conn.connection:
+            conn._worker_connection = conn.connection
+            conn.close_at = time.time() + max_age
+        conn.close_if_unusable_or_obsolete()
+
+
+def _call(func, recorder):
+    '''在工作线程中执行func, 查询前后关闭超时或出错的连接'''
+    _local.in_worker = True
+    close_old_connections()
+    try:
+        with metrics.recording(recorder):
+            return func()
+    finally:
+        _close_worker_connections()
+        _local.in_worker = False
+
+
+def _concurrent(funcs):
+    return (len(funcs) > 1 and
+            getattr(settings, 'CONCURRENT_LOOKUPS', False) and
+            not connection.in_atomic_block and
+            not getattr(_local, 'in_worker', False))
+
+
+def run(*funcs):
+    '''并发执行funcs(无参数的函数), 按funcs的顺序返回结果列表
+
+    funcs之间不能有依赖, 不要在funcs中修改共享的对象;
+    任何一个抛出异常时抛出第一个异常
+    '''
+    if not _concurrent(funcs):
+        return [func() for func in funcs]
+    executor = _get_executor()
+    recorder = metrics.current()
+    loop = asyncio.new_event_loop()
+    try:
+        futures = [loop.run_in_executor(executor, _call, func, recorder) for
+                   func in funcs]
+        return loop.run_until_complete(asyncio.gather(*futures))
+    finally:
+        loop.close()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+# 带持有者token的redis锁
+# 获取: SET key token NX PX timeout, 只有一个进程获得
+# 延长/释放: lua脚本比较token后PEXPIRE/DEL, 锁过期后被其他进程获得时,
+# 原持有者不会延长或删除别人的锁
+# 与swr_cache.acquire_lock(cache.add)不同, 用于持有时间可能超过过期时间的
+# 定时任务: 每处理一批前调用extend, 返回False时说明锁已丢失, 应停止处理
+# 用法:
+#   lock = Lock('toggles:drain', timeout=60)
+#   if lock.acquire():
+#       try:
+#           while lock.extend():
+#               ...
+#       finally:
+#           lock.release()
+
+import uuid
+
+from django_redis import get_redis_connection
+
+EXTEND_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+'''
+
+RELEASE_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+'''
+
+
+class Lock(object):
+    '''redis锁, timeout为过期时间(秒)'''
+
+    def __init__(self, name, timeout=60):
+        self.key = 'lock:%s' % name
+        self.timeout_ms = int(timeout * 1000)
+        self.token = uuid.uuid4().hex
+        self.conn = get_redis_connection('default')
+
+    def acquire(self):
+        '''获取锁, 已被其他进程持有时返回False'''
+        return bool(self.conn.set(self.key, self.token, px=self.timeout_ms,
+                                  nx=True))
+
+    def extend(self):
+        '''仍持有锁时重新计算过期时间并返回True, 锁已丢失时返回False'''
+        script = self.conn.register_script(EXTEND_SCRIPT)
+        return bool(script(keys=[self.key],
+                           args=[self.token, self.timeout_ms]))
+
+    def release(self):
+        '''释放锁, 只删除自己持有的锁'''
+        script = self.conn.register_script(RELEASE_SCRIPT)
+        return bool(script(keys=[self.key], args=[self.token]))
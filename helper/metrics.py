@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+
+# 请求性能统计
+# MetricsMiddleware按settings.METRICS_SAMPLE_RATE抽样请求, 抽中的请求记录:
+#   SQL查询数和总耗时   connection.execute_wrapper包装数据库执行
+#   缓存命中/未命中      settings.CACHES使用本模块的InstrumentedRedisCache
+#   模板渲染耗时        settings.TEMPLATES使用本模块的InstrumentedDjangoTemplates
+#   总耗时
+# 同一个请求中相同结构的SQL(参数不同)执行超过N_PLUS_ONE_THRESHOLD次时视为N+1查询,
+# 写入日志并计数
+# 统计结果按视图(url名)累加到redis, 多个进程共享:
+#   metrics:views          视图名集合
+#   metrics:view:<视图名>   hash, 请求数, 各项总和, 直方图各区间的请求数
+#   metrics:nplusone:<视图名> hash, SQL结构: 出现N+1的请求数
+# /metrics/以prometheus文本格式输出, 只允许管理员(is_staff)登录后访问,
+# 或请求头Authorization: Bearer <settings.METRICS_TOKEN>, METRICS_TOKEN为空时不允许;
+# 不按来源地址判断, 反向代理后REMOTE_ADDR都是代理的地址
+# 未抽中的请求只有一次random()的开销
+
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, Http404
+from django.template.backends.django import DjangoTemplates
+from django.utils.crypto import constant_time_compare
+from django_redis import get_redis_connection
+from django_redis.cache import RedisCache
+
+logger = logging.getLogger(__name__)
+
+# 直方图区间上界
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+# 相同结构的SQL超过这个次数视为N+1查询
+N_PLUS_ONE_THRESHOLD = 5
+
+VIEWS_KEY = 'metrics:views'
+
+# 合并 IN (%s, %s, ...) 中的占位符, 数字常量
+SHAPE_RES = [(re.compile(r'(%s)(, %s)+'), '%s, ...'),
+             (re.compile(r'\b\d+\b'), 'N')]
+
+_local = threading.local()
+
+
+def _view_key(view):
+    return 'metrics:view:%s' % view
+
+
+def _nplusone_key(view):
+    return 'metrics:nplusone:%s' % view
+
+
+def sql_shape(sql):
+    '''去掉参数差异后的SQL结构'''
+    for pattern, repl in SHAPE_RES:
+        sql = pattern.sub(repl, sql)
+    return sql
+
+
+class Recorder(object):
+    '''一个抽中的请求的统计
+
+    helper.concurrency的工作线程也会写入, 查询和缓存的计数加锁更新
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.shapes = Counter()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.render_time = 0.0
+        self.render_depth = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        '''connection.execute_wrapper'''
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            shape = sql_shape(sql)
+            with self.lock:
+                self.sql_time += elapsed
+                self.queries += 1
+                self.shapes[shape] += 1
+
+    def record_cache(self, hits, misses):
+        with self.lock:
+            self.cache_hits += hits
+            self.cache_misses += misses
+
+    def n_plus_one(self):
+        return [shape for shape, nums in self.shapes.items() if
+                nums > N_PLUS_ONE_THRESHOLD]
+
+
+def current():
+    '''当前请求的Recorder, 未抽中时为None'''
+    return getattr(_local, 'recorder', None)
+
+
+@contextmanager
+def recording(recorder):
+    '''当前线程的查询和缓存命中计入recorder, recorder为None时不统计
+
+    请求线程和helper.concurrency的工作线程都使用
+    '''
+    if recorder is None:
+        yield
+        return
+    previous = current()
+    _local.recorder = recorder
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            yield
+    finally:
+        _local.recorder = previous
+
+
+def record_cache(hits, misses):
+    recorder = current()
+    if recorder is not None:
+        recorder.record_cache(hits, misses)
+
+
+def _bucket(value, buckets):
+    for bound in buckets:
+        if value <= bound:
+            return str(bound)
+    return '+Inf'
+
+
+def save(view, recorder, total_time):
+    '''统计结果累加到redis'''
+    latency = total_time * 1000
+    key = _view_key(view)
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    pipe.sadd(VIEWS_KEY, view)
+    pipe.hincrby(key, 'requests', 1)
+    pipe.hincrby(key, 'queries', recorder.queries)
+    pipe.hincrbyfloat(key, 'sql_ms', recorder.sql_time * 1000)
+    pipe.hincrbyfloat(key, 'render_ms', recorder.render_time * 1000)
+    pipe.hincrbyfloat(key, 'latency_ms', latency)
+    pipe.hincrby(key, 'cache_hits', recorder.cache_hits)
+    pipe.hincrby(key, 'cache_misses', recorder.cache_misses)
+    pipe.hincrby(key, 'latency_le:%s' % _bucket(latency, LATENCY_BUCKETS), 1)
+    pipe.hincrby(key, 'queries_le:%s' % _bucket(recorder.queries,
+                                                QUERY_BUCKETS), 1)
+    for shape in recorder.n_plus_one():
+        pipe.hincrby(_nplusone_key(view), shape[:500], 1)
+    pipe.execute()
+
+
+class MetricsMiddleware(object):
+    '''抽样统计请求的查询数, SQL耗时, 缓存命中, 渲染耗时'''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        rate = getattr(settings, 'METRICS_SAMPLE_RATE', 0)
+        if not rate or random.random() >= rate:
+            return self.get_response(request)
+        recorder = Recorder()
+        start = time.perf_counter()
+        with recording(recorder):
+            response = self.get_response(request)
+        total_time = time.perf_counter() - start
+        match = getattr(request, 'resolver_match', None)
+        view = match.url_name if match and match.url_name else 'unresolved'
+        for shape in recorder.n_plus_one():
+            logger.warning('N+1 query in %s (%d times): %s', view,
+                           recorder.shapes[shape], shape[:200])
+        try:
+            save(view, recorder, total_time)
+        except Exception:
+            # 统计失败不影响请求
+            logger.exception('save metrics failed')
+        return response
+
+
+_MISSING = object()
+
+
+class InstrumentedRedisCache(RedisCache):
+    '''统计抽中请求的缓存命中/未命中'''
+
+    def get(self, key, default=None, version=None, client=None):
+        value = super(InstrumentedRedisCache, self).get(
+            key, _MISSING, version, client)
+        if value is _MISSING:
+            record_cache(0, 1)
+            return default
+        record_cache(1, 0)
+        return value
+
+    def get_many(self, keys, *args, **kwargs):
+        keys = list(keys)
+        values = super(InstrumentedRedisCache, self).get_many(
+            keys, *args, **kwargs)
+        record_cache(len(values), len(keys) - len(values))
+        return values
+
+
+class TimedTemplate(object):
+    '''统计模板渲染耗时, 模板中嵌套渲染的时间只计算一次'''
+
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        recorder = current()
+        if recorder is None:
+            return self.template.render(context, request)
+        recorder.render_depth += 1
+        start = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            recorder.render_depth -= 1
+            if not recorder.render_depth:
+                recorder.render_time += time.perf_counter() - start
+
+
+class InstrumentedDjangoTemplates(DjangoTemplates):
+    def from_string(self, template_code):
+        return TimedTemplate(super(InstrumentedDjangoTemplates,
+                                   self).from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super(InstrumentedDjangoTemplates,
+                                   self).get_template(template_name))
+
+
+def _header(name, help_text, metric_type):
+    return ['# HELP %s %s' % (name, help_text),
+            '# TYPE %s %s' % (name, metric_type)]
+
+
+def _histogram(name, view, stats, field, buckets):
+    '''一个视图的直方图, redis中保存的是各区间的请求数, 输出累计数'''
+    lines = []
+    cumulative = 0
+    for bound in [str(bound) for bound in buckets] + ['+Inf']:
+        cumulative += int(stats.get('%s_le:%s' % (field, bound), 0))
+        lines.append('%s_bucket{view="%s",le="%s"} %d' % (
+            name, view, bound, cumulative))
+    lines.append('%s_sum{view="%s"} %s' % (
+        name, view, stats.get(HISTOGRAMS[name][1], 0)))
+    lines.append('%s_count{view="%s"} %d' % (name, view, cumulative))
+    return lines
+
+
+# 直方图: (说明, 总和字段, 区间字段, 区间上界)
+HISTOGRAMS = {
+    'zhihuer_request_latency_ms': ('请求耗时(毫秒)', 'latency_ms', 'latency',
+                                   LATENCY_BUCKETS),
+    'zhihuer_request_queries': ('每个请求的SQL查询数', 'queries', 'queries',
+                                QUERY_BUCKETS),
+}
+# 计数: (说明, 字段, 单位换算)
+COUNTERS = {
+    'zhihuer_sql_seconds_total': ('SQL执行总耗时(秒)', 'sql_ms', 1000),
+    'zhihuer_render_seconds_total': ('模板渲染总耗时(秒)', 'render_ms', 1000),
+    'zhihuer_cache_hits_total': ('缓存命中次数', 'cache_hits', 1),
+    'zhihuer_cache_misses_total': ('缓存未命中次数', 'cache_misses', 1),
+}
+
+
+def _decode(mapping):
+    return {key.decode(): value.decode() for key, value in mapping.items()}
+
+
+def _label(value):
+    '''prometheus标签值转义反斜杠, 双引号和换行'''
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def render_metrics():
+    '''prometheus文本格式的统计结果'''
+    conn = get_redis_connection('default')
+    views = sorted(view.decode() for view in conn.smembers(VIEWS_KEY))
+    pipe = conn.pipeline(transaction=False)
+    for view in views:
+        pipe.hgetall(_view_key(view))
+        pipe.hgetall(_nplusone_key(view))
+    results = pipe.execute()
+    stats = {view: _decode(results[index * 2]) for index, view in
+             enumerate(views)}
+    nplusone = {view: _decode(results[index * 2 + 1]) for index, view in
+                enumerate(views)}
+    lines = []
+    for name, (help_text, total_field, field, buckets) in sorted(
+            HISTOGRAMS.items()):
+        lines += _header(name, help_text, 'histogram')
+        for view in views:
+            lines += _histogram(name, view, stats[view], field, buckets)
+    for name, (help_text, field, scale) in sorted(COUNTERS.items()):
+        lines += _header(name, help_text, 'counter')
+        for view in views:
+            lines.append('%s{view="%s"} %s' % (
+                name, view, float(stats[view].get(field, 0)) / scale))
+    lines += _header('zhihuer_n_plus_one_total', '出现N+1查询的请求数',
+                     'counter')
+    for view in views:
+        for shape, nums in sorted(nplusone[view].items()):
+            lines.append('zhihuer_n_plus_one_total{view="%s",sql="%s"} %s' % (
+                view, _label(shape), nums))
+    return '\n'.join(lines) + '\n'
+
+
+def _authorized(request):
+    '''管理员, 或带有settings.METRICS_TOKEN的请求'''
+    if request.user.is_authenticated and request.user.is_staff:
+        return True
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if not token:
+        return False
+    return constant_time_compare(
+        request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer ' + token)
+
+
+def metrics_view(request):
+    '''统计结果, 只允许管理员和带有METRICS_TOKEN的请求访问'''
+    if not _authorized(request):
+        raise Http404
+    return HttpResponse(render_metrics(),
+                        content_type='text/plain; version=0.0.4')
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+# 对象缓存
+# 用户, 问题, 回答, 话题按主键缓存模型对象, 一页对象的外键关联对象
+# (如回答的author, question)用一次cache.get_many取出, 缓存中没有的再用一次
+# in_bulk查询, 不会在模板中逐行查询
+# 对象保存/删除时由zhihu.signals失效, 计数字段用update更新时由zhihu.counters失效
+# 缓存key中包含模型的版本号, 批量更新后调用invalidate_model使该模型的缓存全部失效
+
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from . import tag_cache, concurrency
+
+# 缓存的模型
+CACHED_MODELS = {'user.user', 'zhihu.question', 'zhihu.answer', 'zhihu.topic'}
+
+
+def is_cached(model):
+    return model._meta.label_lower in CACHED_MODELS
+
+
+def _model_tag(model):
+    return 'objects:%s' % model._meta.label_lower
+
+
+def _key_prefix(model):
+    return 'obj:%s:%s' % (model._meta.label_lower,
+                          tag_cache.get_versions([_model_tag(model)])[0])
+
+
+def _clean(obj):
+    '''去掉对象上已加载的关联对象, 只缓存对象本身的字段'''
+    obj._state.fields_cache = {}
+    obj.__dict__.pop('_prefetched_objects_cache', None)
+    return obj
+
+
+def get_many(model, ids):
+    '''按主键批量取出对象, 返回{主键: 对象}, 不存在的主键不在结果中'''
+    ids = {obj_id for obj_id in ids if obj_id is not None}
+    if not ids:
+        return {}
+    if not is_cached(model):
+        return model.objects.in_bulk(ids)
+    prefix = _key_prefix(model)
+    keys = {'%s:%s' % (prefix, obj_id): obj_id for obj_id in ids}
+    objs = {keys[key]: obj for key, obj in cache.get_many(keys).items()}
+    missing = ids - set(objs)
+    if missing:
+        loaded = model.objects.in_bulk(missing)
+        cache.set_many({'%s:%s' % (prefix, obj_id): _clean(obj) for
+                        obj_id, obj in loaded.items()},
+                       settings.OBJECT_CACHE_TIMEOUT)
+        objs.update(loaded)
+    return objs
+
+
+def get(model, obj_id):
+    '''按主键取出一个对象, 不存在时返回None'''
+    return get_many(model, [obj_id]).get(obj_id)
+
+
+def hydrate(model, ids):
+    '''按id列表取出对象, 保持id的顺序, 已删除的对象跳过'''
+    objs = get_many(model, ids)
+    return [objs[obj_id] for obj_id in ids if obj_id in objs]
+
+
+def attach(objs, *related):
+    '''用对象缓存填充同一模型的一组对象的外键关联对象
+
+    related为外键字段名, 可以用__连接多级, 如
+    attach(answers, 'author', 'question'),
+    attach(follow_records, 'answer__question', 'answer__author')
+    每个外键字段只需一次get_many, 各字段的get_many并发执行
+    '''
+    objs = [obj for obj in objs if obj is not None]
+    if not objs:
+        return
+    children = {}
+    for path in related:
+        name, _, rest = path.partition('__')
+        children.setdefault(name, [])
+        if rest:
+            children[name].append(rest)
+    fields = [objs[0]._meta.get_field(name) for name in children]
+    results = concurrency.run(*[
+        partial(get_many, field.related_model,
+                [getattr(obj, field.attname) for obj in objs])
+        for field in fields])
+    for field, related_objs in zip(fields, results):
+        name, rest = field.name, children[field.name]
+        for obj in objs:
+            related_obj = related_objs.get(getattr(obj, field.attname))
+            if related_obj is not None:
+                setattr(obj, name, related_obj)
+        if rest:
+            attach(list(related_objs.values()), *rest)
+
+
+def _delete(model, pks):
+    prefix = _key_prefix(model)
+    cache.delete_many(['%s:%s' % (prefix, pk) for pk in pks])
+
+
+def invalidate(model, *pks):
+    '''对象变化后删除缓存, 立即删除一次, 事务提交后再删除一次,
+    避免事务提交前其他请求把旧数据重新写入缓存'''
+    if not pks or not is_cached(model):
+        return
+    _delete(model, pks)
+    transaction.on_commit(lambda: _delete(model, pks))
+
+
+def invalidate_model(model):
+    '''批量更新后使一个模型的所有缓存失效'''
+    tag_cache.invalidate(_model_tag(model))
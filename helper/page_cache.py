@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+# 共享页面缓存
+# 页面以匿名用户身份渲染一次, 所有访问者(包括登录用户)共用同一份缓存;
+# 页面中与当前用户有关的小片段(导航栏用户菜单, 关注按钮, csrf token等)
+# 在模板中用{% user_fragment %}标记, 共享渲染时输出占位注释,
+# 每次请求取出缓存后再按当前用户批量渲染这些片段填入
+# 片段在zhihu.fragments中注册
+
+import hashlib
+import re
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.http import HttpResponse, QueryDict
+from django.template.loader import render_to_string
+from django.utils.http import urlencode
+
+from . import tag_cache
+
+FRAGMENT_RE = re.compile(r'<!--user-fragment:([\w-]+)\?([^>]*?)-->')
+
+# 片段名: (模板, 批量生成上下文的函数)
+FRAGMENTS = {}
+
+
+def register_fragment(name, template, batch_context=None):
+    '''注册片段
+
+    batch_context(request, args_list)返回与args_list一一对应的上下文列表,
+    同一页面中的同名片段只调用一次, 如一页关注按钮只查询一次关注状态
+    '''
+    FRAGMENTS[name] = (template, batch_context)
+
+
+def is_shared_render(request):
+    return getattr(request, '_shared_render', False)
+
+
+def fragment_marker(name, args):
+    return '<!--user-fragment:%s?%s-->' % (name, urlencode(sorted(args.items())))
+
+
+def render_fragments(request, name, args_list):
+    '''按当前用户渲染一组同名片段, 返回html列表'''
+    template, batch_context = FRAGMENTS[name]
+    contexts = batch_context(request, args_list) if batch_context else args_list
+    return [render_to_string(template, context, request=request) for context in
+            contexts]
+
+
+def fill_fragments(request, html):
+    '''把共享页面中的片段占位注释替换为当前用户的片段'''
+    markers = {}
+    for match in FRAGMENT_RE.finditer(html):
+        markers.setdefault(match.group(1), {}).setdefault(match.group(0), {
+            key: value for key, value in QueryDict(match.group(2)).items()})
+    rendered = {}
+    for name, args_by_marker in markers.items():
+        marker_list = list(args_by_marker)
+        for marker, fragment in zip(marker_list, render_fragments(
+                request, name, [args_by_marker[m] for m in marker_list])):
+            rendered[marker] = fragment
+    return FRAGMENT_RE.sub(lambda match: rendered[match.group(0)], html)
+
+
+def shared_cache_page(timeout=None, key_prefix='', tags=None, variant=None,
+                      shared_if=None):
+    '''共享页面缓存装饰器
+
+    tags: 参数与视图相同的函数, 返回页面关联的标签, 见helper.tag_cache
+    variant: 参数与视图相同的函数, 返回非空字符串时以当前用户身份渲染,
+             并单独缓存, 如用户访问自己的主页
+    shared_if: 参数为request的函数, 返回False时不使用缓存, 如有个性化内容的首页
+    '''
+    if timeout is None:
+        timeout = settings.TAG_CACHE_TIMEOUT
+
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or (
+                    shared_if and not shared_if(request)):
+                return view_func(request, *args, **kwargs)
+            page_variant = variant(request, *args, **kwargs) if variant else ''
+            key = 'shared_page:%s:%s:%s' % (
+                key_prefix, page_variant or '',
+                hashlib.md5(request.get_full_path().encode()).hexdigest())
+            key = tag_cache.make_key(
+                key, tags(request, *args, **kwargs) if tags else [])
+            cached = cache.get(key)
+            if cached is None:
+                response = _shared_render(request, view_func, args, kwargs,
+                                          page_variant)
+                # 跳转, 404等不缓存
+                if response.status_code != 200 or response.streaming:
+                    return response
+                cached = (response.content.decode(response.charset),
+                          response['Content-Type'])
+                cache.set(key, cached, timeout)
+            content, content_type = cached
+            return HttpResponse(fill_fragments(request, content),
+                                content_type=content_type)
+
+        return wrapper
+
+    return decorator
+
+
+def _shared_render(request, view_func, args, kwargs, page_variant):
+    '''以匿名用户身份渲染页面, page_variant非空时以当前用户身份渲染'''
+    user = request.user
+    if not page_variant:
+        request.user = AnonymousUser()
+    request._shared_render = True
+    try:
+        return view_func(request, *args, **kwargs)
+    finally:
+        request.user = user
+        request._shared_render = False
@@ -1,7 +1,43 @@
 # -*- coding: utf-8 -*-
 
+import math
+
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
+from django.db.models import Q
+
+
+def page_range_window(number, num_pages):
+    '''页码列表, 首尾各保留MARGIN_PAGES页, 当前页附近保留PAGE_RANGE页,
+    中间省略的页用None表示
+
+    只计算需要显示的页码, 不遍历所有页
+    '''
+    if num_pages <= settings.PAGE_RANGE:
+        return list(range(1, num_pages + 1))
+    left = settings.PAGE_RANGE / 2
+    right = settings.PAGE_RANGE - left
+    if number > num_pages - settings.PAGE_RANGE / 2:
+        right = num_pages - number
+        left = settings.PAGE_RANGE - right
+    elif number < settings.PAGE_RANGE / 2:
+        left = number
+        right = settings.PAGE_RANGE - left
+    page_numbers = set(range(1, settings.MARGIN_PAGES))
+    page_numbers.update(
+        range(num_pages - settings.MARGIN_PAGES + 1, num_pages + 1))
+    page_numbers.update(
+        range(max(1, math.ceil(number - left)),
+              min(num_pages, math.floor(number + right)) + 1))
+    page_range_ex = []
+    for page_number in sorted(page_numbers):
+        if page_range_ex and page_number > page_range_ex[-1] + 1:
+            page_range_ex.append(None)
+        page_range_ex.append(page_number)
+    if page_range_ex[0] != 1:
+        page_range_ex.insert(0, None)
+    return page_range_ex
 
 
 def paginator_helper(request, object_list, per_page=10):
@@ -15,31 +51,131 @@ def paginator_helper(request, object_list, per_page=10):
     except EmptyPage:
         page = paginator.page(paginator.num_pages)
 
-    page_range_ex = []
     if paginator.num_pages > settings.PAGE_RANGE:
-        left = settings.PAGE_RANGE / 2
-        right = settings.PAGE_RANGE - left
-        if page.number > paginator.num_pages - settings.PAGE_RANGE / 2:
-            right = paginator.num_pages - page.number
-            left = settings.PAGE_RANGE - right
-        elif page.number < settings.PAGE_RANGE / 2:
-            left = page.number
-            right = settings.PAGE_RANGE - left
-        for page_number in range(1, paginator.num_pages + 1):
-            if page_number < settings.MARGIN_PAGES:
-                page_range_ex.append(page_number)
-                continue
-            if page_number > paginator.num_pages - settings.MARGIN_PAGES:
-                page_range_ex.append(page_number)
-                continue
-            if (page_number >= page.number - left) and (
-                    page_number <= page.number + right):
-                page_range_ex.append(page_number)
-                continue
-            if page_range_ex[-1]:
-                page_range_ex.append(None)
         # 由于paginator.page_range为只读, 给page绑定页码列表
-        page.page_range_ex = page_range_ex
+        page.page_range_ex = page_range_window(page.number, paginator.num_pages)
     else:
         page.page_range_ex = paginator.page_range
     return page
+
+
+class CursorPage(object):
+    '''游标分页的一页
+
+    next_cursor为下一页的游标, 没有下一页时为None;
+    cursor为当前页的游标, 第一页为None;
+    count为总数, 未统计时为None, count_exact为False时count是下限
+    '''
+
+    def __init__(self, object_list, next_cursor, cursor, count=None,
+                 count_exact=True):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.cursor = cursor
+        self.count = count
+        self.count_exact = count_exact
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.cursor is not None
+
+
+def _field_name(order):
+    return order.lstrip('-')
+
+
+def encode_cursor(obj, ordering):
+    '''由一页最后一个对象的排序字段值生成游标, 如 2018-03-20T10:00:00,42'''
+    values = []
+    for order in ordering:
+        value = getattr(obj, _field_name(order))
+        values.append(value.isoformat() if hasattr(value, 'isoformat') else
+                      str(value))
+    return ','.join(values)
+
+
+def decode_cursor(model, cursor, ordering):
+    '''解析游标, 按模型字段类型转换排序字段值, 无效时返回None'''
+    if not cursor:
+        return None
+    values = cursor.split(',')
+    if len(values) != len(ordering):
+        return None
+    try:
+        return [model._meta.get_field(_field_name(order)).to_python(value)
+                for order, value in zip(ordering, values)]
+    except ValidationError:
+        return None
+
+
+def keyset_filter(ordering, values):
+    '''排序在游标之后的记录的查询条件
+
+    如ordering为('-pub_time', '-id')时为
+    pub_time < t OR (pub_time = t AND id < i)
+    '''
+    condition = Q()
+    for i, order in enumerate(ordering):
+        lookup = '__lt' if order.startswith('-') else '__gt'
+        q = Q(**{_field_name(order) + lookup: values[i]})
+        for prev_order, value in zip(ordering[:i], values[:i]):
+            q &= Q(**{_field_name(prev_order): value})
+        condition |= q
+    return condition
+
+
+def approximate_count(queryset, limit=1000):
+    '''统计总数, 最多数到limit条, 返回(总数, 是否精确)
+
+    COUNT(*)只扫描前limit+1条记录, 记录很多时显示"1000+"
+    '''
+    count = queryset.order_by()[:limit + 1].count()
+    if count > limit:
+        return limit, False
+    return count, True
+
+
+def cursor_paginator_helper(request, queryset, per_page=10,
+                            ordering=('-pub_time', '-id'), cursor_name='after',
+                            with_count=False):
+    '''游标分页辅助函数
+
+    按ordering排序, 最后一个排序字段应唯一(如id); 请求参数cursor_name为
+    上一页最后一条记录的排序字段值, 翻页时用WHERE条件定位,
+    不需要OFFSET和COUNT(*), 翻到很后面的页也不会变慢;
+    with_count为True时统计近似总数
+    '''
+    count, count_exact = None, True
+    if with_count:
+        count, count_exact = approximate_count(queryset)
+    cursor = request.GET.get(cursor_name)
+    values = decode_cursor(queryset.model, cursor, ordering)
+    if values is None:
+        cursor = None
+    else:
+        queryset = queryset.filter(keyset_filter(ordering, values))
+    # 多取一条判断是否有下一页
+    object_list = list(queryset.order_by(*ordering)[:per_page + 1])
+    next_cursor = None
+    if len(object_list) > per_page:
+        object_list = object_list[:per_page]
+        next_cursor = encode_cursor(object_list[-1], ordering)
+    return CursorPage(object_list, next_cursor, cursor, count, count_exact)
+
+
+def related_paginator_helper(request, queryset, field, per_page=10,
+                             related=()):
+    '''关系表分页辅助函数
+
+    先对关系记录(如收藏, 关注记录)分页, 再取出当前页记录的field关联对象,
+    关联对象和它的related字段用JOIN一起查询, 不会逐条查询;
+    如 related_paginator_helper(request, user.usercollectanswer_set.all(),
+    'answer', related=('question', 'author'))
+    '''
+    related = [field] + ['%s__%s' % (field, name) for name in related]
+    page = paginator_helper(request, queryset.select_related(*related),
+                            per_page)
+    page.object_list = [getattr(obj, field) for obj in page.object_list]
+    return page
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+# 查询结果缓存
+# 缓存QuerySet会把查询和模型对象一起序列化, 取出后再order_by还会重新查询数据库;
+# 这里只缓存id和排序字段组成的元组列表, 排序和分页在内存中完成,
+# 再按id取出当前页的对象
+
+from .paginator_helper import CursorPage
+from . import tag_cache, object_cache
+
+
+def cached_rows(key, tags, queryset, fields=('id',), timeout=None):
+    '''缓存查询结果的字段值元组列表, 第一个字段应为id, 失效规则见helper.tag_cache'''
+    return tag_cache.get_or_set(
+        key, tags, lambda: list(queryset.values_list(*fields)), timeout)
+
+
+def sorted_ids(rows, index, reverse=True):
+    '''按元组的第index个字段排序, 相同时按id排序, 返回id列表'''
+    return [row[0] for row in
+            sorted(rows, key=lambda row: (row[index], row[0]), reverse=reverse)]
+
+
+def hydrate(model, ids, related=()):
+    '''按id列表从对象缓存取出对象, 保持id的顺序, 已删除的对象跳过,
+    related为需要一起取出的外键关联对象'''
+    objs = object_cache.hydrate(model, ids)
+    object_cache.attach(objs, *related)
+    return objs
+
+
+class CachedIdList(object):
+    '''缓存的id列表
+
+    支持len()和切片, 可以直接传给paginator_helper分页,
+    切片时只取出当前页的对象
+    '''
+
+    def __init__(self, model, ids, related=()):
+        self.model = model
+        self.ids = ids
+        self.related = related
+
+    def count(self):
+        return len(self.ids)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        return hydrate(self.model, self.ids[index], self.related)
+
+
+def cursor_page(request, id_list, per_page=10, cursor_name='after'):
+    '''在CachedIdList上游标翻页, 游标为上一页最后一个对象的id
+
+    游标对应的对象不在列表中时(如已删除)从第一页开始
+    '''
+    cursor = request.GET.get(cursor_name)
+    start = 0
+    try:
+        start = id_list.ids.index(int(cursor)) + 1
+    except (TypeError, ValueError):
+        cursor = None
+    object_list = id_list[start:start + per_page]
+    next_cursor = None
+    if start + per_page < len(id_list) and object_list:
+        next_cursor = str(id_list.ids[start + per_page - 1])
+    return CursorPage(object_list, next_cursor, cursor)
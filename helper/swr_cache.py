@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+# 防击穿缓存 (stale-while-revalidate)
+# 计算代价大的结果(如发现页, 话题广场的排序id列表)过期时, 并发请求会同时重新计算;
+# 这里缓存项在软过期后仍保留STALE时间:
+#   未过期      直接返回, 临近过期时按计算耗时以一定概率提前刷新(XFetch)
+#   已软过期/标签版本变化  返回旧值, 同时触发一次后台刷新
+#   不存在      获得锁的请求计算, 其他请求短暂等待结果
+# 刷新时用cache.add(redis SET NX)加锁, 同一个缓存项同一时间只有一个刷新,
+# 刷新由celery任务(settings.SWR_REFRESH_TASK)调用refresh完成
+# 用法:
+#   @swr_cache.cached('hot_topics', timeout=10 * 60, tags=['topics'])
+#   def hot_topic_ids():
+#       return list(Topic.objects.order_by(...).values_list('id', flat=True))
+# 参数需可以json序列化, 定义函数的模块需在celery worker中导入
+# schedule_build用于redis中全量生成的索引(相关问题, 热度排行等):
+# 索引不存在时只触发一次后台生成, 读取方先返回空结果, 不在请求中生成
+
+import logging
+import math
+import random
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+from . import tag_cache
+
+logger = logging.getLogger(__name__)
+
+# 函数名: (函数, 缓存时间, 过期后保留时间, 标签)
+FUNCTIONS = {}
+
+# 锁的过期时间, 刷新进程异常退出时锁自动释放
+LOCK_TIMEOUT = 60
+# 缓存不存在且未获得锁时等待其他请求计算结果的时间
+WAIT_TIMEOUT = 3
+WAIT_INTERVAL = 0.05
+# 提前刷新的系数, 越大越早刷新
+BETA = 1.0
+# 后台生成索引的锁时间, 生成任务结束时释放
+BUILD_LOCK_TIMEOUT = 10 * 60
+
+
+def _key(name, args):
+    return 'swr:%s:%s' % (name, ':'.join(str(arg) for arg in args))
+
+
+def _tags(tags, args):
+    if callable(tags):
+        return tags(*args)
+    return tags or []
+
+
+def acquire_lock(key, timeout=LOCK_TIMEOUT):
+    '''获取锁, 已被其他进程持有时返回False'''
+    return cache.add('swr_lock:%s' % key, 1, timeout)
+
+
+def release_lock(key):
+    cache.delete('swr_lock:%s' % key)
+
+
+def schedule_build(key, task):
+    '''交给celery后台生成索引, 已有任务在生成时不重复触发
+
+    获得锁后调用task.delay(), 任务结束时应调用release_lock(key)
+    '''
+    if not acquire_lock(key, BUILD_LOCK_TIMEOUT):
+        return
+    try:
+        task.delay()
+    except Exception:
+        # celery不可用, 释放锁, 下次读取时重试
+        logger.exception('schedule build %s failed', key)
+        release_lock(key)
+
+
+def wait_for(getter, timeout=WAIT_TIMEOUT):
+    '''等待其他进程生成结果, getter返回None表示还没有生成, 超时返回None'''
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        time.sleep(WAIT_INTERVAL)
+        value = getter()
+        if value is not None:
+            return value
+    return None
+
+
+def cached(name, timeout, stale_timeout=None, tags=None):
+    '''注册一个防击穿缓存的函数, 调用时返回缓存的结果
+
+    timeout: 缓存时间, 过期后返回旧值并在后台刷新
+    stale_timeout: 过期后旧值保留的时间, 默认与timeout相同
+    tags: 标签列表, 或参数与函数相同的函数, 标签失效后按过期处理, 见helper.tag_cache
+    '''
+    if stale_timeout is None:
+        stale_timeout = timeout
+
+    def decorator(func):
+        FUNCTIONS[name] = (func, timeout, stale_timeout, tags)
+
+        @wraps(func)
+        def wrapper(*args):
+            return get(name, args)
+
+        wrapper.refresh = lambda *args: refresh(name, args)
+        return wrapper
+
+    return decorator
+
+
+def _compute(name, args):
+    '''计算并写入缓存, 返回结果'''
+    func, timeout, stale_timeout, tags = FUNCTIONS[name]
+    versions = tag_cache.get_versions(_tags(tags, args))
+    start = time.time()
+    value = func(*args)
+    now = time.time()
+    cache.set(_key(name, args), {
+        'value': value,
+        'expires': now + timeout,
+        'delta': now - start,
+        'versions': versions,
+    }, timeout + stale_timeout)
+    return value
+
+
+def refresh(name, args):
+    '''重新计算缓存项并释放刷新锁, 由celery任务调用'''
+    key = _key(name, args)
+    try:
+        return _compute(name, args)
+    finally:
+        release_lock(key)
+
+
+def _schedule_refresh(name, args):
+    '''获得锁后交给celery刷新, 已有刷新在进行时不重复触发'''
+    key = _key(name, args)
+    if not acquire_lock(key):
+        return
+    try:
+        import_string(settings.SWR_REFRESH_TASK).delay(name, list(args))
+    except Exception:
+        # celery不可用时在当前请求中刷新
+        refresh(name, args)
+
+
+def should_refresh(expires, delta):
+    '''是否需要刷新, expires为过期时间, delta为上次计算耗时(秒)
+
+    XFetch: 剩余时间越少, 计算越慢, 越可能在过期前提前刷新
+    '''
+    early = delta * BETA * -math.log(1 - random.random())
+    return time.time() + early >= expires
+
+
+def _is_stale(item, name, args):
+    tags = FUNCTIONS[name][3]
+    if item['versions'] != tag_cache.get_versions(_tags(tags, args)):
+        return True
+    return should_refresh(item['expires'], item['delta'])
+
+
+def get(name, args=()):
+    '''读取缓存结果'''
+    args = tuple(args)
+    key = _key(name, args)
+    item = cache.get(key)
+    if item is not None:
+        if _is_stale(item, name, args):
+            _schedule_refresh(name, args)
+        return item['value']
+    # 缓存不存在, 只有获得锁的请求计算, 其他请求等待结果
+    if acquire_lock(key):
+        return refresh(name, args)
+    item = wait_for(lambda: cache.get(key))
+    if item is not None:
+        return item['value']
+    return _compute(name, args)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+# 带标签的缓存
+# 缓存项关联若干标签, 如 question:42, topic:7, 每个标签在缓存中保存一个版本号,
+# 缓存key中包含所有标签的当前版本号; 数据变化时由zhihu.signals增加相关标签的版本号,
+# 旧版本的缓存项不会再被读取, 等待过期删除
+# 因此缓存时间可以设置得很长, 数据变化后也不会读到旧数据
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+def _version_key(tag):
+    return 'tag_version:%s' % tag
+
+
+def get_versions(tags):
+    '''一次读取多个标签的版本号, 不存在的标签以当前时间(毫秒)为初始版本号
+
+    版本号被清除后重新生成, 不会与清除前的版本号重复
+    '''
+    keys = [_version_key(tag) for tag in tags]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, int(time.time() * 1000), None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def make_key(key, tags):
+    '''缓存key加上标签版本号'''
+    if not tags:
+        return key
+    return '%s:%s' % (key, '.'.join(str(version) for version in
+                                    get_versions(tags)))
+
+
+def get(key, tags, default=None):
+    return cache.get(make_key(key, tags), default)
+
+
+def set(key, value, tags, timeout=None):
+    if timeout is None:
+        timeout = settings.TAG_CACHE_TIMEOUT
+    cache.set(make_key(key, tags), value, timeout)
+
+
+def get_or_set(key, tags, default, timeout=None):
+    '''读取缓存, 不存在时调用default()生成并缓存'''
+    tagged_key = make_key(key, tags)
+    value = cache.get(tagged_key)
+    if value is None:
+        value = default()
+        if timeout is None:
+            timeout = settings.TAG_CACHE_TIMEOUT
+        cache.set(tagged_key, value, timeout)
+    return value
+
+
+def invalidate(*tags):
+    '''增加标签的版本号, 使关联的缓存项失效'''
+    for tag in tags:
+        try:
+            cache.incr(_version_key(tag))
+        except ValueError:
+            # 标签还没有版本号, 没有关联的缓存项
+            pass
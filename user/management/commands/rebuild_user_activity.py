@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+# 由已有的回答, 提问, 点赞, 收藏, 关注问题记录重新生成用户动态
+# 运行: python manage.py rebuild_user_activity
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from user.models import UserActivity
+from user.timeline import ACTIVITY_MODELS, build_activity
+
+
+class Command(BaseCommand):
+    help = '重新生成用户动态'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='每次批量插入的记录数')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        with transaction.atomic():
+            UserActivity.objects.all().delete()
+            for activity_type, (model, *_) in ACTIVITY_MODELS.items():
+                nums = 0
+                activities = []
+                for obj in model.objects.iterator(chunk_size=batch_size):
+                    activities.append(build_activity(obj))
+                    if len(activities) >= batch_size:
+                        UserActivity.objects.bulk_create(activities)
+                        nums += len(activities)
+                        activities = []
+                UserActivity.objects.bulk_create(activities)
+                nums += len(activities)
+                self.stdout.write('%s: %d activities' % (activity_type, nums))
@@ -0,0 +1,53 @@
+# Generated by Django 2.0.3 on 2026-10-18 16:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0007_auto_20180628_1903'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='answer_by_collected_nums',
+            field=models.IntegerField(default=0, verbose_name='回答被收藏数'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='answer_by_followed_nums',
+            field=models.IntegerField(default=0, verbose_name='回答被赞同数'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='answer_nums',
+            field=models.IntegerField(default=0, verbose_name='回答数'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='collect_answer_nums',
+            field=models.IntegerField(default=0, verbose_name='收藏回答数'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='follow_question_nums',
+            field=models.IntegerField(default=0, verbose_name='关注问题数'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='follow_user_nums',
+            field=models.IntegerField(default=0, verbose_name='关注用户数'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='followed_by_user_nums',
+            field=models.IntegerField(default=0, verbose_name='关注者数'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='topic_nums',
+            field=models.IntegerField(default=0, verbose_name='关注话题数'),
+        ),
+    ]
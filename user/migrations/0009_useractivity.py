@@ -0,0 +1,33 @@
+# Generated by Django 2.0.3 on 2026-10-18 16:48
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0008_user_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserActivity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('activity_type', models.CharField(choices=[('answer', '回答了问题'), ('question', '提了一个问题'), ('follow_answer', '赞同了回答'), ('collect_answer', '收藏了回答'), ('follow_question', '关注了问题')], max_length=20, verbose_name='动态类型')),
+                ('object_id', models.IntegerField(verbose_name='记录id')),
+                ('add_time', models.DateTimeField(verbose_name='动态时间')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='用户')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='useractivity',
+            index=models.Index(fields=['user', '-add_time', '-id'], name='user_userac_user_id_a542fd_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='useractivity',
+            unique_together={('activity_type', 'object_id')},
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 2.0.3 on 2026-10-18 17:15
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicates(apps, schema_editor):
+    '''添加唯一约束前删除重复点击插入的关注记录, 每组保留最早的一条
+    删除后运行 python manage.py sync_counters 修正计数字段'''
+    UserRelationship = apps.get_model('user', 'UserRelationship')
+    duplicates = UserRelationship.objects.values('from_user', 'to_user') \
+        .annotate(first_id=Min('id'), nums=Count('id')).filter(nums__gt=1)
+    for row in duplicates:
+        UserRelationship.objects.filter(
+            from_user=row['from_user'], to_user=row['to_user']).exclude(
+            id=row['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0009_useractivity'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='userrelationship',
+            unique_together={('from_user', 'to_user')},
+        ),
+        migrations.AddIndex(
+            model_name='userrelationship',
+            index=models.Index(fields=['from_user', '-add_time', '-id'], name='user_userre_from_us_326038_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userrelationship',
+            index=models.Index(fields=['to_user', '-add_time', '-id'], name='user_userre_to_user_c3b34f_idx'),
+        ),
+    ]
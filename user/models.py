@@ -26,34 +26,42 @@ class User(AbstractUser):
     users = models.ManyToManyField('self', through='UserRelationship',
                                    symmetrical=False, verbose_name='关注')
 
+    # 计数字段, 由zhihu.counters维护, 避免模板中逐行COUNT查询
+    answer_nums = models.IntegerField('回答数', default=0)
+    topic_nums = models.IntegerField('关注话题数', default=0)
+    collect_answer_nums = models.IntegerField('收藏回答数', default=0)
+    follow_question_nums = models.IntegerField('关注问题数', default=0)
+    answer_by_followed_nums = models.IntegerField('回答被赞同数', default=0)
+    answer_by_collected_nums = models.IntegerField('回答被收藏数', default=0)
+    follow_user_nums = models.IntegerField('关注用户数', default=0)
+    followed_by_user_nums = models.IntegerField('关注者数', default=0)
+
     def __str__(self):
         return self.username
 
     def get_answer_nums(self):
         '''获取回答数量'''
-        return self.answer_set.count()
+        return self.answer_nums
 
     def get_topic_nums(self):
         '''获取关注话题的数量'''
-        return self.topic_set.count()
+        return self.topic_nums
 
     def get_collect_answer_nums(self):
         '''获取收藏的回答数量'''
-        return self.usercollectanswer_set.count()
+        return self.collect_answer_nums
 
     def get_follow_question_nums(self):
         '''获取关注的问题数量'''
-        return self.userfollowquestion_set.all().count()
+        return self.follow_question_nums
 
     def get_answer_by_followed_nums(self):
         '''获取所有回答的被关注数量'''
-        from zhihu.models import UserFollowAnswer
-        return UserFollowAnswer.objects.filter(answer__author=self).count()
+        return self.answer_by_followed_nums
 
     def get_answer_by_collected_nums(self):
         '''获取所有回答的被关注数量'''
-        from zhihu.models import UserCollectAnswer
-        return UserCollectAnswer.objects.filter(answer__author=self).count()
+        return self.answer_by_collected_nums
 
     def generate_confirm_token(self):
         '''生成用户确认签名'''
@@ -96,11 +104,11 @@ class User(AbstractUser):
 
     def get_follow_user_nums(self):
         '''获取用户关注的用户数量'''
-        return self.to_user_set.count()
+        return self.follow_user_nums
 
     def get_followed_by_user_nums(self):
         '''获取关注该用户的用户数量'''
-        return self.from_user_set.count()
+        return self.followed_by_user_nums
 
 
 class CheckCode(models.Model):
@@ -121,3 +129,37 @@ class UserRelationship(models.Model):
     to_user = models.ForeignKey(User, on_delete=models.CASCADE,
                                 related_name='from_user_set', verbose_name='关注')
     add_time = models.DateTimeField('关注时间', auto_now_add=True)
+
+    class Meta:
+        # 每对用户只有一条关注记录, 重复点击不会插入多条
+        unique_together = ('from_user', 'to_user')
+        # 用户主页关注的人, 关注者列表按(add_time, id)倒序
+        indexes = [
+            models.Index(fields=['from_user', '-add_time', '-id']),
+            models.Index(fields=['to_user', '-add_time', '-id']),
+        ]
+
+
+class UserActivity(models.Model):
+    '''用户动态模型, 用户回答, 提问, 点赞, 收藏, 关注问题时追加一条记录'''
+    activity_choices = (
+        ('answer', '回答了问题'),
+        ('question', '提了一个问题'),
+        ('follow_answer', '赞同了回答'),
+        ('collect_answer', '收藏了回答'),
+        ('follow_question', '关注了问题'),
+    )
+    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name='用户')
+    activity_type = models.CharField('动态类型', choices=activity_choices,
+                                     max_length=20)
+    # 动态对应记录的id: 回答, 问题, 点赞, 收藏, 关注问题记录
+    object_id = models.IntegerField('记录id')
+    add_time = models.DateTimeField('动态时间')
+
+    class Meta:
+        # 用户主页按(add_time, id)倒序翻页
+        indexes = [models.Index(fields=['user', '-add_time', '-id'])]
+        unique_together = ('activity_type', 'object_id')
+
+    def __str__(self):
+        return self.get_activity_type_display()
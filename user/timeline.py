@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+# 用户动态时间线
+# 用户回答, 提问, 点赞, 收藏, 关注问题时由zhihu.signals追加UserActivity记录,
+# 对应记录删除时删除动态; 用户主页按(add_time, id)倒序游标翻页,
+# 每页只查询一页动态, 再按类型批量取出对应的记录
+# 为已有数据生成动态: python manage.py rebuild_user_activity
+
+from helper import object_cache
+from helper.paginator_helper import cursor_paginator_helper
+from zhihu.models import Question, Answer, UserFollowAnswer, \
+    UserCollectAnswer, UserFollowQuestion, attach_topic_names
+from .models import UserActivity
+
+# 动态类型: (模型, 用户字段, 时间字段, 模板需要的关联字段)
+ACTIVITY_MODELS = {
+    'answer': (Answer, 'author', 'pub_time', ('question', 'author')),
+    'question': (Question, 'author', 'pub_time', ()),
+    'follow_answer': (UserFollowAnswer, 'user', 'add_time',
+                      ('answer__question', 'answer__author')),
+    'collect_answer': (UserCollectAnswer, 'user', 'add_time',
+                       ('answer__question', 'answer__author')),
+    'follow_question': (UserFollowQuestion, 'user', 'add_time', ('question',)),
+}
+
+# 模型: 动态类型
+ACTIVITY_TYPES = {model: activity_type for activity_type, (model, *_) in
+                  ACTIVITY_MODELS.items()}
+
+
+def build_activity(obj):
+    '''由回答, 问题等记录生成动态对象, 不是动态记录时返回None'''
+    activity_type = ACTIVITY_TYPES.get(type(obj))
+    if activity_type is None:
+        return None
+    model, user_field, time_field, related = ACTIVITY_MODELS[activity_type]
+    return UserActivity(user_id=getattr(obj, user_field + '_id'),
+                        activity_type=activity_type, object_id=obj.id,
+                        add_time=getattr(obj, time_field))
+
+
+def add_activity(obj):
+    '''追加动态'''
+    activity = build_activity(obj)
+    if activity is not None:
+        activity.save()
+
+
+def remove_activity(obj):
+    '''对应记录删除时删除动态'''
+    activity_type = ACTIVITY_TYPES.get(type(obj))
+    if activity_type is not None:
+        UserActivity.objects.filter(activity_type=activity_type,
+                                    object_id=obj.id).delete()
+
+
+def get_timeline_page(request, user, per_page=10):
+    '''获取用户动态的一页, 请求参数after为上一页最后一条动态的游标'''
+    page = cursor_paginator_helper(request,
+                                   UserActivity.objects.filter(user=user),
+                                   per_page, ordering=('-add_time', '-id'))
+    activities = page.object_list
+
+    # 按类型批量取出动态对应的记录
+    object_ids = {}
+    for activity in activities:
+        object_ids.setdefault(activity.activity_type, []).append(
+            activity.object_id)
+    # 回答, 问题及关联的问题, 作者从对象缓存批量取出
+    objects = {}
+    for activity_type, ids in object_ids.items():
+        model, user_field, time_field, related = ACTIVITY_MODELS[activity_type]
+        objects[activity_type] = object_cache.get_many(model, ids)
+        object_cache.attach(objects[activity_type].values(), *related)
+    object_list = []
+    for activity in activities:
+        obj = objects[activity.activity_type].get(activity.object_id)
+        if obj is not None:
+            object_list.append(obj)
+    # 收藏动态显示回答所属问题的话题名
+    attach_topic_names([obj.answer.question for obj in object_list if
+                        isinstance(obj, UserCollectAnswer)])
+    # object_list替换为动态对应的回答, 问题, 点赞, 收藏, 关注问题记录
+    page.object_list = object_list
+    return page
@@ -1,25 +1,28 @@
 import random
 import time
 from datetime import datetime, timedelta
-from itertools import chain
 
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.backends import ModelBackend  # 这是默认用户认证后端
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Q, Count
 from django.http import JsonResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse
-from django.views.decorators.cache import cache_page
+from django.views.decorators.cache import never_cache
 
-from helper.paginator_helper import paginator_helper
-from zhihu.models import Answer, Question
+from helper import page_cache
+from helper.paginator_helper import paginator_helper, related_paginator_helper
+from zhihu import counters, leaderboard, toggles
+from zhihu.models import Answer
 from .forms import RegisterForm, LoginForm, ForgetPwdForm, UserProfileForm, \
     ChangePasswordForm, ChangeEmailForm
-from .models import User, CheckCode, UserRelationship
+from .models import User, CheckCode
 from .tasks import send_email
+from .timeline import get_timeline_page
 
 
 class CustomModelBackend(ModelBackend):
@@ -126,49 +129,40 @@ def resend_confirm_email(request):
         return redirect(reverse('index'))
 
 
-def get_time(obj):
-    '''返回对象的创建时间, 在sorted中以对象的创建时间比较'''
-    if isinstance(obj, Answer) or isinstance(obj, Question):
-        return obj.pub_time
-    else:
-        return obj.add_time
+def _user_tags(request, user_id):
+    '''用户主页各页面的缓存标签'''
+    return ['user:%s' % user_id]
+
+
+def _owner_variant(request, user_id, **kwargs):
+    '''用户访问自己的主页时以用户身份渲染, 单独缓存'''
+    if request.user.is_authenticated and request.user.id == int(user_id):
+        return 'owner'
 
 
-@cache_page(60, key_prefix='user_home')
+@page_cache.shared_cache_page(key_prefix='user_home', tags=_user_tags,
+                              variant=_owner_variant)
 def user_home(request, user_id):
     '''用户主页'''
     user = get_object_or_404(User, id=user_id)
-    # 当前用户是否已关注用户
-    has_follow_user = False
-    if request.user.is_authenticated:
-        if request.user.to_user_set.filter(to_user=user):
-            has_follow_user = True
-
-    user_answers = user.answer_set.all()
-    user_questions = user.question_set.all()
-    user_follow_answers = user.userfollowanswer_set.all()
-    user_collect_answers = user.usercollectanswer_set.all()
-    user_follow_questions = user.userfollowquestion_set.all()
-    # 使用itertools.chain合并多个queryset, 反应用户的动态
-    user_trend = chain(user_answers, user_questions, user_follow_answers,
-                       user_collect_answers, user_follow_questions)
-    user_trend_sorted = sorted(user_trend, key=get_time, reverse=True)
-    # 分页
-    user_trend_sorted_page = paginator_helper(request, user_trend_sorted,
-                                              per_page=settings.TREND_PER_PAGE)
+
+    # 用户动态, 按时间倒序, 使用游标翻页, 每页只查询当前页的动态
+    user_trend_sorted_page = get_timeline_page(request, user,
+                                               per_page=settings.TREND_PER_PAGE)
 
     context = {}
     context['user'] = user
-    context['has_follow_user'] = has_follow_user
     context['user_trend_sorted_page'] = user_trend_sorted_page
     return render(request, 'user/user_home.html', context)
 
 
-@cache_page(60, key_prefix='user_answer')
+@page_cache.shared_cache_page(key_prefix='user_answer', tags=_user_tags,
+                              variant=_owner_variant)
 def user_answer(request, user_id):
     '''用户主页--回答'''
     user = get_object_or_404(User, id=user_id)
-    user_answers = user.answer_set.all().order_by('-pub_time')
+    user_answers = user.answer_set.select_related('question').order_by(
+        '-pub_time')
 
     user_answers_page = paginator_helper(request, user_answers,
                                          per_page=settings.ANSWER_PER_PAGE)
@@ -178,7 +172,8 @@ def user_answer(request, user_id):
     return render(request, 'user/user_answer.html', context)
 
 
-@cache_page(60, key_prefix='user_question')
+@page_cache.shared_cache_page(key_prefix='user_question', tags=_user_tags,
+                              variant=_owner_variant)
 def user_question(request, user_id):
     '''用户主页--提问'''
     user = get_object_or_404(User, id=user_id)
@@ -192,92 +187,75 @@ def user_question(request, user_id):
     return render(request, 'user/user_question.html', context)
 
 
-@cache_page(60)
+@page_cache.shared_cache_page(key_prefix='user_collect_answer', tags=_user_tags,
+                              variant=_owner_variant)
 def user_collect_answer(request, user_id):
     '''用户主页--收藏的回答'''
     user = get_object_or_404(User, id=user_id)
     user_collect_answers = user.usercollectanswer_set.all().order_by(
-        '-add_time')
-    # 取出answer对象
-    user_collect_answers = [obj.answer for obj in user_collect_answers]
-    user_collect_answers_page = paginator_helper(request, user_collect_answers,
-                                                 per_page=settings.ANSWER_PER_PAGE)
+        '-add_time', '-id')
+    # 先分页, 只取出当前页的answer对象
+    user_collect_answers_page = related_paginator_helper(
+        request, user_collect_answers, 'answer',
+        per_page=settings.ANSWER_PER_PAGE, related=('question', 'author'))
     context = {}
     context['user'] = user
     context['user_collect_answers_page'] = user_collect_answers_page
     return render(request, 'user/user_collect_answer.html', context)
 
 
-@cache_page(60)
+@page_cache.shared_cache_page(key_prefix='user_follow_topic', tags=_user_tags,
+                              variant=_owner_variant)
 def user_follow_topic(request, user_id):
     '''用户主页--关注话题'''
     user = get_object_or_404(User, id=user_id)
-    # 用户关注的话题
-    user_topics = user.topic_set.all()
-    user_topics_list = []
-    if user_topics:
-        for topic in user_topics:
-            # 话题下所有问题
-            topic_questions = topic.question_set.all()
-            # 用户在该话题下的所有回答
-            user_answer_nums = Answer.objects.filter(
-                question__in=topic_questions, author=user).count()
-            # 创建dict对象放入列表中
-            user_topics_list.append(
-                {'topic': topic, 'user_answer_nums': user_answer_nums})
-
-    user_topics_page = paginator_helper(request, user_topics_list,
+    # 用户关注的话题, 先分页
+    user_topics_page = paginator_helper(request,
+                                        user.topic_set.all().order_by('id'),
                                         per_page=settings.TOPIC_PER_PAGE)
+    topics = list(user_topics_page.object_list)
+    # 一次分组查询出用户在当前页每个话题下的回答数
+    user_answer_nums = dict(Answer.objects.filter(
+        author=user, question__topics__in=topics).order_by().values_list(
+        'question__topics').annotate(nums=Count('id')))
+    # 创建dict对象放入列表中
+    user_topics_page.object_list = [
+        {'topic': topic, 'user_answer_nums': user_answer_nums.get(topic.id, 0)}
+        for topic in topics]
     context = {}
     context['user'] = user
     context['user_topics_page'] = user_topics_page
     return render(request, 'user/user_follow_topic.html', context)
 
 
-@cache_page(60)
+@page_cache.shared_cache_page(key_prefix='user_follow_question', tags=_user_tags,
+                              variant=_owner_variant)
 def user_follow_question(request, user_id):
     '''用户主页--关注问题'''
     user = get_object_or_404(User, id=user_id)
     # 用户关注问题
     user_follow_questions = user.userfollowquestion_set.all().order_by(
-        '-add_time')
-    # 取出question对象
-    user_follow_questions = [obj.question for obj in user_follow_questions]
-    user_follow_questions_page = paginator_helper(request,
-                                                  user_follow_questions,
-                                                  per_page=settings.QUESTION_PER_PAGE)
+        '-add_time', '-id')
+    # 先分页, 只取出当前页的question对象
+    user_follow_questions_page = related_paginator_helper(
+        request, user_follow_questions, 'question',
+        per_page=settings.QUESTION_PER_PAGE)
     context = {}
     context['user'] = user
     context['user_follow_questions_page'] = user_follow_questions_page
     return render(request, 'user/user_follow_question.html', context)
 
 
-@cache_page(60)
+@page_cache.shared_cache_page(key_prefix='user_follow_user', tags=_user_tags,
+                              variant=_owner_variant)
 def user_follow_user(request, user_id):
     '''用户主页--用户关注'''
     user = get_object_or_404(User, id=user_id)
     # 该用户关注的用户
-    to_users = user.to_user_set.all().order_by('-add_time')
-    # 取出关注的用户
-    to_users = [obj.to_user for obj in to_users]
-
-    # 判断用户关注的用户是否被当前用户关注
-    to_users_list = []
-    if request.user.is_authenticated and request.user != user:
-        # 当前用户关注的用户
-        current_user_to_users = [obj.to_user for obj in
-                                 request.user.to_user_set.all().order_by(
-                                     '-add_time')]
-        for to_user in to_users:
-            if to_user in current_user_to_users:
-                # 添加被当前用户关注属性
-                to_user.has_followed = True
-            to_users_list.append(to_user)
-        to_users_page = paginator_helper(request, to_users_list,
-                                         per_page=settings.USER_PER_PAGE)
-    else:
-        to_users_page = paginator_helper(request, to_users,
-                                         per_page=settings.USER_PER_PAGE)
+    to_users = user.to_user_set.all().order_by('-add_time', '-id')
+    # 先分页, 只取出当前页关注的用户
+    to_users_page = related_paginator_helper(request, to_users, 'to_user',
+                                             per_page=settings.USER_PER_PAGE)
 
     context = {}
     context['user'] = user
@@ -285,31 +263,17 @@ def user_follow_user(request, user_id):
     return render(request, 'user/user_follow_user.html', context)
 
 
-@cache_page(60)
+@page_cache.shared_cache_page(key_prefix='user_followed_by_user', tags=_user_tags,
+                              variant=_owner_variant)
 def user_followed_by_user(request, user_id):
     '''用户主页--用户关注者'''
     user = get_object_or_404(User, id=user_id)
     # 关注该用户的用户
-    from_users = user.from_user_set.all().order_by('-add_time')
-    # 取出关注者
-    from_users = [obj.from_user for obj in from_users]
-
-    # 判断用户的关注者是否也被当前用户关注
-    from_users_list = []
-    if request.user.is_authenticated:
-        # 当前用户关注的用户
-        current_user_to_users = [obj.to_user for obj in
-                                 request.user.to_user_set.all().order_by(
-                                     '-add_time')]
-        for from_user in from_users:
-            if from_user in current_user_to_users:
-                from_user.has_followed = True
-            from_users_list.append(from_user)
-        from_users_page = paginator_helper(request, from_users_list,
-                                           per_page=settings.USER_PER_PAGE)
-    else:
-        from_users_page = paginator_helper(request, from_users,
-                                           per_page=settings.USER_PER_PAGE)
+    from_users = user.from_user_set.all().order_by('-add_time', '-id')
+    # 先分页, 只取出当前页的关注者
+    from_users_page = related_paginator_helper(request, from_users,
+                                               'from_user',
+                                               per_page=settings.USER_PER_PAGE)
 
     context = {}
     context['user'] = user
@@ -317,7 +281,11 @@ def user_followed_by_user(request, user_id):
     return render(request, 'user/user_followed_user.html', context)
 
 
-@cache_page(60)
+@page_cache.shared_cache_page(
+    key_prefix='user_topic_answer',
+    tags=lambda request, user_id, topic_id: ['user:%s' % user_id,
+                                             'topic:%s' % topic_id],
+    variant=_owner_variant)
 def user_topic_answer(request, user_id, topic_id):
     '''用户在话题下的回答'''
     user = get_object_or_404(User, id=user_id)
@@ -337,17 +305,14 @@ def user_topic_answer(request, user_id, topic_id):
     return render(request, 'user/user_topic_answer.html', context)
 
 
+@never_cache
 @login_required
 def follow_user(request):
     '''关注用户, 取消关注'''
     user_id = int(request.GET.get('user_id', ''))
     user = get_object_or_404(User, id=user_id)
-    user_relationship_existed = request.user.to_user_set.filter(to_user=user)
-    if user_relationship_existed:
-        user_relationship_existed.delete()
+    if toggles.toggle(request.user, 'follow_user', user) < 0:
         return JsonResponse({'status': 'success', 'message': '关注 TA'})
-    user_relationship = UserRelationship(from_user=request.user, to_user=user)
-    user_relationship.save()
     return JsonResponse({'status': 'success', 'message': '取消关注'})
 
 
@@ -356,7 +321,10 @@ def delete_answer(request):
     '''删除回答'''
     answer_id = int(request.GET.get('answer_id', ''))
     answer = get_object_or_404(request.user.answer_set.all(), id=answer_id)
-    answer.delete()
+    with transaction.atomic():
+        counters.answer_deleted(answer)
+        leaderboard.answer_deleted(answer)
+        answer.delete()
     return JsonResponse({'status': 'success'})
 
 
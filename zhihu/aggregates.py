@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+# 发现页推荐问题的排序结果
+# 只缓存排序后的id列表, 使用helper.swr_cache防止过期时并发重新计算,
+# 热门话题, 热门问题排行见zhihu.rankings, 今日/本月点赞排行见zhihu.rollups,
+# 热度排行见zhihu.trending
+# 视图从对象缓存取出当前页的对象
+# 本模块由zhihu.tasks导入, celery worker刷新时可以找到注册的函数
+
+from helper import swr_cache
+from .models import Question
+
+# 发现页缓存时间, 列表中的赞同数, 浏览量只在刷新后更新
+EXPLORE_TIMEOUT = 10 * 60
+
+
+@swr_cache.cached('explore_recommend_question_ids', EXPLORE_TIMEOUT,
+                  tags=['questions', 'answers'])
+def explore_recommend_question_ids():
+    '''热度排行中有回答的问题不足时补充的推荐问题, 按浏览量取前5个, 排除没有回答的问题'''
+    return list(Question.objects.filter(answer_nums__gt=0).order_by(
+        '-read_nums', '-id').values_list('id', flat=True)[:5])
+
@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class ZhihuConfig(AppConfig):
     name = 'zhihu'
+
+    def ready(self):
+        # 注册信号处理函数
+        from . import signals
+        # 注册共享页面缓存中按用户渲染的片段
+        from . import fragments
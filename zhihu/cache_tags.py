@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+# 缓存标签
+# 模型保存/删除时需要失效的缓存标签, 由zhihu.signals调用helper.tag_cache.invalidate
+#   question:<id>  问题详情, 问题的回答列表, 关注问题的用户
+#   answer:<id>    回答详情
+#   topic:<id>     话题下的回答, 问题, 相关问题
+#   user:<id>      用户主页各页面
+#   questions, answers, topics  问题, 回答, 话题列表页
+
+from user.models import User, UserRelationship
+from .models import Question, Answer, Topic, AnswerComment, \
+    UserFollowQuestion, UserFollowAnswer, UserCollectAnswer
+
+
+def _question_topic_tags(question_id):
+    return ['topic:%s' % topic_id for topic_id in
+            Question.topics.through.objects.filter(
+                question_id=question_id).values_list('topic_id', flat=True)]
+
+
+def _question_tags(question):
+    return ['question:%s' % question.id, 'user:%s' % question.author_id,
+            'questions'] + _question_topic_tags(question.id)
+
+
+def _answer_tags(answer):
+    return ['answer:%s' % answer.id, 'question:%s' % answer.question_id,
+            'user:%s' % answer.author_id,
+            'answers'] + _question_topic_tags(answer.question_id)
+
+
+def _answer_relation_tags(obj):
+    '''点赞, 收藏改变回答, 问题回答列表, 话题回答列表中的计数'''
+    answer = Answer.objects.filter(id=obj.answer_id).values(
+        'question_id', 'author_id').first()
+    tags = ['answer:%s' % obj.answer_id, 'user:%s' % obj.user_id]
+    if answer is not None:
+        tags += ['question:%s' % answer['question_id'],
+                 'user:%s' % answer['author_id']]
+        tags += _question_topic_tags(answer['question_id'])
+    return tags
+
+
+# 模型: 获取标签的函数
+MODEL_TAGS = {
+    Question: _question_tags,
+    Answer: _answer_tags,
+    Topic: lambda topic: ['topic:%s' % topic.id, 'topics'],
+    User: lambda user: ['user:%s' % user.id],
+    AnswerComment: lambda comment: ['answer:%s' % comment.answer_id],
+    UserFollowQuestion: lambda obj: ['question:%s' % obj.question_id,
+                                     'user:%s' % obj.user_id],
+    UserFollowAnswer: _answer_relation_tags,
+    UserCollectAnswer: _answer_relation_tags,
+    UserRelationship: lambda obj: ['user:%s' % obj.from_user_id,
+                                   'user:%s' % obj.to_user_id],
+}
+
+
+def tags_for(instance):
+    '''模型对象变化时需要失效的标签, 不需要失效时返回空列表'''
+    func = MODEL_TAGS.get(type(instance))
+    return func(instance) if func else []
+
+
+def m2m_tags(sender, instance, pk_set):
+    '''问题话题, 用户关注话题变化时需要失效的标签'''
+    if sender is Question.topics.through:
+        if isinstance(instance, Question):
+            question_ids, topic_ids = [instance.id], pk_set or []
+        else:
+            question_ids, topic_ids = pk_set or [], [instance.id]
+        return ['question:%s' % question_id for question_id in question_ids] + [
+            'topic:%s' % topic_id for topic_id in topic_ids] + ['topics']
+    if sender is Topic.users.through:
+        if isinstance(instance, Topic):
+            topic_ids, user_ids = [instance.id], pk_set or []
+        else:
+            topic_ids, user_ids = pk_set or [], [instance.id]
+        return ['topic:%s' % topic_id for topic_id in topic_ids] + [
+            'user:%s' % user_id for user_id in user_ids] + ['topics']
+    return []
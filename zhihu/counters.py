@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+# 计数字段维护
+# 点赞, 收藏, 关注, 评论等操作发生时, 使用F表达式在数据库中原子地增减计数,
+# 不需要先读出对象再save, 并发时不会丢失计数;
+# 计数出现偏差时, 运行: python manage.py sync_counters 重新统计
+# 问题浏览量写入频繁, 先在redis中累加, 由celery定时任务批量写入数据库,
+# 同时批量更新zhihu.trending中的浏览加分
+# 计数变化时同时增量更新zhihu.rankings中的排行
+
+import uuid
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F, Case, When, Value, IntegerField
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from helper import object_cache, locks
+from user.models import User
+from . import rankings, trending
+from .models import Question, Answer, Topic, ReadNumsFlush
+
+
+def update_counter(model, pk, **deltas):
+    '''按主键原子增减计数字段, deltas为 字段名=增量'''
+    deltas = {field: F(field) + delta for field, delta in deltas.items() if
+              delta}
+    if not deltas:
+        return 0
+    rows = model.objects.filter(pk=pk).update(**deltas)
+    object_cache.invalidate(model, pk)
+    return rows
+
+
+def answer_followed(answer, delta=1):
+    '''回答被点赞/取消点赞'''
+    update_counter(Answer, answer.id, follow_nums=delta)
+    update_counter(User, answer.author_id, answer_by_followed_nums=delta)
+
+
+def answer_collected(answer, user, delta=1):
+    '''回答被收藏/取消收藏'''
+    update_counter(Answer, answer.id, collect_nums=delta)
+    update_counter(User, user.id, collect_answer_nums=delta)
+    update_counter(User, answer.author_id, answer_by_collected_nums=delta)
+
+
+def answer_commented(answer, delta=1):
+    '''回答被评论'''
+    update_counter(Answer, answer.id, comment_nums=delta)
+
+
+def question_followed(question, user, delta=1):
+    '''问题被关注/取消关注'''
+    update_counter(Question, question.id, follow_nums=delta)
+    update_counter(User, user.id, follow_question_nums=delta)
+    rankings.question_followed(question.id, delta)
+
+
+def topic_followed(topic, user, delta=1):
+    '''话题被关注/取消关注'''
+    update_counter(Topic, topic.id, user_nums=delta)
+    update_counter(User, user.id, topic_nums=delta)
+    rankings.topic_followed(topic.id, delta)
+
+
+def user_followed(from_user, to_user, delta=1):
+    '''用户关注/取消关注用户'''
+    update_counter(User, from_user.id, follow_user_nums=delta)
+    update_counter(User, to_user.id, followed_by_user_nums=delta)
+
+
+def question_created(question, topics):
+    '''新提问, 问题所属话题的问题数+1'''
+    topic_ids = [topic.id for topic in topics]
+    Topic.objects.filter(id__in=topic_ids).update(
+        question_nums=F('question_nums') + 1)
+    object_cache.invalidate(Topic, *topic_ids)
+    rankings.question_created(topic_ids)
+
+
+def answer_created(answer):
+    '''新回答'''
+    update_counter(Question, answer.question_id, answer_nums=1)
+    update_counter(User, answer.author_id, answer_nums=1)
+    rankings.answer_created(answer)
+
+
+def answer_deleted(answer):
+    '''删除回答前调用, 扣除级联删除的点赞, 收藏记录带来的计数'''
+    update_counter(Question, answer.question_id, answer_nums=-1)
+    update_counter(User, answer.author_id, answer_nums=-1,
+                   answer_by_followed_nums=-answer.follow_nums,
+                   answer_by_collected_nums=-answer.collect_nums)
+    collector_ids = list(User.objects.filter(
+        usercollectanswer__answer=answer).values_list('id', flat=True))
+    User.objects.filter(id__in=collector_ids).update(
+        collect_answer_nums=F('collect_answer_nums') - 1)
+    object_cache.invalidate(User, *collector_ids)
+    rankings.answer_created(answer, -1)
+
+
+# redis hash, 问题id: 未写入数据库的浏览量
+READ_NUMS_KEY = 'question_read_nums'
+# 正在写入数据库的浏览量, 写入失败时保留, 下次重试
+READ_NUMS_FLUSHING_KEY = 'question_read_nums_flushing'
+# READ_NUMS_FLUSHING_KEY中保存本批写入id的字段, 写入时在数据库中记录
+READ_NUMS_FLUSH_ID_FIELD = '_flush_id'
+READ_NUMS_LOCK = 'question_read_nums_flush'
+READ_NUMS_LOCK_TIMEOUT = 5 * 60
+# 每条UPDATE语句更新的问题数
+READ_NUMS_BATCH_SIZE = 500
+# 写入记录保留的天数, 只用于判断中断后重试的一批是否已写入
+READ_NUMS_FLUSH_KEEP_DAYS = 1
+
+# 没有正在写入的一批时把累加的浏览量改名为新的一批, 新的浏览量累加到新的hash中;
+# 返回这一批的id, 没有浏览量时返回nil
+START_FLUSH_SCRIPT = '''
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return false
+    end
+    redis.call('RENAME', KEYS[1], KEYS[2])
+end
+redis.call('HSETNX', KEYS[2], ARGV[1], ARGV[2])
+return redis.call('HGET', KEYS[2], ARGV[1])
+'''
+
+
+def incr_read_nums(question_id):
+    '''问题浏览量+1, 返回还未写入数据库的浏览量'''
+    conn = get_redis_connection('default')
+    return conn.hincrby(READ_NUMS_KEY, question_id, 1)
+
+
+def flush_read_nums():
+    '''将redis中累加的浏览量批量写入数据库, 返回更新的问题数
+
+    同一时间只有一个任务写入; 一批浏览量与写入记录(ReadNumsFlush)在同一个事务中
+    写入, 删除redis中的这一批之前中断时, 重试只删除不再累加
+    '''
+    lock = locks.Lock(READ_NUMS_LOCK, READ_NUMS_LOCK_TIMEOUT)
+    if not lock.acquire():
+        return 0
+    try:
+        conn = get_redis_connection('default')
+        start_flush = conn.register_script(START_FLUSH_SCRIPT)
+        flush_id = start_flush(
+            keys=[READ_NUMS_KEY, READ_NUMS_FLUSHING_KEY],
+            args=[READ_NUMS_FLUSH_ID_FIELD, uuid.uuid4().hex])
+        if flush_id is None:
+            # 没有新的浏览量
+            return 0
+        flush_id = flush_id.decode()
+        read_nums = {int(question_id): int(nums) for question_id, nums in
+                     conn.hgetall(READ_NUMS_FLUSHING_KEY).items() if
+                     question_id.decode() != READ_NUMS_FLUSH_ID_FIELD}
+        question_ids = sorted(read_nums)
+        # 在一个事务中写入, 失败时整体回滚, 下次重试不会重复累加
+        with transaction.atomic():
+            if ReadNumsFlush.objects.filter(flush_id=flush_id).exists():
+                # 上次已写入, 删除redis中的这一批前中断
+                question_ids = []
+            for i in range(0, len(question_ids), READ_NUMS_BATCH_SIZE):
+                batch = question_ids[i:i + READ_NUMS_BATCH_SIZE]
+                # 一条UPDATE语句, CASE WHEN为每个问题加上各自的增量
+                increment = Case(
+                    *[When(id=question_id, then=Value(read_nums[question_id]))
+                      for question_id in batch], default=Value(0),
+                    output_field=IntegerField())
+                Question.objects.filter(id__in=batch).update(
+                    read_nums=F('read_nums') + increment)
+            if question_ids:
+                # 唯一约束, 并发写入同一批时只有一个事务提交
+                ReadNumsFlush.objects.create(flush_id=flush_id)
+        conn.delete(READ_NUMS_FLUSHING_KEY)
+        object_cache.invalidate(Question, *question_ids)
+        if question_ids:
+            # 重试时这一批已写入数据库, 不再加分, 避免重复
+            trending.record_reads({question_id: read_nums[question_id] for
+                                   question_id in question_ids})
+        ReadNumsFlush.objects.filter(add_time__lt=timezone.now() - timedelta(
+            days=READ_NUMS_FLUSH_KEEP_DAYS)).delete()
+        return len(question_ids)
+    finally:
+        lock.release()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+# 首页动态
+# 每个用户在redis中有一个有序集合 feed:<用户id>, 保存关注的用户和话题下的新回答id,
+# 分数为回答id, 新回答发布时由celery任务推送到关注者的集合中(写扩散);
+# 关注者很多的用户和话题不推送, 读取时从数据库查询再合并(读扩散)
+# 首页按回答id倒序游标翻页, 每页只读取一页回答
+
+from django.conf import settings
+from django.db.models import Q
+from django_redis import get_redis_connection
+
+from helper import object_cache, concurrency
+from helper.paginator_helper import CursorPage
+from user.models import UserRelationship
+from .models import Answer, Topic, attach_topic_names
+
+
+def _keys(user_id):
+    return 'feed:%s' % user_id, 'feed_built:%s' % user_id
+
+
+def _is_push_author(user):
+    '''关注者不多的用户, 新回答推送给关注者'''
+    return user.followed_by_user_nums <= settings.FEED_FANOUT_LIMIT
+
+
+def _is_push_topic(topic):
+    return topic.user_nums <= settings.FEED_FANOUT_LIMIT
+
+
+def _followed(user, push=True):
+    '''用户关注的用户id和话题id
+
+    push为True时返回关注者不多, 新回答推送的用户和话题;
+    为False时返回关注者很多, 读取时从数据库拉取的用户和话题
+    '''
+    lookup = 'lte' if push else 'gt'
+    author_ids = UserRelationship.objects.filter(from_user=user, **{
+        'to_user__followed_by_user_nums__' + lookup:
+            settings.FEED_FANOUT_LIMIT}).values_list('to_user_id', flat=True)
+    topic_ids = Topic.objects.filter(users=user, **{
+        'user_nums__' + lookup: settings.FEED_FANOUT_LIMIT}).values_list(
+        'id', flat=True)
+    return list(author_ids), list(topic_ids)
+
+
+def _followed_answers(author_ids, topic_ids):
+    '''关注的用户的回答和关注的话题下的回答, 匿名回答只通过话题推送'''
+    return Answer.objects.filter(
+        Q(author_id__in=author_ids, is_anonymous=False) | Q(
+            question__topics__id__in=topic_ids)).order_by('-id').values_list(
+        'id', flat=True).distinct()
+
+
+def rebuild_feed(user_id):
+    '''重新生成用户首页动态, 关注或取消关注用户, 话题后调用'''
+    author_ids, topic_ids = _followed(user_id)
+    answer_ids = _followed_answers(author_ids, topic_ids)[
+                 :settings.FEED_MAX_LENGTH]
+    feed_key, built_key = _keys(user_id)
+    pipe = get_redis_connection('default').pipeline()
+    pipe.delete(feed_key)
+    for answer_id in answer_ids:
+        pipe.zadd(feed_key, answer_id, answer_id)
+    pipe.set(built_key, 1)
+    pipe.execute()
+
+
+def fanout_answer(answer_id):
+    '''新回答推送到回答者和问题话题的关注者的首页动态'''
+    answer = Answer.objects.select_related('author').get(id=answer_id)
+    follower_ids = set()
+    if not answer.is_anonymous and _is_push_author(answer.author):
+        follower_ids.update(
+            UserRelationship.objects.filter(to_user=answer.author).values_list(
+                'from_user_id', flat=True))
+    for topic in answer.question.topics.all():
+        if _is_push_topic(topic):
+            follower_ids.update(topic.users.values_list('id', flat=True))
+    pipe = get_redis_connection('default').pipeline()
+    for follower_id in follower_ids:
+        feed_key = _keys(follower_id)[0]
+        pipe.zadd(feed_key, answer_id, answer_id)
+        # 只保留最新的FEED_MAX_LENGTH条
+        pipe.zremrangebyrank(feed_key, 0, -settings.FEED_MAX_LENGTH - 1)
+    pipe.execute()
+    return len(follower_ids)
+
+
+def _parse_cursor(cursor):
+    try:
+        return int(cursor)
+    except (TypeError, ValueError):
+        return None
+
+
+def has_feed(user):
+    '''用户是否有个性化的首页动态, 没有时首页显示全站最新回答, 可以共享页面缓存'''
+    return user.is_authenticated and bool(
+        user.follow_user_nums or user.topic_nums)
+
+
+def get_feed_page(user, cursor=None, per_page=10):
+    '''获取用户首页动态的一页, cursor为上一页最后一个回答的id
+
+    用户没有关注任何用户和话题时返回None
+    '''
+    if not has_feed(user):
+        return None
+    cursor = _parse_cursor(cursor)
+    conn = get_redis_connection('default')
+    feed_key, built_key = _keys(user.id)
+    if not conn.exists(built_key):
+        rebuild_feed(user.id)
+    # 多取一条判断是否有下一页
+    max_score = '(%d' % cursor if cursor else '+inf'
+
+    def pushed():
+        return [int(answer_id) for answer_id in
+                conn.zrevrangebyscore(feed_key, max_score, '-inf', start=0,
+                                      num=per_page + 1)]
+
+    def pulled():
+        '''关注者很多的用户和话题, 从数据库读取'''
+        author_ids, topic_ids = _followed(user, push=False)
+        if not (author_ids or topic_ids):
+            return []
+        pull_answers = _followed_answers(author_ids, topic_ids)
+        if cursor:
+            pull_answers = pull_answers.filter(id__lt=cursor)
+        return list(pull_answers[:per_page + 1])
+
+    # redis中推送的回答和数据库中拉取的回答同时读取, 合并
+    answer_ids, pull_ids = concurrency.run(pushed, pulled)
+    if pull_ids:
+        answer_ids = sorted(set(answer_ids) | set(pull_ids), reverse=True)
+    return _build_page(answer_ids, cursor, per_page)
+
+
+def get_latest_page(cursor=None, per_page=10):
+    '''全站最新回答的一页, 未登录或没有关注时使用'''
+    cursor = _parse_cursor(cursor)
+    answers = Answer.objects.order_by('-id')
+    if cursor:
+        answers = answers.filter(id__lt=cursor)
+    answer_ids = list(answers.values_list('id', flat=True)[:per_page + 1])
+    return _build_page(answer_ids, cursor, per_page)
+
+
+def _build_page(answer_ids, cursor, per_page):
+    next_cursor = None
+    if len(answer_ids) > per_page:
+        answer_ids = answer_ids[:per_page]
+        next_cursor = str(answer_ids[-1])
+    # 回答, 问题, 作者, 话题名都从对象缓存批量取出
+    object_list = object_cache.hydrate(Answer, answer_ids)
+    object_cache.attach(object_list, 'question', 'author')
+    attach_topic_names([answer.question for answer in object_list])
+    return CursorPage(object_list, next_cursor, cursor)
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+# 当前用户的关注状态
+# 判断当前用户是否关注, 收藏, 赞同了列表中的对象, 每种关系在redis中保存一个集合
+# follow_state:<关系>:<用户id>, 内容为该用户关注的对象id;
+# 集合不存在时用一条查询取出用户的全部关注对象id生成, 之后由关注/取消关注的视图更新,
+# 一页对象的状态只需要一次redis往返
+# 用法: follow_state.annotate(request.user, answers, has_followed='follow_answer')
+
+from django.db import IntegrityError, transaction
+from django_redis import get_redis_connection
+
+from user.models import UserRelationship
+from .models import Topic, UserFollowAnswer, UserCollectAnswer, \
+    UserFollowQuestion
+
+# 关系: (模型, 用户字段, 对象字段)
+RELATIONS = {
+    'follow_answer': (UserFollowAnswer, 'user_id', 'answer_id'),
+    'collect_answer': (UserCollectAnswer, 'user_id', 'answer_id'),
+    'follow_question': (UserFollowQuestion, 'user_id', 'question_id'),
+    'follow_topic': (Topic.users.through, 'user_id', 'topic_id'),
+    'follow_user': (UserRelationship, 'from_user_id', 'to_user_id'),
+}
+
+# 集合过期时间, 过期后重新生成, 修正偏差
+FOLLOW_STATE_TIMEOUT = 24 * 60 * 60
+# 对象id从1开始, 集合中总是保存0, 用户没有关注任何对象时集合也存在
+PLACEHOLDER = 0
+
+
+def _key(relation, user_id):
+    return 'follow_state:%s:%s' % (relation, user_id)
+
+
+def build(relation, user_id):
+    '''一次查询取出用户关注的全部对象id, 写入redis'''
+    model, user_field, object_field = RELATIONS[relation]
+    object_ids = list(model.objects.filter(**{user_field: user_id}).values_list(
+        object_field, flat=True))
+    key = _key(relation, user_id)
+    tmp_key = '%s:tmp' % key
+    # 写入临时key后renamenx, 不覆盖其他请求已生成并修改过的集合
+    pipe = get_redis_connection('default').pipeline()
+    pipe.delete(tmp_key)
+    pipe.sadd(tmp_key, PLACEHOLDER, *object_ids)
+    pipe.expire(tmp_key, FOLLOW_STATE_TIMEOUT)
+    pipe.renamenx(tmp_key, key)
+    pipe.delete(tmp_key)
+    pipe.execute()
+
+
+def ensure_built(relation, user_id):
+    '''集合不存在时生成, 返回集合的key'''
+    key = _key(relation, user_id)
+    if not get_redis_connection('default').exists(key):
+        build(relation, user_id)
+    return key
+
+
+def get_followed_ids(user, relation, object_ids):
+    '''object_ids中被用户关注的对象id集合'''
+    object_ids = list(object_ids)
+    if not object_ids or not user.is_authenticated:
+        return set()
+    key = ensure_built(relation, user.id)
+    pipe = get_redis_connection('default').pipeline()
+    for object_id in object_ids:
+        pipe.sismember(key, object_id)
+    return {object_id for object_id, is_member in
+            zip(object_ids, pipe.execute()) if is_member}
+
+
+def has_followed(user, relation, obj):
+    '''用户是否关注了一个对象'''
+    return obj.id in get_followed_ids(user, relation, [obj.id])
+
+
+def annotate(user, objects, **flags):
+    '''给一页对象添加关注状态属性, flags为 属性名=关系, 返回对象列表
+
+    如 annotate(request.user, answers, has_followed='follow_answer',
+    has_collected='collect_answer'), 每种关系只访问一次redis
+    '''
+    objects = list(objects)
+    object_ids = [obj.id for obj in objects]
+    for attr, relation in flags.items():
+        followed_ids = get_followed_ids(user, relation, object_ids)
+        for obj in objects:
+            setattr(obj, attr, obj.id in followed_ids)
+    return objects
+
+
+def add(user_id, relation, object_id):
+    '''关注后调用, 只更新已生成的集合, 未生成的集合在读取时生成'''
+    conn = get_redis_connection('default')
+    key = _key(relation, user_id)
+    if conn.exists(key):
+        conn.sadd(key, object_id)
+
+
+def remove(user_id, relation, object_id):
+    '''取消关注后调用'''
+    conn = get_redis_connection('default')
+    conn.srem(_key(relation, user_id), object_id)
+
+
+def followed_changed(user_id, relation, object_id, followed=True):
+    '''关注/取消关注的视图中调用, 事务提交后更新集合, 回滚时不更新'''
+    if followed:
+        transaction.on_commit(lambda: add(user_id, relation, object_id))
+    else:
+        transaction.on_commit(lambda: remove(user_id, relation, object_id))
+
+
+def follow(user_id, relation, object_id):
+    '''插入关注记录, 返回插入的记录数
+
+    不先查询是否存在, 重复点击的并发请求由唯一约束保证只插入一条,
+    记录已存在时返回0
+    '''
+    model, user_field, object_field = RELATIONS[relation]
+    try:
+        with transaction.atomic():
+            model.objects.create(**{user_field: user_id,
+                                    object_field: object_id})
+    except IntegrityError:
+        return 0
+    followed_changed(user_id, relation, object_id)
+    return 1
+
+
+def unfollow(user_id, relation, object_id):
+    '''删除关注记录, 返回删除的记录数, 记录不存在时返回0'''
+    model, user_field, object_field = RELATIONS[relation]
+    deleted, rows = model.objects.filter(
+        **{user_field: user_id, object_field: object_id}).delete()
+    deleted = rows.get(model._meta.label, 0)
+    if deleted:
+        followed_changed(user_id, relation, object_id, False)
+    return deleted
+
+
+def toggle(user_id, relation, object_id):
+    '''关注/取消关注: 已关注时删除记录, 否则插入记录
+
+    返回计数字段的变化: 1为关注, -1为取消关注,
+    0为并发请求已插入记录(当前仍为关注状态), 计数不变
+    '''
+    deleted = unfollow(user_id, relation, object_id)
+    if deleted:
+        return -deleted
+    return follow(user_id, relation, object_id)
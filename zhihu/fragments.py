@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+# 共享页面缓存中按当前用户渲染的片段, 见helper.page_cache
+# 模板中使用 {% load myfilter %} {% user_fragment '片段名' 参数=值 %}
+
+from helper.page_cache import register_fragment
+from . import follow_state
+
+
+def _follow_user_context(request, args_list):
+    '''一页中的关注按钮只查询一次关注状态'''
+    followed_ids = follow_state.get_followed_ids(
+        request.user, 'follow_user',
+        {int(args['user_id']) for args in args_list})
+    return [dict(args, has_followed=int(args['user_id']) in followed_ids) for
+            args in args_list]
+
+
+# 导航栏用户菜单
+register_fragment('navbar_user', 'zhihu/fragments/navbar_user.html')
+# 提示消息
+register_fragment('messages', 'zhihu/fragments/messages.html')
+# 表单csrf token
+register_fragment('csrf_token', 'zhihu/fragments/csrf_token.html')
+# 首页右侧用户信息
+register_fragment('index_sidebar', 'zhihu/fragments/index_sidebar.html')
+# 话题广场用户关注的话题
+register_fragment('topic_list_sidebar', 'zhihu/fragments/topic_list_sidebar.html')
+# 关注用户按钮, 参数 user_id, css
+register_fragment('follow_user_button', 'zhihu/fragments/follow_user_button.html',
+                  _follow_user_context)
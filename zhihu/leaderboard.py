@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+# 话题活跃回答者排行
+# 每个话题在redis中保存:
+#   有序集合 topic_answerer_rank:<话题id>       用户id -> 回答数 * SCORE_BASE + 赞同数
+#   标记     topic_answerer_rank_built:<话题id> 排行生成的时间和统计耗时
+# 分数按(回答数, 赞同数)排序, 一次zrevrange取出一页; 回答数为0的用户移出排行
+# 排行不存在时用一条分组聚合查询生成, 之后回答和点赞在事务提交后增量更新
+# 排行过期后继续返回旧排行, 由celery任务重新统计; 排行不存在时只有一个请求统计,
+# 其他请求等待结果, 见helper.swr_cache
+
+import time
+
+from django.db import transaction
+from django.db.models import Count, Sum
+from django_redis import get_redis_connection
+
+from helper import object_cache, swr_cache
+from user.models import User
+from .models import Answer
+
+# 排行过期时间, 过期后重新统计, 修正增量更新的偏差
+LEADERBOARD_TIMEOUT = 24 * 60 * 60
+# 过期后旧排行保留的时间
+LEADERBOARD_STALE_TIMEOUT = 24 * 60 * 60
+# 分数中回答数的倍数, 大于单个用户在话题下的赞同数
+SCORE_BASE = 10 ** 9
+
+
+def _keys(topic_id):
+    return ('topic_answerer_rank:%s' % topic_id,
+            'topic_answerer_rank_built:%s' % topic_id)
+
+
+def _score(answer_nums, follow_nums):
+    return answer_nums * SCORE_BASE + follow_nums
+
+
+def _split(score):
+    '''分数还原为(回答数, 赞同数)'''
+    answer_nums = int(round(score / SCORE_BASE))
+    return answer_nums, int(score - answer_nums * SCORE_BASE)
+
+
+def build(topic_id):
+    '''分组聚合统计话题下每个用户的回答数和赞同数, 写入redis'''
+    rank_key, built_key = _keys(topic_id)
+    start = time.time()
+    rows = list(Answer.objects.filter(question__topics__id=topic_id).order_by()
+                .values('author').annotate(answer_nums=Count('id'),
+                                           follow_nums=Sum('follow_nums')))
+    now = time.time()
+    pipe = get_redis_connection('default').pipeline()
+    pipe.delete(rank_key)
+    for row in rows:
+        pipe.zadd(rank_key, _score(row['answer_nums'], row['follow_nums'] or 0),
+                  row['author'])
+    pipe.set(built_key, '%f,%f' % (now, now - start))
+    for key in (rank_key, built_key):
+        pipe.expire(key, LEADERBOARD_TIMEOUT + LEADERBOARD_STALE_TIMEOUT)
+    pipe.execute()
+
+
+def rebuild(topic_id):
+    '''重新统计排行并释放锁, 由celery任务调用'''
+    try:
+        build(topic_id)
+    finally:
+        swr_cache.release_lock(_keys(topic_id)[1])
+
+
+def _ensure_built(conn, topic_id):
+    '''排行不存在时统计; 已过期或临近过期时返回旧排行, 在后台重新统计'''
+    built_key = _keys(topic_id)[1]
+    built = conn.get(built_key)
+    if built is None:
+        if swr_cache.acquire_lock(built_key):
+            rebuild(topic_id)
+        elif swr_cache.wait_for(lambda: conn.get(built_key)) is None:
+            build(topic_id)
+        return
+    try:
+        built_time, delta = (float(value) for value in
+                             built.decode().split(','))
+    except ValueError:
+        # 旧格式的标记, 立即重新统计
+        built_time, delta = 0, 0
+    if swr_cache.should_refresh(built_time + LEADERBOARD_TIMEOUT, delta) and \
+            swr_cache.acquire_lock(built_key):
+        from .tasks import rebuild_leaderboard
+        try:
+            rebuild_leaderboard.delay(topic_id)
+        except Exception:
+            # celery不可用时在当前请求中统计
+            rebuild(topic_id)
+
+
+def _update(topic_ids, user_id, answer_delta=0, follow_delta=0):
+    '''增量更新, 只更新已生成的排行, 未生成的排行在读取时统计'''
+    conn = get_redis_connection('default')
+    delta = _score(answer_delta, follow_delta)
+    for topic_id in topic_ids:
+        rank_key, built_key = _keys(topic_id)
+        if not conn.exists(built_key):
+            continue
+        pipe = conn.pipeline()
+        pipe.zincrby(rank_key, user_id, delta)
+        # 回答数减到0的用户移出排行
+        pipe.zremrangebyscore(rank_key, '-inf', '(%d' % (SCORE_BASE // 2))
+        # 排行在exists之后过期时zincrby新建的key也会过期
+        pipe.expire(rank_key, LEADERBOARD_TIMEOUT + LEADERBOARD_STALE_TIMEOUT)
+        pipe.execute()
+
+
+def _update_on_commit(answer, answer_delta=0, follow_delta=0):
+    '''事务提交后增量更新, 回滚时不修改排行; 话题在调用时读取'''
+    topic_ids = list(answer.question.topics.values_list('id', flat=True))
+    user_id = answer.author_id
+    transaction.on_commit(lambda: _update(topic_ids, user_id, answer_delta,
+                                          follow_delta))
+
+
+def answer_created(answer):
+    '''新回答, 回答者在问题所属话题下的回答数+1'''
+    _update_on_commit(answer, answer_delta=1)
+
+
+def answer_deleted(answer):
+    '''删除回答前调用'''
+    _update_on_commit(answer, answer_delta=-1,
+                      follow_delta=-answer.follow_nums)
+
+
+def answer_followed(answer, delta=1):
+    '''回答被点赞/取消点赞'''
+    _update_on_commit(answer, follow_delta=delta)
+
+
+class TopicAnswerers(object):
+    '''话题活跃回答者列表, 按回答数排序, 回答数相同时按赞同数排序
+
+    支持len()和切片, 可以直接传给paginator_helper分页,
+    切片时只从redis取当前页的用户id, 再一次查询出用户对象
+    用户对象绑定user_answer_nums(回答数)和user_answer_follow_nums(赞同数)属性
+    '''
+
+    def __init__(self, topic):
+        self.topic_id = topic.id
+        self.conn = get_redis_connection('default')
+        _ensure_built(self.conn, self.topic_id)
+
+    def count(self):
+        return self.conn.zcard(_keys(self.topic_id)[0])
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        start = index.start or 0
+        stop = index.stop if index.stop is not None else self.count()
+        if stop <= start:
+            return []
+        ranks = self.conn.zrevrange(_keys(self.topic_id)[0], start, stop - 1,
+                                    withscores=True)
+        users = object_cache.get_many(User, [int(user_id) for user_id, score
+                                             in ranks])
+        users_list = []
+        for user_id, score in ranks:
+            user = users.get(int(user_id))
+            if user is None:
+                continue
+            user.user_answer_nums, user.user_answer_follow_nums = _split(
+                score)
+            users_list.append(user)
+        return users_list
+
+
+def user_answer_nums(topic, user_ids):
+    '''用户在话题下的回答数, 返回{用户id: 回答数}'''
+    conn = get_redis_connection('default')
+    _ensure_built(conn, topic.id)
+    pipe = conn.pipeline()
+    for user_id in user_ids:
+        pipe.zscore(_keys(topic.id)[0], user_id)
+    return {user_id: _split(score or 0)[0] for user_id, score in
+            zip(user_ids, pipe.execute())}
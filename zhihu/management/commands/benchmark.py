@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+# 视图压测
+# 用django测试客户端依次请求zhihuer/urls.py中的每个url, 统计每个视图的
+# 延迟分位数, SQL查询数和响应字节数; 数据库为当前settings中的数据库(SQLite或MySQL),
+# 先用 python manage.py generate_data 生成模拟数据
+# 运行:
+#   python manage.py benchmark --runs 50 --save benchmarks/mysql.json
+#   python manage.py benchmark --compare benchmarks/mysql.json
+# --compare时与保存的基线比较, p50延迟超过基线(1 + threshold)倍或查询数增加时报错
+
+import json
+import os
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Max
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment
+from django.urls import URLPattern, URLResolver, get_resolver, reverse
+
+from user.models import User
+from zhihu.models import Question, Answer, Topic
+
+# 不压测的url: 会删除数据, 退出登录, 只接受POST, 需要邮件中的token, 性能统计
+SKIP = {'user_logout', 'delete_answer', 'comment_answer', 'user_confirm',
+        'change_email', 'update_image', 'get_check_code',
+        'resend_confirm_email', 'metrics'}
+# url中不属于本站视图的命名空间和前缀
+SKIP_PREFIXES = ('admin/', 'captcha/', '^ckeditor/', 'media/', '^media/')
+
+# 切换类的视图成对请求, 数据不会累积变化
+TOGGLE_PARAMS = {
+    'add_follow_answer': 'answer_id',
+    'cancel_follow_answer': 'answer_id',
+    'collect_answer': 'answer_id',
+    'follow_question': 'question_id',
+    'follow_user': 'user_id',
+}
+
+
+def percentile(values, p):
+    '''values已排序, 最近秩法'''
+    if not values:
+        return 0
+    index = max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))
+    return values[index]
+
+
+def iter_patterns(patterns, prefix=''):
+    '''(url名, 路由字符串, 参数名列表), 只包括有名字的本站url'''
+    for pattern in patterns:
+        route = prefix + str(pattern.pattern)
+        if route.startswith(SKIP_PREFIXES):
+            continue
+        if isinstance(pattern, URLResolver):
+            yield from iter_patterns(pattern.url_patterns, route)
+        elif isinstance(pattern, URLPattern) and pattern.name:
+            yield pattern.name, route, list(
+                pattern.pattern.regex.groupindex)
+
+
+class Command(BaseCommand):
+    help = '压测每个url, 统计延迟分位数, 查询数和响应字节数'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=20,
+                            help='每个url的请求次数')
+        parser.add_argument('--warmup', type=int, default=2,
+                            help='统计前的预热请求次数, 填充缓存')
+        parser.add_argument('--anonymous', action='store_true',
+                            help='不登录, 以匿名用户请求')
+        parser.add_argument('--user', help='登录的用户名, 默认为回答最多的用户')
+        parser.add_argument('--only', nargs='*', help='只压测这些url名')
+        parser.add_argument('--save', help='结果保存为json基线')
+        parser.add_argument('--compare', help='与json基线比较')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='p50延迟允许超过基线的比例')
+
+    def handle(self, *args, **options):
+        # 测试环境: 允许testserver主机, 邮件不真正发送
+        setup_test_environment()
+        self.client = Client()
+        self.user = self.login(options)
+        self.ids = self.sample_ids()
+
+        results = {}
+        for name, route, params in iter_patterns(get_resolver().url_patterns):
+            if name in SKIP or (options['only'] and
+                                name not in options['only']):
+                continue
+            try:
+                url = reverse(name, kwargs={
+                    param: self.ids[param] for param in params})
+            except KeyError:
+                self.stderr.write('%s: 跳过, 未知参数 %s' % (name, params))
+                continue
+            results[name] = self.run(name, url, options['runs'],
+                                     options['warmup'])
+            self.report(name, results[name])
+
+        report = {
+            'meta': {
+                'time': datetime.now().isoformat(),
+                'database': connection.vendor,
+                'runs': options['runs'],
+                'anonymous': self.user is None,
+                'rows': {model._meta.model_name: model.objects.count() for
+                         model in (User, Topic, Question, Answer)},
+            },
+            'views': results,
+        }
+        if options['save']:
+            directory = os.path.dirname(options['save'])
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(options['save'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+            self.stdout.write('已保存到 %s' % options['save'])
+        if options['compare']:
+            self.compare(options['compare'], results, options['threshold'])
+
+    def login(self, options):
+        if options['anonymous']:
+            return None
+        if options['user']:
+            user = User.objects.filter(username=options['user']).first()
+        else:
+            user = User.objects.order_by('-answer_nums').first()
+        if user is None:
+            raise CommandError('没有用户, 先运行 python manage.py generate_data')
+        self.client.force_login(user)
+        return user
+
+    def sample_ids(self):
+        '''url参数: 取互动最多的对象, 缓存和查询的压力最大'''
+        answer = Answer.objects.order_by('-follow_nums').first()
+        question = Question.objects.order_by('-answer_nums').first()
+        topic = Topic.objects.order_by('-question_nums').first()
+        if not (answer and question and topic):
+            raise CommandError('没有数据, 先运行 python manage.py generate_data')
+        most_followed = User.objects.aggregate(
+            nums=Max('followed_by_user_nums'))['nums']
+        user = User.objects.filter(followed_by_user_nums=most_followed).first()
+        return {
+            'answer_id': answer.id,
+            'question_id': question.id,
+            'topic_id': topic.id,
+            # 登录用户自己的主页显示编辑入口, 与访问其他用户的主页不同, 用其他用户
+            'user_id': user.id,
+        }
+
+    def request(self, name, url):
+        if name == 'search':
+            return self.client.get(url, {'search_type': 'question',
+                                         'keywords': 'python'})
+        if name in TOGGLE_PARAMS:
+            param = TOGGLE_PARAMS[name]
+            return self.client.get(url, {param: self.ids[param]})
+        return self.client.get(url)
+
+    def run(self, name, url, runs, warmup):
+        for _ in range(warmup):
+            self.request(name, url)
+        latencies = []
+        queries = []
+        size = 0
+        status = None
+        for _ in range(runs):
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                response = self.request(name, url)
+                latencies.append((time.perf_counter() - start) * 1000)
+            queries.append(len(context.captured_queries))
+            status = response.status_code
+            size = len(response.content)
+        latencies.sort()
+        return {
+            'url': url,
+            'status': status,
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p90_ms': round(percentile(latencies, 90), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'max_ms': round(latencies[-1], 3) if latencies else 0,
+            'queries': max(queries) if queries else 0,
+            'bytes': size,
+        }
+
+    def report(self, name, result):
+        self.stdout.write(
+            '%-24s %3s  p50 %8.2fms  p90 %8.2fms  p99 %8.2fms  '
+            '%3d queries  %8d bytes' % (
+                name, result['status'], result['p50_ms'], result['p90_ms'],
+                result['p99_ms'], result['queries'], result['bytes']))
+
+    def compare(self, path, results, threshold):
+        with open(path) as f:
+            baseline = json.load(f)['views']
+        regressions = []
+        for name, result in sorted(results.items()):
+            base = baseline.get(name)
+            if base is None:
+                continue
+            slower = result['p50_ms'] > base['p50_ms'] * (1 + threshold)
+            more_queries = result['queries'] > base['queries']
+            self.stdout.write('%-24s p50 %8.2fms -> %8.2fms  queries %3d -> %3d%s' % (
+                name, base['p50_ms'], result['p50_ms'], base['queries'],
+                result['queries'], '  !' if slower or more_queries else ''))
+            if slower or more_queries:
+                regressions.append(name)
+        if regressions:
+            raise CommandError('性能回退: %s' % ', '.join(regressions))
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+# 输出关注, 点赞, 收藏记录常用查询的执行计划和平均耗时
+# 运行: python manage.py explain_interactions [--runs 100]
+# 迁移前后各运行一次(python manage.py migrate zhihu 0014, migrate user 0009),
+# 对比是否使用了(用户, 对象)唯一索引和(对象, add_time)索引
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from user.models import User, UserRelationship
+from zhihu.models import Question, Answer, UserFollowQuestion, \
+    UserFollowAnswer, UserCollectAnswer
+
+
+def _queries(user_id, question_id, answer_id):
+    '''查询名: queryset, 与视图中的查询相同'''
+    return [
+        ('toggle follow_answer', UserFollowAnswer.objects.filter(
+            user_id=user_id, answer_id=answer_id)),
+        ('toggle collect_answer', UserCollectAnswer.objects.filter(
+            user_id=user_id, answer_id=answer_id)),
+        ('toggle follow_question', UserFollowQuestion.objects.filter(
+            user_id=user_id, question_id=question_id)),
+        ('toggle follow_user', UserRelationship.objects.filter(
+            from_user_id=user_id, to_user_id=user_id)),
+        ('follow_question_user', UserFollowQuestion.objects.filter(
+            question_id=question_id).order_by('-add_time')[:20]),
+        ('user_follow_question', UserFollowQuestion.objects.filter(
+            user_id=user_id).order_by('-add_time', '-id')[:20]),
+        ('user_collect_answer', UserCollectAnswer.objects.filter(
+            user_id=user_id).order_by('-add_time', '-id')[:20]),
+        ('user_follow_user', UserRelationship.objects.filter(
+            from_user_id=user_id).order_by('-add_time', '-id')[:20]),
+        ('user_followed_by_user', UserRelationship.objects.filter(
+            to_user_id=user_id).order_by('-add_time', '-id')[:20]),
+    ]
+
+
+def explain(queryset):
+    '''数据库的执行计划, 每行一个字符串'''
+    sql, params = queryset.query.sql_with_params()
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else \
+        'EXPLAIN '
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        return [' | '.join(str(column) for column in row) for row in
+                cursor.fetchall()]
+
+
+class Command(BaseCommand):
+    help = '输出关注, 点赞, 收藏记录常用查询的执行计划和平均耗时'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=100,
+                            help='每个查询的执行次数')
+
+    def handle(self, *args, **options):
+        # 取数据最多的对象, 没有数据时用id 1
+        user_id = User.objects.order_by('-follow_question_nums').values_list(
+            'id', flat=True).first() or 1
+        question_id = Question.objects.order_by('-follow_nums').values_list(
+            'id', flat=True).first() or 1
+        answer_id = Answer.objects.order_by('-follow_nums').values_list(
+            'id', flat=True).first() or 1
+        for name, queryset in _queries(user_id, question_id, answer_id):
+            start = time.time()
+            for _ in range(options['runs']):
+                list(queryset.all())
+            elapsed = (time.time() - start) / options['runs'] * 1000
+            self.stdout.write('%s: %.3f ms' % (name, elapsed))
+            for line in explain(queryset):
+                self.stdout.write('    %s' % line)
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+# 生成压测用的模拟数据
+# 运行: python manage.py generate_data --users 100000 --answers 1000000 \
+#           --upvotes 10000000
+# 用户的活跃度, 问题和回答的热度, 用户的关注者数都服从幂律分布(少数对象占大部分互动),
+# 边生成边用bulk_create分批插入, 不在内存中保存全部记录;
+# 发布时间分布在最近--days天内, 回答在问题发布之后, 点赞, 收藏, 评论在回答发布之后,
+# 关注问题在问题发布之后;
+# 插入后重新统计计数字段, 用户动态和redis中的排行, 与线上数据的读取路径一致
+
+import bisect
+import random
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from helper import object_cache
+from user.models import User, UserRelationship
+from zhihu import rankings, rollups, trending, related, search_index
+from zhihu.models import Topic, Question, Answer, AnswerComment, \
+    UserFollowQuestion, UserFollowAnswer, UserCollectAnswer
+
+# 标题, 内容使用的词, 分词后有足够的重复, 搜索和相关问题有结果
+WORDS = ['python', 'django', '编程', '程序员', '数据库', '前端', '算法', '机器学习',
+         '大学', '考研', '工作', '面试', '职场', '创业', '投资', '理财', '房价',
+         '电影', '音乐', '小说', '游戏', '旅行', '美食', '健身', '减肥', '心理',
+         '历史', '哲学', '经济', '法律', '医学', '手机', '电脑', '汽车', '摄影',
+         '设计', '宠物', '教育', '恋爱', '生活', '城市', '科技', '互联网', '产品']
+TITLE_TEMPLATES = ['如何看待%s和%s?', '%s对%s有什么影响?', '怎样学好%s和%s?',
+                   '为什么%s比%s更难?', '%s行业的%s前景如何?', '有哪些关于%s的%s推荐?']
+
+# 模型: 插入时需要手动指定的时间字段
+TIME_FIELDS = {
+    Question: 'pub_time',
+    Answer: 'pub_time',
+    UserFollowAnswer: 'add_time',
+    UserCollectAnswer: 'add_time',
+    UserFollowQuestion: 'add_time',
+    UserRelationship: 'add_time',
+    AnswerComment: 'add_time',
+}
+
+
+@contextmanager
+def explicit_times():
+    '''临时关闭auto_now_add, bulk_create时使用生成的时间'''
+    fields = [model._meta.get_field(name) for model, name in
+              TIME_FIELDS.items()]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+class PowerLaw(object):
+    '''按幂律分布抽取0 ~ size-1, 排名i的权重为 1 / (i + 1) ^ alpha'''
+
+    def __init__(self, size, alpha=1.0, rng=random):
+        self.size = size
+        self.rng = rng
+        self.cum_weights = list(accumulate(
+            1 / (rank + 1) ** alpha for rank in range(size)))
+
+    def sample(self):
+        return bisect.bisect(self.cum_weights,
+                             self.rng.random() * self.cum_weights[-1])
+
+    def distinct(self, num):
+        '''抽取num个不重复的值'''
+        num = min(num, self.size)
+        # 接近全部时按幂律抽取很慢, 均匀抽取
+        if num * 2 > self.size:
+            return set(self.rng.sample(range(self.size), num))
+        values = set()
+        while len(values) < num:
+            values.add(self.sample())
+        return values
+
+
+def spread(total, size, alpha, rng):
+    '''把total个互动按幂律分配给size个对象(如用户的点赞数), 返回每个对象的数量'''
+    nums = [0] * size
+    law = PowerLaw(size, alpha, rng)
+    for _ in range(total):
+        nums[law.sample()] += 1
+    return nums
+
+
+class Command(BaseCommand):
+    help = '生成压测用的模拟数据: 用户, 话题, 问题, 回答, 点赞, 收藏, 关注'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--topics', type=int, default=50)
+        parser.add_argument('--questions', type=int, default=5000)
+        parser.add_argument('--answers', type=int, default=20000)
+        parser.add_argument('--upvotes', type=int, default=100000)
+        parser.add_argument('--collects', type=int, default=10000)
+        parser.add_argument('--comments', type=int, default=10000)
+        parser.add_argument('--question-follows', type=int, default=10000)
+        parser.add_argument('--user-follows', type=int, default=20000)
+        parser.add_argument('--topic-follows', type=int, default=5000)
+        parser.add_argument('--days', type=int, default=30,
+                            help='发布时间, 点赞时间分布的天数')
+        parser.add_argument('--alpha', type=float, default=1.0,
+                            help='幂律分布的指数, 越大越集中')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='每次批量插入的记录数')
+        parser.add_argument('--index', action='store_true',
+                            help='同时重建搜索索引和相关问题索引')
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        self.alpha = options['alpha']
+        self.now = datetime.now()
+        self.days = options['days']
+
+        with explicit_times():
+            user_ids = self.create_users(options['users'])
+            topic_ids = self.create_topics(options['topics'])
+            question_ids, question_times = self.create_questions(
+                options['questions'], user_ids, topic_ids)
+            answer_ids, answer_times = self.create_answers(
+                options['answers'], user_ids, question_ids, question_times)
+            self.create_interactions(UserFollowAnswer, 'answer_id',
+                                     options['upvotes'], user_ids, answer_ids,
+                                     answer_times)
+            self.create_interactions(UserCollectAnswer, 'answer_id',
+                                     options['collects'], user_ids, answer_ids,
+                                     answer_times)
+            self.create_interactions(UserFollowQuestion, 'question_id',
+                                     options['question_follows'], user_ids,
+                                     question_ids, question_times)
+            self.create_follow_graph(options['user_follows'], user_ids)
+            self.create_topic_follows(options['topic_follows'], user_ids,
+                                      topic_ids)
+            self.create_comments(options['comments'], user_ids, answer_ids,
+                                 answer_times)
+
+        # 计数字段, 用户动态, redis中的排行按新数据重新生成
+        call_command('sync_counters', stdout=self.stdout)
+        call_command('rebuild_user_activity', stdout=self.stdout)
+        rollups.build()
+        trending.build()
+        rankings.refresh_all()
+        if options['index']:
+            for doc_type in sorted(search_index.DOC_TYPES):
+                search_index.rebuild(doc_type)
+            related.build()
+        for model in (User, Topic, Question, Answer):
+            object_cache.invalidate_model(model)
+
+    def random_time(self, after=None):
+        '''after(默认为days天前)到现在之间的时间, 越近越多'''
+        if after is None:
+            after = self.now - timedelta(days=self.days)
+        return self.now - (self.now - after) * self.rng.random() ** 2
+
+    def title(self):
+        return self.rng.choice(TITLE_TEMPLATES) % (
+            self.rng.choice(WORDS), self.rng.choice(WORDS))
+
+    def text(self, words):
+        return ''.join(self.rng.choice(WORDS) + self.rng.choice('，。 ')
+                       for _ in range(words))
+
+    def insert(self, model, objs):
+        '''objs可以是生成器, 每生成batch_size条插入一次, 返回插入的记录数'''
+        nums = 0
+        batch = []
+        for obj in objs:
+            batch.append(obj)
+            if len(batch) >= self.batch_size:
+                model.objects.bulk_create(batch)
+                nums += len(batch)
+                batch = []
+        model.objects.bulk_create(batch)
+        nums += len(batch)
+        self.stdout.write('%s: %d created' % (model._meta.model_name, nums))
+        return nums
+
+    def bulk_create(self, model, objs):
+        '''分批插入, 返回新记录的id列表(按插入顺序)'''
+        start_id = (model.objects.order_by('-id').values_list(
+            'id', flat=True).first() or 0)
+        self.insert(model, objs)
+        return list(model.objects.filter(id__gt=start_id).order_by(
+            'id').values_list('id', flat=True))
+
+    def create_users(self, num):
+        # 所有用户使用同一个密码, 只计算一次哈希
+        password = make_password('password')
+        prefix = 'bench%d_' % self.rng.randrange(10 ** 6)
+        return self.bulk_create(User, (
+            User(username='%s%d' % (prefix, i), nickname='用户%d' % i,
+                 email='%s%d@example.com' % (prefix, i), password=password,
+                 confirmed=True) for i in range(num)))
+
+    def create_topics(self, num):
+        return self.bulk_create(Topic, (
+            Topic(name='%s%d' % (self.rng.choice(WORDS), i),
+                  description=self.text(10)) for i in range(num)))
+
+    def create_questions(self, num, user_ids, topic_ids):
+        '''返回问题id列表和对应的发布时间列表'''
+        authors = PowerLaw(len(user_ids), self.alpha, self.rng)
+        pub_times = []
+
+        def questions():
+            for _ in range(num):
+                pub_times.append(self.random_time())
+                yield Question(title=self.title(), content=self.text(30),
+                               author_id=user_ids[authors.sample()],
+                               pub_time=pub_times[-1],
+                               read_nums=int(self.rng.paretovariate(1.2) * 10))
+
+        question_ids = self.bulk_create(Question, questions())
+        # 每个问题1到3个话题, 热门话题的问题多
+        topics = PowerLaw(len(topic_ids), self.alpha, self.rng)
+        through = Question.topics.through
+        self.insert(through, (
+            through(question_id=question_id, topic_id=topic_ids[index])
+            for question_id in question_ids for index in
+            topics.distinct(self.rng.randint(1, 3))))
+        return question_ids, pub_times
+
+    def create_answers(self, num, user_ids, question_ids, question_times):
+        '''回答在问题发布之后, 返回回答id列表和对应的发布时间列表'''
+        authors = PowerLaw(len(user_ids), self.alpha, self.rng)
+        questions = PowerLaw(len(question_ids), self.alpha, self.rng)
+        pub_times = []
+
+        def answers():
+            for _ in range(num):
+                index = questions.sample()
+                pub_times.append(self.random_time(question_times[index]))
+                yield Answer(question_id=question_ids[index],
+                             author_id=user_ids[authors.sample()],
+                             content='<p>%s</p>' % self.text(80),
+                             pub_time=pub_times[-1])
+
+        return self.bulk_create(Answer, answers()), pub_times
+
+    def _user_pairs(self, total, user_ids, target_ids):
+        '''按幂律分配每个用户的互动数, 每个用户的目标不重复,
+        生成(用户id, 目标在target_ids中的下标)'''
+        targets = PowerLaw(len(target_ids), self.alpha, self.rng)
+        nums = spread(total, len(user_ids), self.alpha, self.rng)
+        for user_id, num in zip(user_ids, nums):
+            for index in targets.distinct(num):
+                yield user_id, index
+
+    def create_interactions(self, model, target_field, total, user_ids,
+                            target_ids, target_times):
+        '''点赞, 收藏, 关注问题, 时间在目标发布之后'''
+        self.insert(model, (
+            model(**{'user_id': user_id, target_field: target_ids[index],
+                     'add_time': self.random_time(target_times[index])})
+            for user_id, index in self._user_pairs(total, user_ids,
+                                                   target_ids)))
+
+    def create_follow_graph(self, total, user_ids):
+        '''用户关注关系, 被关注者服从幂律分布, 不关注自己'''
+        self.insert(UserRelationship, (
+            UserRelationship(from_user_id=from_user_id,
+                             to_user_id=user_ids[index],
+                             add_time=self.random_time())
+            for from_user_id, index in self._user_pairs(total, user_ids,
+                                                        user_ids)
+            if from_user_id != user_ids[index]))
+
+    def create_topic_follows(self, total, user_ids, topic_ids):
+        through = Topic.users.through
+        self.insert(through, (
+            through(user_id=user_id, topic_id=topic_ids[index])
+            for user_id, index in self._user_pairs(total, user_ids,
+                                                   topic_ids)))
+
+    def create_comments(self, total, user_ids, answer_ids, answer_times):
+        '''评论时间在回答发布之后'''
+        users = PowerLaw(len(user_ids), self.alpha, self.rng)
+        answers = PowerLaw(len(answer_ids), self.alpha, self.rng)
+
+        def comments():
+            for _ in range(total):
+                index = answers.sample()
+                yield AnswerComment(
+                    user_id=user_ids[users.sample()],
+                    answer_id=answer_ids[index], comment=self.text(8)[:300],
+                    add_time=self.random_time(answer_times[index]))
+
+        self.insert(AnswerComment, comments())
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+
+# 全量统计相关问题索引
+# 运行: python manage.py rebuild_related
+
+from django.core.management.base import BaseCommand
+
+from zhihu import related
+
+
+class Command(BaseCommand):
+    help = '按标题相似度和共同话题重新统计全部问题的相关问题'
+
+    def handle(self, *args, **options):
+        nums = related.build()
+        self.stdout.write('%d questions indexed' % nums)
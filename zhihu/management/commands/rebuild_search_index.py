@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+# 重建站内搜索索引
+# 运行: python manage.py rebuild_search_index [question answer topic user]
+
+from django.core.management.base import BaseCommand, CommandError
+
+from zhihu import search_index
+
+
+class Command(BaseCommand):
+    help = '重建问题, 回答, 话题, 用户的搜索索引'
+
+    def add_arguments(self, parser):
+        parser.add_argument('doc_types', nargs='*',
+                            help='要重建的索引类型: question, answer, topic, '
+                                 'user, 默认全部重建')
+
+    def handle(self, *args, **options):
+        doc_types = options['doc_types'] or sorted(search_index.DOC_TYPES)
+        for doc_type in doc_types:
+            if doc_type not in search_index.DOC_TYPES:
+                raise CommandError('未知的索引类型: %s' % doc_type)
+        for doc_type in doc_types:
+            nums = search_index.rebuild(doc_type)
+            self.stdout.write('%s: %d indexed' % (doc_type, nums))
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+# 重新统计计数字段, 修正计数偏差
+# 运行: python manage.py sync_counters
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from helper import object_cache
+from user.models import User, UserRelationship
+from zhihu import rankings
+from zhihu.models import Question, Answer, Topic, AnswerComment, \
+    UserFollowQuestion, UserFollowAnswer, UserCollectAnswer
+
+
+def count_subquery(queryset, field):
+    '''按field分组计数的关联子查询, 没有记录时为0'''
+    queryset = queryset.filter(**{field: OuterRef('pk')}).order_by().values(
+        field).annotate(nums=Count('pk')).values('nums')
+    return Coalesce(Subquery(queryset, output_field=IntegerField()), 0)
+
+
+# 模型: {计数字段: (计数的记录queryset, 指向该模型的字段)}
+COUNTERS = (
+    (Answer, {
+        'follow_nums': (UserFollowAnswer.objects.all(), 'answer'),
+        'collect_nums': (UserCollectAnswer.objects.all(), 'answer'),
+        'comment_nums': (AnswerComment.objects.all(), 'answer'),
+    }),
+    (Question, {
+        'answer_nums': (Answer.objects.all(), 'question'),
+        'follow_nums': (UserFollowQuestion.objects.all(), 'question'),
+    }),
+    (Topic, {
+        'user_nums': (Topic.users.through.objects.all(), 'topic'),
+        'question_nums': (Question.topics.through.objects.all(), 'topic'),
+    }),
+    (User, {
+        'answer_nums': (Answer.objects.all(), 'author'),
+        'topic_nums': (Topic.users.through.objects.all(), 'user'),
+        'collect_answer_nums': (UserCollectAnswer.objects.all(), 'user'),
+        'follow_question_nums': (UserFollowQuestion.objects.all(), 'user'),
+        'answer_by_followed_nums': (UserFollowAnswer.objects.all(),
+                                    'answer__author'),
+        'answer_by_collected_nums': (UserCollectAnswer.objects.all(),
+                                     'answer__author'),
+        'follow_user_nums': (UserRelationship.objects.all(), 'from_user'),
+        'followed_by_user_nums': (UserRelationship.objects.all(), 'to_user'),
+    }),
+)
+
+
+class Command(BaseCommand):
+    help = '重新统计回答, 问题, 话题, 用户的计数字段'
+
+    def handle(self, *args, **options):
+        for model, fields in COUNTERS:
+            # 每个模型一条批量UPDATE语句
+            with transaction.atomic():
+                rows = model.objects.update(**{
+                    name: count_subquery(queryset, field) for
+                    name, (queryset, field) in fields.items()})
+            object_cache.invalidate_model(model)
+            self.stdout.write(
+                '%s: %d rows synced' % (model._meta.model_name, rows))
+        # 计数字段修正后重新统计排行
+        rankings.refresh_all()
@@ -0,0 +1,48 @@
+# Generated by Django 2.0.3 on 2026-10-18 16:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zhihu', '0013_topic_image'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='answer',
+            name='collect_nums',
+            field=models.IntegerField(default=0, verbose_name='收藏数'),
+        ),
+        migrations.AddField(
+            model_name='answer',
+            name='comment_nums',
+            field=models.IntegerField(default=0, verbose_name='评论数'),
+        ),
+        migrations.AddField(
+            model_name='answer',
+            name='follow_nums',
+            field=models.IntegerField(default=0, verbose_name='点赞数'),
+        ),
+        migrations.AddField(
+            model_name='question',
+            name='answer_nums',
+            field=models.IntegerField(default=0, verbose_name='回答数'),
+        ),
+        migrations.AddField(
+            model_name='question',
+            name='follow_nums',
+            field=models.IntegerField(default=0, verbose_name='关注者数'),
+        ),
+        migrations.AddField(
+            model_name='topic',
+            name='question_nums',
+            field=models.IntegerField(default=0, verbose_name='问题数'),
+        ),
+        migrations.AddField(
+            model_name='topic',
+            name='user_nums',
+            field=models.IntegerField(default=0, verbose_name='关注者数'),
+        ),
+    ]
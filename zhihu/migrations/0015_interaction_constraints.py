@@ -0,0 +1,63 @@
+# Generated by Django 2.0.3 on 2026-10-18 17:15
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicates(apps, schema_editor):
+    '''添加唯一约束前删除重复点击插入的记录, 每组保留最早的一条
+    删除后运行 python manage.py sync_counters 修正计数字段'''
+    for model_name, target in (('UserFollowQuestion', 'question'),
+                               ('UserFollowAnswer', 'answer'),
+                               ('UserCollectAnswer', 'answer')):
+        model = apps.get_model('zhihu', model_name)
+        duplicates = model.objects.values('user', target).annotate(
+            first_id=Min('id'), nums=Count('id')).filter(nums__gt=1)
+        for row in duplicates:
+            model.objects.filter(user=row['user'], **{
+                target: row[target]}).exclude(id=row['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('zhihu', '0014_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='usercollectanswer',
+            unique_together={('user', 'answer')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='userfollowanswer',
+            unique_together={('user', 'answer')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='userfollowquestion',
+            unique_together={('user', 'question')},
+        ),
+        migrations.AddIndex(
+            model_name='usercollectanswer',
+            index=models.Index(fields=['answer', '-add_time'], name='zhihu_userc_answer__84314f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usercollectanswer',
+            index=models.Index(fields=['user', '-add_time', '-id'], name='zhihu_userc_user_id_73ddb9_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userfollowanswer',
+            index=models.Index(fields=['answer', '-add_time'], name='zhihu_userf_answer__5d5716_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userfollowquestion',
+            index=models.Index(fields=['question', '-add_time'], name='zhihu_userf_questio_02c992_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userfollowquestion',
+            index=models.Index(fields=['user', '-add_time', '-id'], name='zhihu_userf_user_id_34bb3d_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.0.3 on 2026-10-18 20:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zhihu', '0015_interaction_constraints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadNumsFlush',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('flush_id', models.CharField(max_length=32, unique=True, verbose_name='写入批次')),
+                ('add_time', models.DateTimeField(auto_now_add=True, verbose_name='写入时间')),
+            ],
+        ),
+    ]
@@ -2,6 +2,7 @@ from ckeditor_uploader.fields import RichTextUploadingField
 from django.contrib.auth import get_user_model
 from django.db import models
 
+from helper import object_cache
 from user.models import User
 
 
@@ -21,16 +22,20 @@ class Topic(models.Model):
 
     users = models.ManyToManyField(User, blank=True, verbose_name='用户话题')
 
+    # 计数字段, 由zhihu.counters维护, 避免模板中逐行COUNT查询
+    user_nums = models.IntegerField('关注者数', default=0)
+    question_nums = models.IntegerField('问题数', default=0)
+
     def __str__(self):
         return self.name
 
     def get_user_nums(self):
         '''获取关注者数量'''
-        return self.users.count()
+        return self.user_nums
 
     def get_question_nums(self):
         '''获取话题的问题数'''
-        return self.question_set.count()
+        return self.question_nums
 
 
 class Question(models.Model):
@@ -45,6 +50,10 @@ class Question(models.Model):
     read_nums = models.IntegerField('浏览量', default=0)
     is_anonymous = models.BooleanField('匿名问题', default=False)
 
+    # 计数字段, 由zhihu.counters维护
+    answer_nums = models.IntegerField('回答数', default=0)
+    follow_nums = models.IntegerField('关注者数', default=0)
+
     def __str__(self):
         return self.title
 
@@ -53,21 +62,37 @@ class Question(models.Model):
 
     def get_answer_nums(self):
         '''获取回答数量'''
-        return self.answer_set.count()
+        return self.answer_nums
 
     def get_follow_est_answer(self):
         '''获取点赞最多的回答'''
-        return self.answer_set.annotate(
-            follow_nums=models.Count('userfollowanswer')).order_by(
-            '-follow_nums').first()
+        return self.answer_set.order_by('-follow_nums').first()
 
     def get_topic_name(self):
-        '''获取话题名'''
-        return self.topics.first().name
+        '''获取话题名, 已由attach_topic_names批量设置时不再查询'''
+        if hasattr(self, '_topic_name'):
+            return self._topic_name
+        topic = self.topics.first()
+        return topic.name if topic else ''
 
     def get_follow_nums(self):
         '''获取关注者数量'''
-        return self.userfollowquestion_set.count()
+        return self.follow_nums
+
+
+def attach_topic_names(questions):
+    '''批量设置一组问题的话题名(第一个话题), 一次查询加一次对象缓存get_many'''
+    questions = [question for question in questions if question is not None]
+    first_topic_ids = {}
+    for question_id, topic_id in Question.topics.through.objects.filter(
+            question_id__in={question.id for question in questions}).order_by(
+        'question_id', 'topic_id').values_list('question_id', 'topic_id'):
+        first_topic_ids.setdefault(question_id, topic_id)
+    topics = object_cache.get_many(Topic, first_topic_ids.values())
+    for question in questions:
+        topic = topics.get(first_topic_ids.get(question.id))
+        if topic is not None:
+            question._topic_name = topic.name
 
 
 def get_sentinel_question():
@@ -87,17 +112,22 @@ class Answer(models.Model):
     votedown_nums = models.IntegerField('不认同数', default=0)
     is_anonymous = models.BooleanField('匿名回答', default=False)
 
+    # 计数字段, 由zhihu.counters维护
+    follow_nums = models.IntegerField('点赞数', default=0)
+    collect_nums = models.IntegerField('收藏数', default=0)
+    comment_nums = models.IntegerField('评论数', default=0)
+
     def get_follow_nums(self):
         '''获取回答点赞数'''
-        return self.userfollowanswer_set.count()
+        return self.follow_nums
 
     def get_collect_nums(self):
         '''获取回答的被收藏数'''
-        return self.usercollectanswer_set.count()
+        return self.collect_nums
 
     def get_comment_nums(self):
         '''获取评论数量'''
-        return self.answercomment_set.count()
+        return self.comment_nums
 
     def __str__(self):
         return self.content[:50]
@@ -122,6 +152,15 @@ class UserFollowQuestion(models.Model):
                                  verbose_name='问题')
     add_time = models.DateTimeField('添加时间', auto_now_add=True)
 
+    class Meta:
+        # 每个用户对同一个问题只有一条记录, 重复点击不会插入多条
+        unique_together = ('user', 'question')
+        # 问题的关注者列表, 用户主页关注的问题按时间倒序
+        indexes = [
+            models.Index(fields=['question', '-add_time']),
+            models.Index(fields=['user', '-add_time', '-id']),
+        ]
+
 
 class UserFollowAnswer(models.Model):
     '''用户点赞回答模型'''
@@ -130,6 +169,12 @@ class UserFollowAnswer(models.Model):
                                verbose_name='回答')
     add_time = models.DateTimeField('添加时间', auto_now_add=True)
 
+    class Meta:
+        # 每个用户对同一个回答只有一条记录, 重复点击不会插入多条
+        unique_together = ('user', 'answer')
+        # 回答的点赞记录按时间倒序
+        indexes = [models.Index(fields=['answer', '-add_time'])]
+
 
 class UserCollectAnswer(models.Model):
     '''用户收藏回答模型'''
@@ -137,3 +182,25 @@ class UserCollectAnswer(models.Model):
     answer = models.ForeignKey(Answer, on_delete=models.CASCADE,
                                verbose_name='回答')
     add_time = models.DateTimeField('添加时间', auto_now_add=True)
+
+    class Meta:
+        # 每个用户对同一个回答只有一条记录, 重复点击不会插入多条
+        unique_together = ('user', 'answer')
+        # 回答的收藏记录按时间倒序, 用户主页收藏的回答按时间倒序
+        indexes = [
+            models.Index(fields=['answer', '-add_time']),
+            models.Index(fields=['user', '-add_time', '-id']),
+        ]
+
+
+class ReadNumsFlush(models.Model):
+    '''问题浏览量写入记录
+
+    与浏览量的UPDATE在同一个事务中插入, 写入后删除redis中的hash前中断时,
+    重试发现记录已存在, 不会重复累加; 见zhihu.counters.flush_read_nums
+    '''
+    flush_id = models.CharField('写入批次', max_length=32, unique=True)
+    add_time = models.DateTimeField('写入时间', auto_now_add=True)
+
+    def __str__(self):
+        return self.flush_id
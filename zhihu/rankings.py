@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+# 物化排行
+# 热门话题, 热门问题等排行保存在redis有序集合 ranking:<排行名> 中,
+# 成员为对象id, 分数为排序字段; celery beat定时任务(refresh_rankings)重新统计,
+# 统计结果先写入临时key再rename, 读取时不会看到写了一半的排行;
+# 两次统计之间由zhihu.counters, zhihu.signals增量更新
+# 视图读取一页只需zrevrange当前页的id, 再从对象缓存取出对象, 不需要全表排序
+
+import time
+
+from django.db.models import Count
+from django_redis import get_redis_connection
+
+from helper import object_cache, swr_cache
+from helper.paginator_helper import CursorPage
+from .models import Question, Topic
+
+# 每批写入redis的成员数
+BATCH_SIZE = 1000
+
+
+def _topic_answer_nums():
+    return Topic.objects.annotate(answer_nums=Count('question__answer')) \
+        .values_list('id', 'answer_nums')
+
+
+# 排行名: (模型, 返回(id, 分数)列表的查询)
+RANKINGS = {
+    # 问题最多的话题
+    'hot_topics': (Topic, lambda: Topic.objects.values_list(
+        'id', 'question_nums')),
+    # 回答最多的话题
+    'topics_by_answers': (Topic, _topic_answer_nums),
+    # 关注人数最多的话题
+    'topics_by_users': (Topic, lambda: Topic.objects.values_list(
+        'id', 'user_nums')),
+    # 关注人数最多的问题
+    'hot_questions': (Question, lambda: Question.objects.values_list(
+        'id', 'follow_nums')),
+}
+
+
+def _key(name):
+    return 'ranking:%s' % name
+
+
+def _built_key(name):
+    return 'ranking_built:%s' % name
+
+
+def build(name):
+    '''重新统计一个排行, 返回成员数'''
+    model, query = RANKINGS[name]
+    key = _key(name)
+    tmp_key = '%s:tmp' % key
+    conn = get_redis_connection('default')
+    conn.delete(tmp_key)
+    rows = query().order_by().iterator()
+    members = 0
+    while True:
+        pipe = conn.pipeline()
+        batch = 0
+        for obj_id, score in rows:
+            pipe.zadd(tmp_key, score or 0, obj_id)
+            batch += 1
+            if batch >= BATCH_SIZE:
+                break
+        pipe.execute()
+        members += batch
+        if batch < BATCH_SIZE:
+            break
+    pipe = conn.pipeline()
+    if members:
+        pipe.rename(tmp_key, key)
+    else:
+        pipe.delete(key)
+    pipe.set(_built_key(name), int(time.time()))
+    pipe.execute()
+    return members
+
+
+def refresh_all():
+    '''重新统计全部排行, 由celery beat定时调用'''
+    return {name: build(name) for name in RANKINGS}
+
+
+def _ensure_built(conn, name):
+    '''排行还没有统计时(如首次部署, redis数据清除后)统计, 并发请求只统计一次'''
+    built_key = _built_key(name)
+    if conn.exists(built_key):
+        return
+    if swr_cache.acquire_lock(built_key):
+        try:
+            build(name)
+        finally:
+            swr_cache.release_lock(built_key)
+    elif swr_cache.wait_for(lambda: conn.get(built_key)) is None:
+        build(name)
+
+
+def _update(names, obj_ids, delta):
+    '''增量更新, 只更新已统计的排行, delta为0时添加分数为0的新成员'''
+    conn = get_redis_connection('default')
+    for name in names:
+        if not conn.exists(_built_key(name)):
+            continue
+        pipe = conn.pipeline()
+        for obj_id in obj_ids:
+            pipe.zincrby(_key(name), obj_id, delta)
+        pipe.execute()
+
+
+def _names(model):
+    return [name for name, (ranking_model, query) in RANKINGS.items() if
+            ranking_model is model]
+
+
+def object_created(obj):
+    '''新话题, 新问题加入排行'''
+    _update(_names(type(obj)), [obj.id], 0)
+
+
+def object_deleted(model, obj_id):
+    '''话题, 问题删除后移出排行'''
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    for name in _names(model):
+        pipe.zrem(_key(name), obj_id)
+    pipe.execute()
+
+
+def topic_followed(topic_id, delta=1):
+    _update(['topics_by_users'], [topic_id], delta)
+
+
+def question_followed(question_id, delta=1):
+    _update(['hot_questions'], [question_id], delta)
+
+
+def question_created(topic_ids):
+    '''新提问, 问题所属话题的问题数+1'''
+    _update(['hot_topics'], topic_ids, 1)
+
+
+def answer_created(answer, delta=1):
+    '''新回答/删除回答, 问题所属话题的回答数增减'''
+    topic_ids = list(Question.topics.through.objects.filter(
+        question_id=answer.question_id).values_list('topic_id', flat=True))
+    _update(['topics_by_answers'], topic_ids, delta)
+
+
+class SortedSetList(object):
+    '''redis有序集合中按分数倒序排列的对象列表
+
+    支持len()和切片, 可以直接传给paginator_helper分页,
+    切片时只从redis取当前页的id, 再从对象缓存取出对象
+    '''
+
+    def __init__(self, key, model, related=()):
+        self.key = key
+        self.model = model
+        self.related = related
+        self.conn = get_redis_connection('default')
+
+    def count(self):
+        return self.conn.zcard(self.key)
+
+    def __len__(self):
+        return self.count()
+
+    def ids(self, start, stop):
+        if stop <= start:
+            return []
+        return [int(obj_id) for obj_id in
+                self.conn.zrevrange(self.key, start, stop - 1)]
+
+    def objects(self, ids):
+        objs = object_cache.hydrate(self.model, ids)
+        object_cache.attach(objs, *self.related)
+        return objs
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        start = index.start or 0
+        stop = index.stop if index.stop is not None else self.count()
+        return self.objects(self.ids(start, stop))
+
+    def cursor_page(self, request, per_page=10, cursor_name='after'):
+        '''游标翻页, 游标为上一页最后一个对象的id
+
+        用zrevrank定位游标, 每页只取当前页的id; 游标不在集合中时从第一页开始
+        '''
+        cursor = request.GET.get(cursor_name)
+        start = 0
+        try:
+            rank = self.conn.zrevrank(self.key, int(cursor))
+        except (TypeError, ValueError):
+            rank = None
+        if rank is None:
+            cursor = None
+        else:
+            start = rank + 1
+        # 多取一个判断是否有下一页
+        ids = self.ids(start, start + per_page + 1)
+        next_cursor = None
+        if len(ids) > per_page:
+            ids = ids[:per_page]
+            next_cursor = str(ids[-1])
+        return CursorPage(self.objects(ids), next_cursor, cursor)
+
+
+class Ranking(SortedSetList):
+    '''一个排行的对象列表, 排行还没有统计时先统计'''
+
+    def __init__(self, name, related=()):
+        super(Ranking, self).__init__(_key(name), RANKINGS[name][0], related)
+        self.name = name
+        _ensure_built(self.conn, name)
+
+
+def top(name, num, related=()):
+    '''排行前num个对象'''
+    return Ranking(name, related)[:num]
+
+
+def cursor_page(request, name, per_page=10, cursor_name='after',
+                related=()):
+    '''在排行上游标翻页, 游标为上一页最后一个对象的id'''
+    return Ranking(name, related).cursor_page(request, per_page, cursor_name)
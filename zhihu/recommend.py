@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+# 推荐相关查询
+
+from django.db.models import OuterRef, Subquery
+
+from helper import object_cache
+from .models import Question, Answer
+
+
+def with_follow_est_answer(questions):
+    '''给问题queryset标注点赞最多的回答id: follow_est_answer_id
+
+    使用关联子查询, 整个queryset只需一条查询, 可以在数据库中过滤, 排序和分页
+    '''
+    follow_est_answer = Answer.objects.filter(
+        question=OuterRef('pk')).order_by('-follow_nums', 'id').values('id')[:1]
+    return questions.annotate(follow_est_answer_id=Subquery(follow_est_answer))
+
+
+def attach_follow_est_answer(questions):
+    '''给一页问题绑定点赞最多的回答: follow_est_answer, 返回问题列表
+
+    问题已由with_follow_est_answer标注时, 一次查询取出所有回答;
+    否则再用一条查询解析回答id
+    '''
+    questions = list(questions)
+    if not questions:
+        return questions
+    if not all(hasattr(question, 'follow_est_answer_id') for question in
+               questions):
+        answer_ids = dict(with_follow_est_answer(Question.objects.filter(
+            id__in=[question.id for question in questions])).values_list(
+            'id', 'follow_est_answer_id'))
+        for question in questions:
+            question.follow_est_answer_id = answer_ids.get(question.id)
+    answers = object_cache.get_many(
+        Answer, [question.follow_est_answer_id for question in questions])
+    object_cache.attach(answers.values(), 'author')
+    for question in questions:
+        question.follow_est_answer = answers.get(question.follow_est_answer_id)
+    return questions
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+# 相关问题索引
+# 问题的相似度 = 标题TF-IDF余弦相似度 + TOPIC_WEIGHT * 共同话题比例:
+#   标题用jieba分词(与站内搜索相同的zhihu.search_index.tokenize),
+#   共同话题比例 = 共同话题数 / sqrt(话题数a * 话题数b)
+# 每个问题最相关的SIZE个问题保存在redis有序集合 related:<问题id> 中,
+# 成员为问题id, 分数为相似度; 详情页只需zrevrange, 不需要查询数据库
+# 候选问题: 标题中有相同的词(词的倒排 related:terms:<词>, 包含该词的问题id集合,
+# 集合大小即文档频率), 或属于同一话题且浏览量最高的TOPIC_CANDIDATES个问题;
+# 出现在太多问题中的词(超过MAX_DF)区分度低, 不用于查找候选
+# 全量统计由管理命令rebuild_related和celery beat定时任务完成,
+# 新问题, 问题话题变化时由zhihu.signals触发celery任务增量更新,
+# 同时把新问题加入相似问题的列表; 话题移除后的旧分数在下次全量统计时修正
+
+import math
+from collections import Counter
+
+from django_redis import get_redis_connection
+
+from helper import object_cache, swr_cache
+from .models import Question
+from .search_index import tokenize
+from . import tasks
+
+# 每个问题保存的相关问题数
+SIZE = 10
+# 共同话题的权重
+TOPIC_WEIGHT = 0.5
+# 每个话题取浏览量最高的问题作为候选
+TOPIC_CANDIDATES = 50
+# 超过这个文档频率的词不用于查找候选
+MAX_DF = 1000
+# 每批写入redis的问题数
+BATCH_SIZE = 500
+
+DOCS_KEY = 'related_docs'
+BUILT_KEY = 'related_built'
+
+
+def _key(question_id):
+    return 'related:%s' % question_id
+
+
+def _term_key(term):
+    return 'related:terms:%s' % term
+
+
+def _idf(doc_count, df):
+    return math.log((1 + doc_count) / (1 + df)) + 1
+
+
+def _vector(tokens, idf):
+    '''词频 * idf, 归一化为单位向量'''
+    vector = {term: tf * idf(term) for term, tf in tokens.items()}
+    norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+    if norm:
+        vector = {term: weight / norm for term, weight in vector.items()}
+    return vector
+
+
+def _similarity(vector, topic_ids, other_vector, other_topic_ids):
+    score = sum(weight * other_vector.get(term, 0) for term, weight in
+                vector.items())
+    if topic_ids and other_topic_ids:
+        score += TOPIC_WEIGHT * len(topic_ids & other_topic_ids) / math.sqrt(
+            len(topic_ids) * len(other_topic_ids))
+    return score
+
+
+def _neighbours(question_id, vector, topic_ids, candidates):
+    '''candidates为{问题id: (向量, 话题id集合)}, 返回最相关的SIZE个(问题id, 相似度)'''
+    scores = []
+    for other_id, (other_vector, other_topic_ids) in candidates.items():
+        if other_id == question_id:
+            continue
+        score = _similarity(vector, topic_ids, other_vector, other_topic_ids)
+        if score > 0:
+            scores.append((other_id, score))
+    # 相似度相同时, 新的问题在前
+    scores.sort(key=lambda item: (-item[1], -item[0]))
+    return scores[:SIZE]
+
+
+def _set_neighbours(pipe, question_id, neighbours):
+    key = _key(question_id)
+    pipe.delete(key)
+    for other_id, score in neighbours:
+        pipe.zadd(key, score, other_id)
+
+
+def build():
+    '''全量统计全部问题的相关问题, 返回问题数'''
+    tokens = {}
+    postings = {}
+    for question_id, title in Question.objects.values_list(
+            'id', 'title').iterator():
+        tokens[question_id] = Counter(tokenize(title))
+        for term in tokens[question_id]:
+            postings.setdefault(term, set()).add(question_id)
+    topic_ids = {}
+    for question_id, topic_id in Question.topics.through.objects.values_list(
+            'question_id', 'topic_id').iterator():
+        topic_ids.setdefault(question_id, set()).add(topic_id)
+    # 话题: 浏览量最高的TOPIC_CANDIDATES个问题
+    topic_questions = {}
+    for question_id, topic_id in Question.objects.filter(
+            topics__isnull=False).order_by('-read_nums', '-id').values_list(
+            'id', 'topics').iterator():
+        questions = topic_questions.setdefault(topic_id, [])
+        if len(questions) < TOPIC_CANDIDATES:
+            questions.append(question_id)
+
+    doc_count = len(tokens)
+
+    def idf(term):
+        return _idf(doc_count, len(postings[term]))
+
+    vectors = {question_id: _vector(question_tokens, idf) for
+               question_id, question_tokens in tokens.items()}
+
+    conn = get_redis_connection('default')
+    question_ids = list(tokens)
+    for start in range(0, len(question_ids), BATCH_SIZE):
+        pipe = conn.pipeline()
+        for question_id in question_ids[start:start + BATCH_SIZE]:
+            candidate_ids = set()
+            for term in tokens[question_id]:
+                if len(postings[term]) <= MAX_DF:
+                    candidate_ids |= postings[term]
+            for topic_id in topic_ids.get(question_id, ()):
+                candidate_ids.update(topic_questions.get(topic_id, ()))
+            candidates = {
+                other_id: (vectors[other_id], topic_ids.get(other_id, set()))
+                for other_id in candidate_ids}
+            _set_neighbours(pipe, question_id, _neighbours(
+                question_id, vectors[question_id],
+                topic_ids.get(question_id, set()), candidates))
+        pipe.execute()
+    # 重写词的倒排, 删除已不存在的词
+    old_keys = set(conn.scan_iter(_term_key('*')))
+    terms = list(postings)
+    for start in range(0, len(terms), BATCH_SIZE):
+        pipe = conn.pipeline()
+        for term in terms[start:start + BATCH_SIZE]:
+            key = _term_key(term)
+            old_keys.discard(key.encode())
+            pipe.delete(key)
+            pipe.sadd(key, *postings[term])
+        pipe.execute()
+    pipe = conn.pipeline()
+    if old_keys:
+        pipe.delete(*old_keys)
+    pipe.set(DOCS_KEY, doc_count)
+    pipe.set(BUILT_KEY, 1)
+    pipe.execute()
+    return doc_count
+
+
+def _ensure_built(conn):
+    '''相关问题索引已生成时返回True; 不存在时(新部署, redis被清空)交给celery后台生成,
+    不在请求中生成, 返回False'''
+    if conn.exists(BUILT_KEY):
+        return True
+    swr_cache.schedule_build(BUILT_KEY, tasks.rebuild_related)
+    # celery同步执行时(CELERY_ALWAYS_EAGER)已生成
+    return bool(conn.exists(BUILT_KEY))
+
+
+def _topic_ids(question_ids):
+    topic_ids = {question_id: set() for question_id in question_ids}
+    for question_id, topic_id in Question.topics.through.objects.filter(
+            question_id__in=question_ids).values_list(
+            'question_id', 'topic_id'):
+        topic_ids[question_id].add(topic_id)
+    return topic_ids
+
+
+def update(question_id, created=False):
+    '''增量更新一个问题的相关问题, 并加入相似问题的列表
+
+    created为True时把问题的标题加入词的倒排; 还没有全量统计时不更新
+    '''
+    conn = get_redis_connection('default')
+    if not conn.exists(BUILT_KEY):
+        return
+    title = Question.objects.filter(id=question_id).values_list(
+        'title', flat=True).first()
+    if title is None:
+        return
+    tokens = Counter(tokenize(title))
+    if created:
+        pipe = conn.pipeline()
+        for term in tokens:
+            pipe.sadd(_term_key(term), question_id)
+        pipe.incr(DOCS_KEY)
+        pipe.execute()
+    terms = list(tokens)
+    pipe = conn.pipeline()
+    for term in terms:
+        pipe.scard(_term_key(term))
+    dfs = dict(zip(terms, pipe.execute()))
+    doc_count = int(conn.get(DOCS_KEY) or 0)
+
+    def idf(term):
+        return _idf(doc_count, dfs.get(term, 0))
+
+    # 候选问题: 标题中有相同的词, 或属于同一话题
+    topic_ids = _topic_ids([question_id])[question_id]
+    candidate_ids = set()
+    pipe = conn.pipeline()
+    for term in terms:
+        if dfs[term] <= MAX_DF:
+            pipe.smembers(_term_key(term))
+    for members in pipe.execute():
+        candidate_ids.update(int(member) for member in members)
+    for topic_id in topic_ids:
+        candidate_ids.update(Question.objects.filter(
+            topics=topic_id).order_by('-read_nums', '-id').values_list(
+            'id', flat=True)[:TOPIC_CANDIDATES])
+    candidate_ids.discard(question_id)
+    # 候选问题的标题在计算时分词, 不保存每个问题的词
+    candidate_topic_ids = _topic_ids(candidate_ids)
+    candidates = {}
+    for other_id, other_title in Question.objects.filter(
+            id__in=candidate_ids).values_list('id', 'title'):
+        candidates[other_id] = (
+            _vector(Counter(tokenize(other_title)), idf),
+            candidate_topic_ids[other_id])
+    neighbours = _neighbours(question_id, _vector(tokens, idf), topic_ids,
+                             candidates)
+
+    pipe = conn.pipeline()
+    _set_neighbours(pipe, question_id, neighbours)
+    # 相似度是对称的, 分数高于对方列表中的最后一个时进入对方的列表
+    for other_id, score in neighbours:
+        pipe.zadd(_key(other_id), score, question_id)
+        pipe.zremrangebyrank(_key(other_id), 0, -SIZE - 1)
+    pipe.execute()
+
+
+def question_deleted(question_id, title):
+    '''问题删除后删除相关问题列表和词的倒排, 其他列表中的id在读取时跳过'''
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    pipe.delete(_key(question_id))
+    for term in set(tokenize(title)):
+        pipe.srem(_term_key(term), question_id)
+    pipe.decr(DOCS_KEY)
+    pipe.execute()
+
+
+def related_questions(question_id, num=5):
+    '''问题的前num个相关问题, 索引未生成时为空列表'''
+    conn = get_redis_connection('default')
+    if not _ensure_built(conn):
+        return []
+    # 多取一些, 已删除的问题跳过
+    ids = [int(other_id) for other_id in
+           conn.zrevrange(_key(question_id), 0, SIZE - 1)]
+    return object_cache.hydrate(Question, ids)[:num]
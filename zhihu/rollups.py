@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+# 回答点赞的时间分桶统计
+# 点赞按发生的时间累加到redis有序集合中, 回答id -> 该时间段内收到的点赞数:
+#   upvotes:hour:<YYYYmmddHH>  每小时一个桶, 保留HOUR_BUCKET_TIMEOUT
+#   upvotes:day:<YYYYmmdd>     每天一个桶, 保留DAY_BUCKET_TIMEOUT
+# 新回答以0分加入发布时的桶, 没有点赞的新回答也在排行中;
+# 发生时间超过桶保留时间的点赞, 取消点赞, 新回答不再写入, 不重新生成已过期的桶;
+# 取消点赞时从点赞发生时的桶中扣除; 回答删除后从保留期内的全部桶中删除;
+# 由zhihu.signals在写入时更新
+# 时间窗口(今天, 本月, 最近24小时, 最近7天)的排行由窗口内的桶合并而成,
+# 从0点开始的一天使用天桶, 其余使用小时桶, 合并结果缓存WINDOW_TIMEOUT;
+# 窗口排行为回答在窗口内收到的点赞数, 不限制回答的发布时间, 窗口内的新回答以0分在排行中;
+# 读取一页只需zrevrange, 与历史数据量无关
+
+from datetime import timedelta
+
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from helper import swr_cache
+from .models import Answer, UserFollowAnswer
+from .rankings import SortedSetList
+from . import tasks
+
+HOUR_BUCKET_TIMEOUT = 8 * 24 * 60 * 60
+DAY_BUCKET_TIMEOUT = 62 * 24 * 60 * 60
+# 合并后的窗口排行缓存时间
+WINDOW_TIMEOUT = 60
+# 不写入的key, 统计未生成时窗口排行为空
+EMPTY_KEY = 'upvotes:empty'
+# 分桶统计已生成的标记
+BUILT_KEY = 'upvotes_built'
+
+
+def _localtime(value=None):
+    '''本地时间, 兼容USE_TZ为True和False'''
+    if value is None:
+        value = timezone.now()
+    if timezone.is_aware(value):
+        value = timezone.localtime(value)
+    return value.replace(tzinfo=None)
+
+
+def _hour_key(hour):
+    return 'upvotes:hour:%s' % hour.strftime('%Y%m%d%H')
+
+
+def _day_key(day):
+    return 'upvotes:day:%s' % day.strftime('%Y%m%d')
+
+
+def _add(pipe, answer_id, delta, when, now=None):
+    '''点赞数累加到when所在的小时桶和天桶, 已超过保留时间的桶不写入'''
+    when = _localtime(when)
+    now = _localtime(now)
+    for key, timeout in ((_hour_key(when), HOUR_BUCKET_TIMEOUT),
+                         (_day_key(when), DAY_BUCKET_TIMEOUT)):
+        if when < now - timedelta(seconds=timeout):
+            continue
+        pipe.zincrby(key, answer_id, delta)
+        pipe.expire(key, timeout)
+
+
+def _window_key(name, end):
+    return 'upvotes:window:%s:%s' % (name, end.strftime('%Y%m%d%H'))
+
+
+def record(answer_id, delta, when):
+    '''记录点赞(delta=1), 取消点赞(delta=-1), 新回答(delta=0), when为发生时间'''
+    pipe = get_redis_connection('default').pipeline()
+    _add(pipe, answer_id, delta, when)
+    pipe.execute()
+
+
+def build():
+    '''从数据库统计保留期内的点赞, 重新生成全部分桶, 首次部署或redis数据清除后调用'''
+    now = _localtime()
+    since = now - timedelta(seconds=DAY_BUCKET_TIMEOUT)
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    keys = list(conn.scan_iter('upvotes:*'))
+    if keys:
+        pipe.delete(*keys)
+    for answer_id, pub_time in Answer.objects.filter(
+            pub_time__gte=since).values_list('id', 'pub_time').iterator():
+        _add(pipe, answer_id, 0, pub_time, now)
+    for answer_id, add_time in UserFollowAnswer.objects.filter(
+            add_time__gte=since).values_list('answer_id', 'add_time') \
+            .iterator():
+        _add(pipe, answer_id, 1, add_time, now)
+    pipe.set(BUILT_KEY, 1)
+    pipe.execute()
+
+
+def _ensure_built(conn):
+    '''点赞分桶统计已生成时返回True; 不存在时(新部署, redis被清空)交给celery后台生成,
+    不在请求中生成, 返回False'''
+    if conn.exists(BUILT_KEY):
+        return True
+    swr_cache.schedule_build(BUILT_KEY, tasks.build_rollups)
+    # celery同步执行时(CELERY_ALWAYS_EAGER)已生成
+    return bool(conn.exists(BUILT_KEY))
+
+
+def _bucket_keys(start, end):
+    '''[start, end)整点小时范围内的桶, end为当前小时的结束时间
+
+    从0点开始的一天使用天桶, 当天的天桶就是当天到现在的点赞
+    '''
+    keys = []
+    hour = start
+    while hour < end:
+        if hour.hour == 0:
+            keys.append(_day_key(hour))
+            hour += timedelta(days=1)
+        else:
+            keys.append(_hour_key(hour))
+            hour += timedelta(hours=1)
+    return keys
+
+
+def _today_start(now):
+    return now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+# 窗口名: 返回窗口开始时间(整点)的函数, 窗口到当前小时结束
+WINDOWS = {
+    'today': _today_start,
+    'month': lambda now: _today_start(now).replace(day=1),
+    '24h': lambda now: now.replace(minute=0, second=0, microsecond=0) -
+                       timedelta(hours=23),
+    '7d': lambda now: now.replace(minute=0, second=0, microsecond=0) -
+                      timedelta(hours=7 * 24 - 1),
+}
+
+
+def window_key(conn, name, now=None):
+    '''窗口排行的有序集合key, 多个桶时合并后缓存'''
+    now = _localtime(now)
+    end = now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    keys = _bucket_keys(WINDOWS[name](now), end)
+    if len(keys) == 1:
+        return keys[0]
+    key = _window_key(name, end)
+    if not conn.exists(key):
+        pipe = conn.pipeline()
+        pipe.zunionstore(key, keys)
+        pipe.expire(key, WINDOW_TIMEOUT)
+        pipe.execute()
+    return key
+
+
+def answer_deleted(answer_id):
+    '''回答删除后从保留期内的全部桶和当前小时的窗口排行中删除, 包括0分的新回答'''
+    now = _localtime()
+    hour = now.replace(minute=0, second=0, microsecond=0)
+    keys = [_hour_key(hour - timedelta(hours=hours)) for hours in
+            range(HOUR_BUCKET_TIMEOUT // (60 * 60) + 1)]
+    keys += [_day_key(now - timedelta(days=days)) for days in
+             range(DAY_BUCKET_TIMEOUT // (24 * 60 * 60) + 1)]
+    keys += [_window_key(name, hour + timedelta(hours=1)) for name in WINDOWS]
+    pipe = get_redis_connection('default').pipeline()
+    for key in keys:
+        pipe.zrem(key, answer_id)
+    pipe.execute()
+
+
+class WindowRanking(SortedSetList):
+    '''时间窗口内点赞最多的回答, 按窗口内的点赞数排序'''
+
+    def __init__(self, name, related=()):
+        conn = get_redis_connection('default')
+        # 统计未生成时读取空的key, 不缓存只有部分点赞的窗口
+        key = window_key(conn, name) if _ensure_built(conn) else EMPTY_KEY
+        super(WindowRanking, self).__init__(key, Answer, related)
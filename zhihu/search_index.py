@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+# 站内搜索倒排索引
+# 问题, 回答, 话题, 用户的文本使用jieba分词, 倒排表保存在本地sqlite文件中,
+# 不依赖外部服务; 搜索时只读取关键词的倒排记录, 使用BM25算法计算相关度排序
+# 倒排记录保存BM25中与词频, 文档长度有关的部分(impact), 按impact倒序建索引,
+# 每个词只读取impact最高的MAX_POSTINGS条, 搜索耗时与匹配的文档数无关;
+# impact按写入时的平均文档长度计算, 重建索引时按最终的平均长度重新计算
+# 排序后的id列表(最多MAX_RESULTS个)按(类型, 分词)缓存, 索引变化时由标签失效
+# 模型保存/删除时由zhihu.signals增量更新索引
+# 重建索引: python manage.py rebuild_search_index
+# 索引结构变化时(SCHEMA_VERSION)旧的索引表被删除, 需要重建索引
+
+import logging
+import math
+import re
+import sqlite3
+from collections import Counter
+from contextlib import contextmanager
+
+import jieba  # 中文分词
+from django.conf import settings
+from django.utils.html import strip_tags
+
+from helper import object_cache, tag_cache
+from user.models import User
+from .models import Question, Answer, Topic
+
+logger = logging.getLogger(__name__)
+
+# BM25参数
+K1 = 1.2
+B = 0.75
+# 每个词读取的倒排记录数
+MAX_POSTINGS = 1000
+# 搜索结果的最大数量
+MAX_RESULTS = 1000
+# 搜索结果缓存时间
+SEARCH_CACHE_TIMEOUT = 10 * 60
+
+# 搜索类型: (模型, 获取索引文本的函数)
+DOC_TYPES = {
+    'question': (Question, lambda obj: ' '.join(
+        [obj.title, obj.title, obj.content or ''])),
+    'answer': (Answer, lambda obj: strip_tags(obj.content)),
+    'topic': (Topic, lambda obj: ' '.join(
+        [obj.name, obj.name, obj.description or ''])),
+    'user': (User, lambda obj: ' '.join(
+        [obj.username, obj.nickname or ''])),
+}
+
+# 只保留含有文字或数字的词
+WORD_RE = re.compile(r'\w', re.UNICODE)
+
+SCHEMA_VERSION = 2
+SCHEMA = '''
+DROP TABLE IF EXISTS docs;
+DROP TABLE IF EXISTS postings;
+DROP TABLE IF EXISTS terms;
+DROP TABLE IF EXISTS stats;
+CREATE TABLE docs (
+    doc_type TEXT NOT NULL,
+    doc_id INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    PRIMARY KEY (doc_type, doc_id)
+) WITHOUT ROWID;
+CREATE TABLE postings (
+    doc_type TEXT NOT NULL,
+    term TEXT NOT NULL,
+    doc_id INTEGER NOT NULL,
+    tf INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    impact REAL NOT NULL,
+    PRIMARY KEY (doc_type, term, doc_id)
+) WITHOUT ROWID;
+CREATE INDEX postings_doc ON postings (doc_type, doc_id);
+CREATE INDEX postings_impact ON postings (doc_type, term, impact DESC,
+                                          doc_id DESC);
+CREATE TABLE terms (
+    doc_type TEXT NOT NULL,
+    term TEXT NOT NULL,
+    df INTEGER NOT NULL,
+    PRIMARY KEY (doc_type, term)
+) WITHOUT ROWID;
+CREATE TABLE stats (
+    doc_type TEXT PRIMARY KEY,
+    doc_count INTEGER NOT NULL,
+    total_length INTEGER NOT NULL
+);
+'''
+
+
+def tokenize(text):
+    '''jieba搜索引擎模式分词, 小写, 去除标点和空白'''
+    return [word.lower() for word in jieba.cut_for_search(text) if
+            WORD_RE.search(word)]
+
+
+def _init(conn):
+    '''索引表不存在或版本不同时创建, 旧版本的表删除后重建
+
+    每次打开只读取user_version; 建表在BEGIN IMMEDIATE事务中,
+    多个进程同时打开新文件时只有一个建表
+    '''
+    if conn.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION:
+        return
+    # WAL模式保存在文件中, 建表时设置一次
+    conn.execute('PRAGMA journal_mode=WAL')
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version != SCHEMA_VERSION:
+                for statement in SCHEMA.split(';'):
+                    if statement.strip():
+                        conn.execute(statement)
+                conn.execute('PRAGMA user_version=%d' % SCHEMA_VERSION)
+                if version:
+                    logger.warning('search index schema changed, run: '
+                                   'python manage.py rebuild_search_index')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+    finally:
+        conn.isolation_level = isolation_level
+
+
+@contextmanager
+def get_connection():
+    '''打开索引文件, 正常退出时提交事务, 出错时回滚'''
+    conn = sqlite3.connect(settings.SEARCH_INDEX_PATH, timeout=10)
+    try:
+        _init(conn)
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def _impact(tf, length, avg_length):
+    '''BM25中一个词在一个文档中的得分, 不含idf'''
+    return tf * (K1 + 1) / (tf + K1 * (1 - B + B * length / avg_length))
+
+
+def _avg_length(conn, doc_type):
+    row = conn.execute(
+        'SELECT doc_count, total_length FROM stats WHERE doc_type=?',
+        (doc_type,)).fetchone()
+    if not row or not row[0]:
+        return None
+    return row[1] / row[0] or 1
+
+
+def _invalidate(doc_type):
+    tag_cache.invalidate('search:%s' % doc_type)
+
+
+def _remove(conn, doc_type, doc_id):
+    row = conn.execute('SELECT length FROM docs WHERE doc_type=? AND doc_id=?',
+                       (doc_type, doc_id)).fetchone()
+    if row is None:
+        return
+    conn.execute(
+        'UPDATE terms SET df=df-1 WHERE doc_type=? AND term IN '
+        '(SELECT term FROM postings WHERE doc_type=? AND doc_id=?)',
+        (doc_type, doc_type, doc_id))
+    conn.execute('DELETE FROM postings WHERE doc_type=? AND doc_id=?',
+                 (doc_type, doc_id))
+    conn.execute('DELETE FROM docs WHERE doc_type=? AND doc_id=?',
+                 (doc_type, doc_id))
+    conn.execute('UPDATE stats SET doc_count=doc_count-1, '
+                 'total_length=total_length-? WHERE doc_type=?',
+                 (row[0], doc_type))
+
+
+def _add(conn, doc_type, obj):
+    terms = tokenize(DOC_TYPES[doc_type][1](obj))
+    length = len(terms)
+    conn.execute('INSERT INTO docs (doc_type, doc_id, length) VALUES (?,?,?)',
+                 (doc_type, obj.id, length))
+    conn.execute('INSERT OR IGNORE INTO stats VALUES (?, 0, 0)', (doc_type,))
+    conn.execute('UPDATE stats SET doc_count=doc_count+1, '
+                 'total_length=total_length+? WHERE doc_type=?',
+                 (length, doc_type))
+    avg_length = _avg_length(conn, doc_type)
+    tfs = Counter(terms)
+    conn.executemany(
+        'INSERT INTO postings (doc_type, term, doc_id, tf, length, impact) '
+        'VALUES (?,?,?,?,?,?)',
+        [(doc_type, term, obj.id, tf, length,
+          _impact(tf, length, avg_length)) for term, tf in tfs.items()])
+    conn.executemany('INSERT OR IGNORE INTO terms VALUES (?, ?, 0)',
+                     [(doc_type, term) for term in tfs])
+    conn.executemany('UPDATE terms SET df=df+1 WHERE doc_type=? AND term=?',
+                     [(doc_type, term) for term in tfs])
+
+
+def index_object(doc_type, obj):
+    '''添加或更新一个对象的索引'''
+    with get_connection() as conn:
+        _remove(conn, doc_type, obj.id)
+        _add(conn, doc_type, obj)
+    _invalidate(doc_type)
+
+
+def remove_object(doc_type, doc_id):
+    '''删除一个对象的索引'''
+    with get_connection() as conn:
+        _remove(conn, doc_type, doc_id)
+    _invalidate(doc_type)
+
+
+def rebuild(doc_type, batch_size=1000):
+    '''重建一种类型的索引, 返回索引的对象数'''
+    model = DOC_TYPES[doc_type][0]
+    nums = 0
+    with get_connection() as conn:
+        conn.execute('DELETE FROM postings WHERE doc_type=?', (doc_type,))
+        conn.execute('DELETE FROM docs WHERE doc_type=?', (doc_type,))
+        conn.execute('DELETE FROM terms WHERE doc_type=?', (doc_type,))
+        conn.execute('DELETE FROM stats WHERE doc_type=?', (doc_type,))
+        for obj in model.objects.order_by('id').iterator(chunk_size=batch_size):
+            _add(conn, doc_type, obj)
+            nums += 1
+        # 按最终的平均文档长度重新计算impact
+        avg_length = _avg_length(conn, doc_type)
+        if avg_length:
+            conn.execute(
+                'UPDATE postings SET impact = tf * ? / '
+                '(tf + ? * (1 - ? + ? * length / ?)) WHERE doc_type=?',
+                (K1 + 1, K1, B, B, float(avg_length), doc_type))
+    _invalidate(doc_type)
+    return nums
+
+
+def _ranked_ids(doc_type, terms):
+    '''按BM25相关度排序的id列表, 每个词只读取impact最高的MAX_POSTINGS条'''
+    with get_connection() as conn:
+        row = conn.execute('SELECT doc_count FROM stats WHERE doc_type=?',
+                           (doc_type,)).fetchone()
+        if not row or not row[0]:
+            return []
+        doc_count = row[0]
+        scores = Counter()
+        for term in terms:
+            row = conn.execute(
+                'SELECT df FROM terms WHERE doc_type=? AND term=?',
+                (doc_type, term)).fetchone()
+            if not row or not row[0]:
+                continue
+            df = row[0]
+            idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+            for doc_id, impact in conn.execute(
+                    'SELECT doc_id, impact FROM postings '
+                    'WHERE doc_type=? AND term=? '
+                    'ORDER BY impact DESC, doc_id DESC LIMIT ?',
+                    (doc_type, term, MAX_POSTINGS)):
+                scores[doc_id] += idf * impact
+    # 相关度相同时, 新的对象在前
+    return [doc_id for doc_id, score in
+            sorted(scores.items(), key=lambda item: (-item[1], -item[0]))[
+            :MAX_RESULTS]]
+
+
+def search(doc_type, keywords):
+    '''搜索, 返回按BM25相关度排序的对象id列表, 最多MAX_RESULTS个'''
+    terms = sorted(set(tokenize(keywords)))
+    if not terms:
+        return []
+    return tag_cache.get_or_set(
+        'search:%s:%s' % (doc_type, ' '.join(terms)),
+        ['search:%s' % doc_type], lambda: _ranked_ids(doc_type, terms),
+        SEARCH_CACHE_TIMEOUT)
+
+
+class SearchResults(object):
+    '''搜索结果列表
+
+    支持len()和切片, 可以直接传给paginator_helper分页,
+    切片时只查询当前页的对象
+    '''
+
+    def __init__(self, doc_type, keywords):
+        self.model = DOC_TYPES[doc_type][0]
+        self.doc_type = doc_type
+        self.ids = search(doc_type, keywords)
+
+    def count(self):
+        return len(self.ids)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        objs = object_cache.hydrate(self.model, self.ids[index])
+        if self.doc_type == 'answer':
+            object_cache.attach(objs, 'question', 'author')
+        return objs
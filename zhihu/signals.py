@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+# 模型信号处理
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from helper import tag_cache, object_cache
+from user import timeline
+from user.models import User
+from . import search_index, cache_tags, rankings, rollups, trending, related
+from .models import Question, Answer, Topic, UserFollowAnswer, \
+    UserCollectAnswer
+from .tasks import update_related
+
+# 模型: 搜索类型
+SEARCH_DOC_TYPES = {
+    Question: 'question',
+    Answer: 'answer',
+    Topic: 'topic',
+    User: 'user',
+}
+
+# 用户登录只更新last_login, 只有这些字段变化时才需要更新用户索引
+USER_INDEX_FIELDS = {'username', 'nickname'}
+
+
+@receiver(post_save)
+def update_search_index(sender, instance, update_fields=None, **kwargs):
+    '''保存后更新搜索索引, 事务提交后执行'''
+    doc_type = SEARCH_DOC_TYPES.get(sender)
+    if doc_type is None:
+        return
+    if sender is User and update_fields and not (
+            USER_INDEX_FIELDS & set(update_fields)):
+        return
+    transaction.on_commit(
+        lambda: search_index.index_object(doc_type, instance))
+
+
+@receiver(post_delete)
+def remove_search_index(sender, instance, **kwargs):
+    '''删除后删除搜索索引'''
+    doc_type = SEARCH_DOC_TYPES.get(sender)
+    if doc_type is None:
+        return
+    doc_id = instance.id
+    transaction.on_commit(lambda: search_index.remove_object(doc_type, doc_id))
+
+
+@receiver(post_save)
+def add_user_activity(sender, instance, created=False, **kwargs):
+    '''回答, 提问, 点赞, 收藏, 关注问题时追加用户动态'''
+    if created and sender in timeline.ACTIVITY_TYPES:
+        timeline.add_activity(instance)
+
+
+@receiver(post_delete)
+def remove_user_activity(sender, instance, **kwargs):
+    '''记录删除时删除对应的用户动态'''
+    if sender in timeline.ACTIVITY_TYPES:
+        timeline.remove_activity(instance)
+
+
+@receiver(post_save)
+def add_to_rankings(sender, instance, created=False, **kwargs):
+    '''新话题, 新问题加入排行, 事务提交后执行'''
+    if created and sender in (Question, Topic):
+        transaction.on_commit(lambda: rankings.object_created(instance))
+
+
+@receiver(post_delete)
+def remove_from_rankings(sender, instance, **kwargs):
+    '''话题, 问题删除后移出排行'''
+    if sender in (Question, Topic):
+        obj_id = instance.id
+        transaction.on_commit(lambda: rankings.object_deleted(sender, obj_id))
+
+
+@receiver(post_save)
+def add_upvote_rollup(sender, instance, created=False, **kwargs):
+    '''新回答, 新点赞计入发生时间的点赞分桶, 事务提交后执行'''
+    if not created:
+        return
+    if sender is Answer:
+        transaction.on_commit(
+            lambda: rollups.record(instance.id, 0, instance.pub_time))
+    elif sender is UserFollowAnswer:
+        transaction.on_commit(
+            lambda: rollups.record(instance.answer_id, 1, instance.add_time))
+
+
+@receiver(post_delete)
+def remove_upvote_rollup(sender, instance, **kwargs):
+    '''取消点赞, 从点赞时间的分桶中扣除; 回答删除后从全部分桶中删除
+
+    级联删除时点赞记录先于回答删除, 扣除在回答移出分桶之前执行
+    '''
+    if sender is UserFollowAnswer:
+        answer_id, add_time = instance.answer_id, instance.add_time
+        transaction.on_commit(lambda: rollups.record(answer_id, -1, add_time))
+    elif sender is Answer:
+        answer_id = instance.id
+        transaction.on_commit(lambda: rollups.answer_deleted(answer_id))
+
+
+# 点赞, 收藏记录: 热度事件
+TRENDING_EVENTS = {
+    UserFollowAnswer: 'upvote',
+    UserCollectAnswer: 'collect',
+}
+
+
+@receiver(post_save)
+def add_trending_event(sender, instance, created=False, **kwargs):
+    '''新问题, 新回答, 点赞, 收藏给热度排行加分, 事务提交后执行'''
+    if not created:
+        return
+    if sender is Question:
+        transaction.on_commit(lambda: trending.record(
+            'question', instance.id, when=instance.pub_time))
+    elif sender is Answer:
+        transaction.on_commit(lambda: trending.record(
+            'answer', instance.question_id, instance.id, instance.pub_time))
+    elif sender in TRENDING_EVENTS:
+        transaction.on_commit(lambda: trending.answer_event(
+            TRENDING_EVENTS[sender], instance.answer_id, instance.add_time))
+
+
+@receiver(post_delete)
+def remove_trending_event(sender, instance, **kwargs):
+    '''取消点赞, 收藏时按原事件时间扣除热度; 回答, 问题删除后移出热度排行'''
+    if sender in TRENDING_EVENTS:
+        answer_id, add_time = instance.answer_id, instance.add_time
+        transaction.on_commit(lambda: trending.answer_event(
+            TRENDING_EVENTS[sender], answer_id, add_time, sign=-1))
+    elif sender is Answer:
+        answer_id, question_id = instance.id, instance.question_id
+        transaction.on_commit(
+            lambda: trending.answer_deleted(answer_id, question_id))
+    elif sender is Question:
+        question_id = instance.id
+        transaction.on_commit(lambda: trending.question_deleted(question_id))
+
+
+@receiver(post_save)
+def add_related_question(sender, instance, created=False, **kwargs):
+    '''新问题加入相关问题索引, 事务提交后由celery任务更新'''
+    if created and sender is Question:
+        transaction.on_commit(lambda: update_related.delay(instance.id, True))
+
+
+@receiver(m2m_changed, sender=Question.topics.through)
+def update_related_question(sender, instance, action, reverse=False,
+                            pk_set=None, **kwargs):
+    '''问题话题变化后重新计算相关问题'''
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    question_ids = list(pk_set or []) if reverse else [instance.id]
+    for question_id in question_ids:
+        transaction.on_commit(
+            lambda question_id=question_id: update_related.delay(question_id))
+
+
+@receiver(post_delete)
+def remove_related_question(sender, instance, **kwargs):
+    '''问题删除后移出相关问题索引'''
+    if sender is Question:
+        question_id, title = instance.id, instance.title
+        transaction.on_commit(
+            lambda: related.question_deleted(question_id, title))
+
+
+def _invalidate_on_commit(tags):
+    if tags:
+        transaction.on_commit(lambda: tag_cache.invalidate(*set(tags)))
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_object_cache(sender, instance, **kwargs):
+    '''保存/删除后删除对象缓存'''
+    object_cache.invalidate(sender, instance.pk)
+
+
+@receiver(post_save)
+def invalidate_cache_on_save(sender, instance, update_fields=None, **kwargs):
+    '''保存后失效相关的缓存标签, 用户登录只更新last_login时不失效'''
+    if update_fields and set(update_fields) == {'last_login'}:
+        return
+    _invalidate_on_commit(cache_tags.tags_for(instance))
+
+
+@receiver(post_delete)
+def invalidate_cache_on_delete(sender, instance, **kwargs):
+    '''删除后失效相关的缓存标签'''
+    _invalidate_on_commit(cache_tags.tags_for(instance))
+
+
+@receiver(m2m_changed)
+def invalidate_cache_on_m2m_change(sender, instance, action, pk_set=None,
+                                   **kwargs):
+    '''问题话题, 用户关注话题变化后失效相关的缓存标签'''
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        _invalidate_on_commit(cache_tags.m2m_tags(sender, instance, pk_set))
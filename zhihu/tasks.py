@@ -0,0 +1,90 @@
+# 在zhihuer项目目录下,
+# cmd运行: celery -A zhihuer worker -l info 启动celery服务
+# cmd运行: celery -A zhihuer beat -l info 启动定时任务
+
+from helper import swr_cache
+from zhihuer import celery_app
+# 导入注册的防击穿缓存函数, 刷新任务中使用
+from . import counters, feed, leaderboard, aggregates, rankings, trending, \
+    related, rollups, toggles
+
+
+@celery_app.task
+def flush_read_nums():
+    '''问题浏览量批量写入数据库'''
+    return counters.flush_read_nums()
+
+
+@celery_app.task
+def drain_toggles():
+    '''延迟写入的点赞, 收藏, 关注操作批量写入数据库'''
+    return toggles.drain()
+
+
+@celery_app.task
+def refresh_rankings():
+    '''重新统计热门话题, 热门问题等物化排行'''
+    return rankings.refresh_all()
+
+
+@celery_app.task
+def build_trending():
+    '''全量统计热度排行, redis中不存在时触发, 结束后释放生成锁'''
+    try:
+        return trending.build()
+    finally:
+        swr_cache.release_lock(trending.BUILT_KEY)
+
+
+@celery_app.task
+def rebase_trending():
+    '''热度排行的基准时间移到当前时间, 删除热度衰减完的对象'''
+    return trending.rebase()
+
+
+@celery_app.task
+def rebuild_related():
+    '''全量统计相关问题索引, 结束后释放生成锁'''
+    try:
+        return related.build()
+    finally:
+        swr_cache.release_lock(related.BUILT_KEY)
+
+
+@celery_app.task
+def build_rollups():
+    '''全量统计点赞分桶, redis中不存在时触发, 结束后释放生成锁'''
+    try:
+        return rollups.build()
+    finally:
+        swr_cache.release_lock(rollups.BUILT_KEY)
+
+
+@celery_app.task
+def update_related(question_id, created=False):
+    '''新问题, 问题话题变化后增量更新相关问题索引'''
+    related.update(question_id, created)
+
+
+@celery_app.task
+def fanout_answer(answer_id):
+    '''新回答推送到关注者的首页动态'''
+    return feed.fanout_answer(answer_id)
+
+
+@celery_app.task
+def rebuild_feed(user_id):
+    '''关注或取消关注后重新生成用户首页动态'''
+    feed.rebuild_feed(user_id)
+
+
+@celery_app.task
+def refresh_cached(name, args):
+    '''后台刷新过期的防击穿缓存, 见helper.swr_cache'''
+    swr_cache.refresh(name, args)
+
+
+@celery_app.task
+def rebuild_leaderboard(topic_id):
+    '''后台重新统计过期的话题回答者排行'''
+    leaderboard.rebuild(topic_id)
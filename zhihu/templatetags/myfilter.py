@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
 from django.template import Library
+from django.utils.safestring import mark_safe
+
+from helper import page_cache
 
 register = Library()
 
@@ -16,3 +19,27 @@ def widget_add_class(value, arg):
 @register.filter(name='object_class_name')
 def object_class_name(value):
     return value.__class__.__name__
+
+
+# 替换当前请求的查询参数, 保留其他参数, value为None时删除该参数
+# 游标翻页链接使用, 如 ?{% query_replace request 'after' page.next_cursor %}
+@register.simple_tag(name='query_replace')
+def query_replace(request, key, value=None):
+    query = request.GET.copy()
+    if value is None:
+        query.pop(key, None)
+    else:
+        query[key] = value
+    return query.urlencode()
+
+
+# 与当前用户有关的页面片段, 共享页面缓存渲染时输出占位注释, 取出缓存后按当前用户填入
+# 否则直接渲染, 片段在zhihu.fragments中注册, 见helper.page_cache
+# 如 {% user_fragment 'follow_user_button' user_id=user.id css='btn-primary' %}
+@register.simple_tag(name='user_fragment', takes_context=True)
+def user_fragment(context, name, **kwargs):
+    request = context['request']
+    args = {key: str(value) for key, value in kwargs.items()}
+    if page_cache.is_shared_render(request):
+        return mark_safe(page_cache.fragment_marker(name, args))
+    return mark_safe(page_cache.render_fragments(request, name, [args])[0])
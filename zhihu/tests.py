@@ -1 +1,779 @@
-# Create your tests here.
+# -*- coding: utf-8 -*-
+
+# 查询数回归测试
+# 每个页面在两种数据规模下各请求一次(缓存为空)和再请求一次(缓存已生成),
+# 两种规模下一页中的行数不同, 查询数必须相同, 即每页的查询数与页面内容无关;
+# 失败时列出增加的SQL结构, 以及触发查询的模板行和代码行
+# 延迟写入等redis上的逻辑的行为测试
+# 测试时redis改用settings.CACHES中同一个redis的TEST_REDIS_DB号数据库,
+# 每次请求前清空, 不影响应用使用的数据库
+# 运行: python manage.py test zhihu
+
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+from collections import Counter
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django_redis import get_redis_connection
+
+from helper import metrics, locks
+from user.models import User, UserRelationship
+from zhihu import search_index, toggles, counters, trending, rollups, feed
+from zhihu.models import Topic, Question, Answer, AnswerComment, \
+    UserFollowQuestion, UserFollowAnswer, UserCollectAnswer, ReadNumsFlush
+
+# 两种数据规模, 不超过每页的条数(settings中最小的为TOPIC_PER_PAGE)
+SMALL = 2
+LARGE = 4
+# 测试使用的redis数据库号
+TEST_REDIS_DB = 15
+
+
+def _test_caches():
+    '''settings.CACHES中的redis数据库换成TEST_REDIS_DB'''
+    caches = {}
+    for alias, options in settings.CACHES.items():
+        options = dict(options)
+        options['LOCATION'] = re.sub(r'(/\d+)?$', '/%d' % TEST_REDIS_DB,
+                                     options['LOCATION'], count=1)
+        caches[alias] = options
+    return caches
+
+
+def _template_line():
+    '''正在渲染的模板名和行号, 不在模板渲染中时返回None'''
+    frame = sys._getframe()
+    while frame is not None:
+        if frame.f_code.co_name == 'render_annotated':
+            node = frame.f_locals.get('self')
+            token = getattr(node, 'token', None)
+            origin = getattr(node, 'origin', None)
+            if token is not None and origin is not None:
+                return '%s:%s' % (origin.template_name, token.lineno)
+        frame = frame.f_back
+    return None
+
+
+def _code_line():
+    '''本项目中执行查询的最内层代码行, 不包括本文件和性能统计的包装'''
+    skip = {__file__, metrics.__file__}
+    frame = sys._getframe()
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(settings.BASE_DIR) and \
+                filename not in skip and 'site-packages' not in filename:
+            return '%s:%s' % (os.path.relpath(filename, settings.BASE_DIR),
+                              frame.f_lineno)
+        frame = frame.f_back
+    return None
+
+
+def _user(name):
+    return User.objects.create(username=name, nickname=name,
+                               email='%s@example.com' % name)
+
+
+class RedisTestMixin(object):
+    '''使用TEST_REDIS_DB, 每个测试前清空'''
+
+    def setUp(self):
+        super(RedisTestMixin, self).setUp()
+        cache.clear()
+        get_redis_connection('default').flushdb()
+
+
+@override_settings(CACHES=_test_caches())
+class RedisTestCase(RedisTestMixin, TestCase):
+    pass
+
+
+@override_settings(CACHES=_test_caches())
+class RedisTransactionTestCase(RedisTestMixin, TransactionTestCase):
+    '''提交事务, transaction.on_commit注册的函数(信号中的索引, 排行更新)会执行'''
+
+
+class QueryRecorder(object):
+    '''记录执行的SQL结构和触发位置'''
+
+    def __init__(self):
+        self.shapes = Counter()
+        # SQL结构: Counter{(模板行, 代码行): 次数}
+        self.locations = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        shape = metrics.sql_shape(sql)
+        self.shapes[shape] += 1
+        self.locations.setdefault(shape, Counter())[
+            (_template_line(), _code_line())] += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self.wrapper = connection.execute_wrapper(self)
+        self.wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wrapper.__exit__(*exc_info)
+
+    def total(self):
+        return sum(self.shapes.values())
+
+
+# (url名, url参数名, GET参数), url参数由fixture中的对象填充
+VIEWS = [
+    ('index', (), {}),
+    ('explore', (), {}),
+    ('explore_recommend', (), {}),
+    ('topic_list', (), {}),
+    ('question_list', (), {}),
+    ('question_list', (), {'hot_after': ''}),
+    ('question_detail', ('question_id',), {}),
+    ('question_detail', ('question_id',), {'sort_type': 'time'}),
+    ('answer_detail', ('answer_id',), {}),
+    ('follow_question_user', ('question_id',), {}),
+    ('topic_detail', ('topic_id',), {}),
+    ('topic_detail', ('topic_id',), {'topic_type': 'wonderful'}),
+    ('topic_question', ('topic_id',), {}),
+    ('topic_answerer', ('topic_id',), {}),
+    ('follow_topic_user', ('topic_id',), {}),
+    ('user_home', ('user_id',), {}),
+    ('user_answer', ('user_id',), {}),
+    ('user_question', ('user_id',), {}),
+    ('user_collect_answer', ('user_id',), {}),
+    ('user_follow_topic', ('user_id',), {}),
+    ('user_follow_question', ('user_id',), {}),
+    ('user_follow_user', ('user_id',), {}),
+    ('user_followed_by_user', ('user_id',), {}),
+    ('user_topic_answer', ('user_id', 'topic_id'), {}),
+    ('search', (), {'search_type': 'question', 'keywords': 'python'}),
+    ('search', (), {'search_type': 'answer', 'keywords': 'python'}),
+    ('search', (), {'search_type': 'topic', 'keywords': 'python'}),
+    ('search', (), {'search_type': 'user', 'keywords': 'python'}),
+]
+
+
+@override_settings(SEARCH_INDEX_PATH=os.path.join(
+    tempfile.gettempdir(), 'zhihuer_test_search_index.sqlite3'))
+class QueryCountTest(RedisTestCase):
+    '''每个页面的查询数与页面中的行数无关'''
+
+    def setUp(self):
+        super(QueryCountTest, self).setUp()
+        self.owner = User.objects.create(username='owner', nickname='owner',
+                                         email='owner@example.com')
+        self.viewer = User.objects.create(username='viewer',
+                                          nickname='viewer',
+                                          email='viewer@example.com')
+        self.topic = Topic.objects.create(name='python')
+        self.question = Question.objects.create(title='python入门',
+                                                author=self.owner)
+        self.question.topics.add(self.topic)
+        self.answer = Answer.objects.create(question=self.question,
+                                            author=self.owner,
+                                            content='python answer')
+        # 话题回答排行前3为owner, active和一个其他用户, 两种规模下话题回答列表中
+        # 都有不在排行中的作者, 批量取出作者的查询数相同
+        active = User.objects.create(username='active', nickname='active',
+                                     email='active@example.com')
+        for i in range(2):
+            Answer.objects.create(question=self.question, author=active,
+                                  content='python active%d' % i)
+        self.size = 0
+
+    def grow(self, size):
+        '''每一页中的行数增加到size: 回答, 评论, 关注者, 话题, 问题, 收藏等'''
+        for i in range(self.size, size):
+            user = User.objects.create(username='python%d' % i,
+                                       nickname='python%d' % i,
+                                       email='user%d@example.com' % i)
+            topic = Topic.objects.create(name='python话题%d' % i)
+            topic.users.add(self.owner)
+            self.topic.users.add(user)
+            question = Question.objects.create(title='python问题%d' % i,
+                                               author=user)
+            question.topics.add(self.topic, topic)
+            own_question = Question.objects.create(
+                title='python提问%d' % i, author=self.owner)
+            own_question.topics.add(self.topic)
+            answer = Answer.objects.create(question=question,
+                                           author=self.owner,
+                                           content='python回答%d' % i)
+            Answer.objects.create(question=self.question, author=user,
+                                  content='python回答%d' % i)
+            AnswerComment.objects.create(user=user, answer=self.answer,
+                                         comment='评论%d' % i)
+            UserFollowQuestion.objects.create(user=self.owner,
+                                              question=question)
+            UserFollowQuestion.objects.create(user=user,
+                                              question=self.question)
+            UserCollectAnswer.objects.create(user=self.owner, answer=answer)
+            UserFollowAnswer.objects.create(user=user, answer=answer)
+            UserFollowAnswer.objects.create(user=self.viewer, answer=answer)
+            UserRelationship.objects.create(from_user=self.owner,
+                                            to_user=user)
+            UserRelationship.objects.create(from_user=user,
+                                            to_user=self.owner)
+        self.size = size
+        call_command('sync_counters', stdout=StringIO())
+        for doc_type in search_index.DOC_TYPES:
+            search_index.rebuild(doc_type)
+
+    def url(self, name, params):
+        kwargs = {
+            'question_id': self.question.id,
+            'answer_id': self.answer.id,
+            'topic_id': self.topic.id,
+            'user_id': self.owner.id,
+        }
+        return reverse(name, kwargs={param: kwargs[param] for param in params})
+
+    def measure(self, name, params, query):
+        '''缓存为空时和缓存生成后各请求一次, 返回两次的QueryRecorder'''
+        cache.clear()
+        get_redis_connection('default').flushdb()
+        recorders = []
+        for _ in range(2):
+            with QueryRecorder() as recorder:
+                response = self.client.get(self.url(name, params), query)
+            self.assertIn(response.status_code, (200, 302),
+                          '%s %s: %s' % (name, query, response.status_code))
+            recorders.append(recorder)
+        return recorders
+
+    def measure_all(self):
+        results = {}
+        for user in (None, self.viewer):
+            self.client.logout()
+            if user is not None:
+                self.client.force_login(user)
+            for name, params, query in VIEWS:
+                key = (name, tuple(sorted(query.items())), user is not None)
+                results[key] = self.measure(name, params, query)
+        return results
+
+    def describe(self, small, large):
+        '''查询次数增加的SQL结构和触发位置'''
+        lines = []
+        for shape, nums in large.shapes.items():
+            if nums <= small.shapes.get(shape, 0):
+                continue
+            lines.append('    %d -> %d: %s' % (small.shapes.get(shape, 0),
+                                                  nums, shape[:300]))
+            # 只列出次数增加的位置, 即逐行执行查询的位置
+            small_locations = small.locations.get(shape, Counter())
+            for (template, code), count in large.locations[shape].items():
+                if count > small_locations[(template, code)]:
+                    lines.append('      template: %s  code: %s' % (template,
+                                                                  code))
+        return '\n'.join(lines)
+
+    def test_query_count_independent_of_page_size(self):
+        self.grow(SMALL)
+        small_results = self.measure_all()
+        self.grow(LARGE)
+        large_results = self.measure_all()
+        failures = []
+        for key, small_recorders in small_results.items():
+            name, query, logged_in = key
+            for state, small, large in zip(('cold', 'warm'), small_recorders,
+                                           large_results[key]):
+                if large.total() > small.total():
+                    failures.append(
+                        '%s %s (%s, %s cache): %d queries with %d rows, '
+                        '%d with %d rows\n%s' % (
+                            name, dict(query),
+                            'logged in' if logged_in else 'anonymous', state,
+                            small.total(), SMALL, large.total(), LARGE,
+                            self.describe(small, large)))
+        if failures:
+            self.fail('\n\n' + '\n\n'.join(failures))
+
+
+@override_settings(TOGGLE_WRITE_BEHIND=True)
+class ToggleWriteBehindTest(RedisTestCase):
+    '''延迟写入的点赞: 按点击顺序生效, 中断后重放只写入一次, 锁丢失后不再处理'''
+
+    def setUp(self):
+        super(ToggleWriteBehindTest, self).setUp()
+        self.conn = get_redis_connection('default')
+        self.user = _user('voter')
+        author = _user('author')
+        question = Question.objects.create(title='toggle', author=author)
+        self.answer = Answer.objects.create(question=question, author=author,
+                                            content='toggle')
+
+    def assertFollowed(self, followed):
+        self.assertEqual(UserFollowAnswer.objects.filter(
+            user=self.user, answer=self.answer).count(), int(followed))
+        self.answer.refresh_from_db()
+        self.assertEqual(self.answer.follow_nums, int(followed))
+
+    def test_last_toggle_wins(self):
+        for delta in (1, -1, 1):
+            self.assertEqual(toggles.toggle(self.user, 'follow_answer',
+                                            self.answer), delta)
+        self.assertFollowed(False)
+        self.assertEqual(toggles.drain(), 3)
+        self.assertFollowed(True)
+        self.assertEqual(self.conn.llen(toggles.QUEUE_KEY), 0)
+        self.assertEqual(self.conn.llen(toggles.PROCESSING_KEY), 0)
+
+    def test_replay_after_crash(self):
+        toggles.toggle(self.user, 'follow_answer', self.answer)
+        apply = toggles.apply
+
+        def crash(ops):
+            # 写入数据库后, 删除toggles:processing前中断
+            apply(ops)
+            raise RuntimeError('crash')
+
+        with mock.patch.object(toggles, 'apply', side_effect=crash):
+            with self.assertRaises(RuntimeError):
+                toggles.drain()
+        self.assertEqual(self.conn.llen(toggles.PROCESSING_KEY), 1)
+        self.assertFollowed(True)
+        # 重放按最终状态写入, 不重复插入或计数
+        self.assertEqual(toggles.drain(), 1)
+        self.assertFollowed(True)
+        self.assertEqual(self.conn.llen(toggles.PROCESSING_KEY), 0)
+        self.assertEqual(toggles.drain(), 0)
+
+    def test_stale_token_does_nothing(self):
+        stale = locks.Lock(toggles.DRAIN_LOCK)
+        self.assertTrue(stale.acquire())
+        # 锁过期后被新的任务获得
+        self.conn.delete(stale.key)
+        current = locks.Lock(toggles.DRAIN_LOCK)
+        self.assertTrue(current.acquire())
+        toggles.toggle(self.user, 'follow_answer', self.answer)
+        self.assertEqual(toggles.drain(), 0)
+
+        move_batch = self.conn.register_script(toggles.MOVE_BATCH_SCRIPT)
+        finish_batch = self.conn.register_script(toggles.FINISH_BATCH_SCRIPT)
+        keys = [stale.key, toggles.QUEUE_KEY, toggles.PROCESSING_KEY]
+        self.assertIsNone(move_batch(keys=keys, args=[stale.token, 10]))
+        self.assertEqual(self.conn.llen(toggles.QUEUE_KEY), 1)
+        ops = move_batch(keys=keys, args=[current.token, 10])
+        self.assertEqual([json.loads(op.decode())['followed'] for op in ops],
+                         [True])
+        self.assertEqual(finish_batch(
+            keys=[stale.key, toggles.PROCESSING_KEY],
+            args=[stale.token, stale.timeout_ms]), 0)
+        self.assertEqual(self.conn.llen(toggles.PROCESSING_KEY), 1)
+        self.assertFalse(stale.extend())
+        self.assertFalse(stale.release())
+        self.assertEqual(self.conn.get(current.key).decode(), current.token)
+        self.assertFollowed(False)
+
+
+class ReadNumsFlushTest(RedisTestCase):
+    '''redis中累加的浏览量写入数据库, 中断后重试不重复累加'''
+
+    def setUp(self):
+        super(ReadNumsFlushTest, self).setUp()
+        self.conn = get_redis_connection('default')
+        author = _user('asker')
+        self.questions = [Question.objects.create(title='read%d' % i,
+                                                  author=author)
+                          for i in range(2)]
+
+    def read(self, question, nums):
+        for _ in range(nums):
+            counters.incr_read_nums(question.id)
+
+    def assertReadNums(self, *nums):
+        for question, expected in zip(self.questions, nums):
+            question.refresh_from_db()
+            self.assertEqual(question.read_nums, expected)
+
+    def test_flush(self):
+        self.read(self.questions[0], 3)
+        self.read(self.questions[1], 5)
+        self.assertEqual(counters.flush_read_nums(), 2)
+        self.assertReadNums(3, 5)
+        self.assertEqual(counters.flush_read_nums(), 0)
+        self.assertReadNums(3, 5)
+
+    def test_retry_after_commit(self):
+        self.read(self.questions[0], 3)
+        # 数据库事务提交后, 删除redis中的这一批前中断
+        with mock.patch.object(type(self.conn), 'delete',
+                               side_effect=RuntimeError('crash')):
+            with self.assertRaises(RuntimeError):
+                counters.flush_read_nums()
+        self.assertReadNums(3)
+        self.assertTrue(self.conn.exists(counters.READ_NUMS_FLUSHING_KEY))
+        self.assertEqual(ReadNumsFlush.objects.count(), 1)
+        # 中断后的新浏览量在下一批写入
+        self.read(self.questions[0], 2)
+        self.assertEqual(counters.flush_read_nums(), 0)
+        self.assertReadNums(3)
+        self.assertFalse(self.conn.exists(counters.READ_NUMS_FLUSHING_KEY))
+        self.assertEqual(counters.flush_read_nums(), 1)
+        self.assertReadNums(5)
+
+
+class SearchIndexTest(RedisTransactionTestCase):
+    '''BM25排序, 保存/删除时由信号增量更新索引'''
+
+    def setUp(self):
+        super(SearchIndexTest, self).setUp()
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir)
+        index_settings = override_settings(
+            SEARCH_INDEX_PATH=os.path.join(index_dir, 'index.sqlite3'))
+        index_settings.enable()
+        self.addCleanup(index_settings.disable)
+        author = _user('writer')
+        self.often = Question.objects.create(
+            title='python', content='python python', author=author)
+        self.once = Question.objects.create(
+            title='python入门', content='数据库', author=author)
+        self.other = Question.objects.create(title='数据库', author=author)
+
+    def test_ranking(self):
+        self.assertEqual(search_index.search('question', 'python'),
+                         [self.often.id, self.once.id])
+        # 短文档中的低频词得分高, 同时包含两个词的排在只包含python的前面
+        self.assertEqual(search_index.search('question', 'Python 数据库'),
+                         [self.other.id, self.once.id, self.often.id])
+        self.assertEqual(search_index.search('question', 'golang'), [])
+
+    def test_update_removes_old_terms(self):
+        self.assertIn(self.often.id, search_index.search('question', 'python'))
+        self.often.title = 'golang'
+        self.often.content = ''
+        self.often.save()
+        self.assertEqual(search_index.search('question', 'python'),
+                         [self.once.id])
+        self.assertEqual(search_index.search('question', 'golang'),
+                         [self.often.id])
+
+    def test_delete_removes_doc(self):
+        self.assertIn(self.often.id, search_index.search('question', 'python'))
+        self.often.delete()
+        self.assertEqual(search_index.search('question', 'python'),
+                         [self.once.id])
+
+    def test_search_view(self):
+        response = self.client.get(reverse('search'), {
+            'search_type': 'question', 'keywords': 'python'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([question.id for question in
+                          response.context['search_results_page']],
+                         [self.often.id, self.once.id])
+
+
+class TrendingTest(RedisTestCase):
+    '''热度按事件时间衰减, rebase后排序不变'''
+
+    NOW = datetime(2026, 3, 10, 12)
+
+    def setUp(self):
+        super(TrendingTest, self).setUp()
+        self.conn = get_redis_connection('default')
+        self.question = Question.objects.create(title='trending',
+                                                author=_user('poster'))
+        self.conn.set(trending.EPOCH_KEY,
+                      int((self.NOW - timedelta(days=1)).timestamp()))
+
+    def upvote(self, answer_id, when, times=1):
+        for _ in range(times):
+            trending.record('upvote', self.question.id, answer_id, when=when)
+
+    def ranking(self):
+        return self.conn.zrevrange(trending._answers_key(), 0, -1,
+                                   withscores=True)
+
+    def test_decay(self):
+        # 3天前的4个点赞衰减到1/8, 少于现在的1个点赞
+        self.upvote(1, self.NOW - timedelta(days=3), times=4)
+        self.upvote(2, self.NOW)
+        self.assertEqual([int(answer_id) for answer_id, score in
+                          self.ranking()], [2, 1])
+        scores = dict(self.ranking())
+        self.assertAlmostEqual(scores[b'1'] / scores[b'2'], 0.5)
+
+    def test_rebase_keeps_order(self):
+        self.upvote(1, self.NOW - timedelta(days=2), times=3)
+        self.upvote(2, self.NOW)
+        self.upvote(3, self.NOW - timedelta(hours=1), times=2)
+        before = self.ranking()
+        rebase_time = (self.NOW + timedelta(days=5)).timestamp()
+        with mock.patch.object(trending, 'time',
+                               mock.Mock(time=lambda: rebase_time)):
+            trending.rebase()
+        after = self.ranking()
+        self.assertEqual([answer_id for answer_id, score in after],
+                         [answer_id for answer_id, score in before])
+        for (answer_id, old), (_, new) in zip(before, after):
+            self.assertAlmostEqual(new / old, 2 ** -6)
+        self.assertEqual(float(self.conn.get(trending.EPOCH_KEY)),
+                         rebase_time)
+
+
+class RollupWindowTest(RedisTestCase):
+    '''时间窗口合并的分桶, 跨过0点'''
+
+    # 0点刚过, 最近24小时和最近7天跨过日期
+    NOW = datetime(2026, 3, 10, 1, 30)
+
+    def setUp(self):
+        super(RollupWindowTest, self).setUp()
+        self.conn = get_redis_connection('default')
+
+    def upvote(self, answer_id, when):
+        pipe = self.conn.pipeline()
+        rollups._add(pipe, answer_id, 1, when, now=self.NOW)
+        pipe.execute()
+
+    def window(self, name):
+        key = rollups.window_key(self.conn, name, now=self.NOW)
+        return {int(answer_id): score for answer_id, score in
+                self.conn.zrange(key, 0, -1, withscores=True)}
+
+    def test_bucket_keys(self):
+        end = datetime(2026, 3, 10, 2)
+        self.assertEqual(rollups._bucket_keys(
+            rollups.WINDOWS['today'](self.NOW), end),
+            ['upvotes:day:20260310'])
+        self.assertEqual(rollups._bucket_keys(
+            rollups.WINDOWS['24h'](self.NOW), end),
+            ['upvotes:hour:202603%04d' % hour for hour in range(902, 924)] +
+            ['upvotes:day:20260310'])
+        self.assertEqual(rollups._bucket_keys(
+            rollups.WINDOWS['7d'](self.NOW), end),
+            ['upvotes:hour:202603%04d' % hour for hour in range(302, 324)] +
+            ['upvotes:day:202603%02d' % day for day in range(4, 11)])
+
+    def test_windows(self):
+        # 昨天窗口开始前一小时, 只在7天窗口中
+        self.upvote(1, datetime(2026, 3, 9, 1, 30))
+        self.upvote(2, datetime(2026, 3, 9, 2, 10))
+        self.upvote(3, datetime(2026, 3, 10, 0, 20))
+        # 7天窗口开始之前
+        self.upvote(4, datetime(2026, 3, 3, 1, 0))
+        self.upvote(3, datetime(2026, 3, 10, 1, 10))
+        self.assertEqual(self.window('today'), {3: 2})
+        self.assertEqual(self.window('24h'), {2: 1, 3: 2})
+        self.assertEqual(self.window('7d'), {1: 1, 2: 1, 3: 2})
+
+
+class SharedPageCacheTest(RedisTestCase):
+    '''共享缓存的页面中不能出现上一个访问者的内容'''
+
+    def setUp(self):
+        super(SharedPageCacheTest, self).setUp()
+        self.owner = _user('owner')
+        self.fan = _user('fan')
+        self.visitor = _user('visitor')
+        UserRelationship.objects.create(from_user=self.fan, to_user=self.owner)
+        self.url = reverse('user_home', args=(self.owner.id,))
+
+    def get(self, user):
+        self.client.force_login(user)
+        return self.client.get(self.url).content.decode()
+
+    def test_no_leak_between_users(self):
+        fan_page = self.get(self.fan)
+        self.assertIn('取消关注', fan_page)
+        self.assertIn(reverse('user_home', args=(self.fan.id,)), fan_page)
+        self.assertIn('>fan', fan_page)
+
+        visitor_page = self.get(self.visitor)
+        self.assertNotIn('取消关注', visitor_page)
+        self.assertIn('关注 TA', visitor_page)
+        self.assertNotIn(reverse('user_home', args=(self.fan.id,)),
+                         visitor_page)
+        self.assertNotIn('>fan', visitor_page)
+        self.assertIn('>visitor', visitor_page)
+        self.assertIn(reverse('user_home', args=(self.visitor.id,)),
+                      visitor_page)
+        # 两次访问共用一份缓存
+        self.assertEqual(len(get_redis_connection('default').keys(
+            '*shared_page:user_home:*')), 1)
+        self.assertNotIn('user-fragment', visitor_page)
+
+
+@override_settings(METRICS_TOKEN='secret', METRICS_SAMPLE_RATE=1)
+class MetricsTest(RedisTestCase):
+    '''/metrics/只允许管理员和带token的请求, N+1查询计入统计'''
+
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        self.url = reverse('metrics')
+
+    def test_forbidden(self):
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.assertEqual(self.client.get(
+            self.url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 404)
+        self.client.force_login(_user('member'))
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_empty_token(self):
+        with override_settings(METRICS_TOKEN=''):
+            self.assertEqual(self.client.get(
+                self.url, HTTP_AUTHORIZATION='Bearer ').status_code, 404)
+
+    def test_allowed(self):
+        self.assertEqual(self.client.get(
+            self.url, HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+        staff = _user('staff')
+        staff.is_staff = True
+        staff.save()
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+    def test_n_plus_one(self):
+        users = [_user('user%d' % index) for index in
+                 range(metrics.N_PLUS_ONE_THRESHOLD + 1)]
+
+        def view(request):
+            request.resolver_match = mock.Mock(url_name='user_list')
+            for user in users:
+                User.objects.get(id=user.id)
+            return None
+
+        metrics.MetricsMiddleware(view)(mock.Mock())
+        content = self.client.get(
+            self.url, HTTP_AUTHORIZATION='Bearer secret').content.decode()
+        lines = [line for line in content.splitlines() if
+                 line.startswith('zhihuer_n_plus_one_total{view="user_list"')]
+        self.assertEqual(len(lines), 1)
+        self.assertIn('sql="SELECT \\"user_user\\".\\"id\\"', lines[0])
+        self.assertTrue(lines[0].endswith(' 1'))
+        self.assertIn('zhihuer_request_queries_count{view="user_list"} 1',
+                      content)
+
+
+class FeedTest(RedisTestCase):
+    '''首页动态: 推送关注者不多的用户和话题的回答, 合并拉取的回答'''
+
+    def setUp(self):
+        super(FeedTest, self).setUp()
+        self.follower = _user('follower')
+        self.stranger = _user('stranger')
+        self.author = _user('author')
+        self.topic = Topic.objects.create(name='python')
+        toggles.toggle(self.follower, 'follow_user', self.author)
+        self.follow_topic(self.follower, self.topic)
+
+    def follow_topic(self, user, topic):
+        self.client.force_login(user)
+        response = self.client.get(reverse('follow_topic', args=(topic.id,)))
+        self.assertEqual(response.json()['status'], 'success')
+
+    def answer(self, author, topic=None):
+        question = Question.objects.create(title='feed', author=author)
+        if topic:
+            question.topics.add(topic)
+        answer = Answer.objects.create(question=question, author=author,
+                                       content='feed')
+        # 视图中提交后由celery任务推送
+        feed.fanout_answer(answer.id)
+        return answer.id
+
+    def feed_ids(self, user, cursor=None, per_page=10):
+        user.refresh_from_db()
+        page = feed.get_feed_page(user, cursor, per_page)
+        return [answer.id for answer in page.object_list], page.next_cursor
+
+    def test_fanout(self):
+        # 先生成动态, 之后的回答通过推送加入
+        self.assertEqual(self.feed_ids(self.follower), ([], None))
+        by_author = self.answer(self.author)
+        by_topic = self.answer(self.stranger, self.topic)
+        other = self.answer(self.stranger)
+        self.assertEqual(self.feed_ids(self.follower),
+                         ([by_topic, by_author], None))
+        self.assertNotIn(other, self.feed_ids(self.follower)[0])
+        # 没有关注回答者和话题的用户看不到
+        self.follow_topic(self.stranger, Topic.objects.create(name='go'))
+        self.assertEqual(self.feed_ids(self.stranger), ([], None))
+
+    @override_settings(FEED_FANOUT_LIMIT=1)
+    def test_merge_pulled(self):
+        # 关注者超过FEED_FANOUT_LIMIT的用户不推送, 读取时拉取
+        famous = _user('famous')
+        toggles.toggle(self.follower, 'follow_user', famous)
+        toggles.toggle(self.stranger, 'follow_user', famous)
+        answer_ids = [self.answer(author) for author in
+                      (self.author, famous, self.author, famous)]
+        pushed = get_redis_connection('default').zrange(
+            feed._keys(self.follower.id)[0], 0, -1)
+        self.assertEqual([int(answer_id) for answer_id in pushed],
+                         answer_ids[::2])
+        first, cursor = self.feed_ids(self.follower, per_page=3)
+        self.assertEqual(first, answer_ids[:0:-1])
+        self.assertEqual(self.feed_ids(self.follower, cursor, per_page=3),
+                         (answer_ids[:1], None))
+
+
+class SyncCountersTest(RedisTestCase):
+    '''F表达式维护的计数与重新统计的结果一致, 计数偏差由sync_counters修正'''
+
+    def setUp(self):
+        super(SyncCountersTest, self).setUp()
+        self.author = _user('author')
+        self.voter = _user('voter')
+        self.question = Question.objects.create(title='counters',
+                                                author=self.author)
+        self.answers = []
+        for index in range(2):
+            answer = Answer.objects.create(question=self.question,
+                                           author=self.author,
+                                           content='answer%d' % index)
+            counters.answer_created(answer)
+            toggles.toggle(self.voter, 'follow_answer', answer)
+            toggles.toggle(self.voter, 'collect_answer', answer)
+            self.answers.append(answer)
+        toggles.toggle(self.voter, 'follow_question', self.question)
+        toggles.toggle(self.voter, 'follow_user', self.author)
+        # 删除回答同时扣除级联删除的点赞, 收藏带来的计数
+        self.client.force_login(self.author)
+        self.client.get(reverse('delete_answer'),
+                        {'answer_id': self.answers[0].id})
+
+    def counts(self):
+        answer = Answer.objects.get(id=self.answers[1].id)
+        question = Question.objects.get(id=self.question.id)
+        author = User.objects.get(id=self.author.id)
+        voter = User.objects.get(id=self.voter.id)
+        return {
+            'answer.follow_nums': answer.follow_nums,
+            'answer.collect_nums': answer.collect_nums,
+            'question.answer_nums': question.answer_nums,
+            'question.follow_nums': question.follow_nums,
+            'author.answer_nums': author.answer_nums,
+            'author.answer_by_followed_nums': author.answer_by_followed_nums,
+            'author.answer_by_collected_nums': author.answer_by_collected_nums,
+            'author.followed_by_user_nums': author.followed_by_user_nums,
+            'voter.collect_answer_nums': voter.collect_answer_nums,
+            'voter.follow_question_nums': voter.follow_question_nums,
+            'voter.follow_user_nums': voter.follow_user_nums,
+        }
+
+    def test_sync(self):
+        self.assertFalse(Answer.objects.filter(id=self.answers[0].id).exists())
+        expected = self.counts()
+        self.assertEqual(set(expected.values()), {1})
+
+        User.objects.filter(id=self.author.id).update(answer_nums=99)
+        Answer.objects.filter(id=self.answers[1].id).update(follow_nums=-3)
+        Question.objects.filter(id=self.question.id).update(answer_nums=0)
+        self.assertNotEqual(self.counts(), expected)
+
+        call_command('sync_counters', stdout=StringIO())
+        self.assertEqual(self.counts(), expected)
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+# 点赞, 收藏, 关注问题, 关注用户的切换
+# 默认同步写入: 一个事务中删除或插入关注记录, 更新计数字段
+# settings.TOGGLE_WRITE_BEHIND为True时延迟写入(write-behind):
+#   视图只执行一个lua脚本, 原子地修改zhihu.follow_state中的关注集合,
+#   并把操作追加到redis队列 toggles:queue, 不访问数据库;
+#   celery beat定时任务(drain_toggles)按队列顺序取出一批操作, 每个(关系, 用户, 对象)
+#   只保留最后一次操作, 与数据库中的记录比较后bulk_create/批量删除, 并更新计数字段;
+#   同一时间只有一个任务写入, 同一个(用户, 对象)的操作按点击顺序生效
+# 崩溃恢复: 取出的操作先移到 toggles:processing, 写入数据库后才删除;
+#   任务中断时下次运行先重放这一批, 按最终状态写入, 重放不会重复插入或重复计数
+# 写入任务持有带token的锁(helper.locks), 每批写入前延长; 移入和删除
+#   toggles:processing都在lua脚本中先检查锁, 锁已过期被其他任务获得时,
+#   原任务不再移入或删除, 这一批由新的持有者重放
+# bulk_create不发送post_save信号, 取出新记录后手动发送, 用户动态, 点赞分桶,
+# 热度排行, 缓存失效与同步写入一致; 新记录的add_time为写入数据库的时间
+
+import json
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_save
+from django_redis import get_redis_connection
+
+from helper import object_cache, locks
+from user.models import User
+from . import counters, leaderboard, follow_state, tasks
+from .models import Question, Answer
+
+QUEUE_KEY = 'toggles:queue'
+PROCESSING_KEY = 'toggles:processing'
+DRAIN_LOCK = 'toggles:drain'
+# 锁的过期时间(秒), 每批写入前延长, 一批的写入时间远小于它
+DRAIN_LOCK_TIMEOUT = 60
+# 每批写入数据库的操作数
+BATCH_SIZE = 500
+# 每次任务最多写入的批数, 其余的留给下一次任务, 不超过锁的时间
+MAX_BATCHES = 20
+
+# 集合不存在时返回nil, 由调用者生成集合后重试
+# 已关注时移出集合, 否则加入集合; 操作追加到队列, 返回计数变化
+TOGGLE_SCRIPT = '''
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+if redis.call('SREM', KEYS[1], ARGV[1]) == 1 then
+    redis.call('LPUSH', KEYS[2], ARGV[3])
+    return -1
+end
+if ARGV[2] == '' then
+    return 0
+end
+redis.call('SADD', KEYS[1], ARGV[1])
+redis.call('LPUSH', KEYS[2], ARGV[2])
+return 1
+'''
+
+# 仍持有锁时从队列移入最多ARGV[2]个操作(先进先出), 锁已丢失时返回nil
+MOVE_BATCH_SCRIPT = '''
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return false
+end
+local ops = {}
+for i = 1, tonumber(ARGV[2]) do
+    local op = redis.call('RPOPLPUSH', KEYS[2], KEYS[3])
+    if not op then
+        break
+    end
+    ops[#ops + 1] = op
+end
+return ops
+'''
+
+# 仍持有锁时删除已写入的一批并延长锁, 锁已丢失时不删除, 返回0
+FINISH_BATCH_SCRIPT = '''
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[2])
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+return 1
+'''
+
+
+def _answer_followed(user, answer, delta):
+    counters.answer_followed(answer, delta)
+    leaderboard.answer_followed(answer, delta)
+
+
+def _answer_collected(user, answer, delta):
+    counters.answer_collected(answer, user, delta)
+
+
+def _question_followed(user, question, delta):
+    counters.question_followed(question, user, delta)
+
+
+def _user_followed(user, to_user, delta):
+    counters.user_followed(user, to_user, delta)
+    # 关注变化后重新生成首页动态
+    transaction.on_commit(lambda: tasks.rebuild_feed.delay(user.id))
+
+
+# 关系: (对象模型, 记录变化后调用的函数, 函数是否需要用户)
+# 不需要用户的函数在延迟写入时每个对象只调用一次, 参数为这一批的计数变化之和
+TOGGLES = {
+    'follow_answer': (Answer, _answer_followed, False),
+    'collect_answer': (Answer, _answer_collected, True),
+    'follow_question': (Question, _question_followed, True),
+    'follow_user': (User, _user_followed, True),
+}
+
+
+def write_behind():
+    return getattr(settings, 'TOGGLE_WRITE_BEHIND', False)
+
+
+def _op(relation, user_id, object_id, followed):
+    return json.dumps({'relation': relation, 'user_id': user_id,
+                       'object_id': object_id, 'followed': followed})
+
+
+def _run_script(relation, user_id, object_id, add):
+    '''执行TOGGLE_SCRIPT, add为False时只取消关注'''
+    conn = get_redis_connection('default')
+    script = conn.register_script(TOGGLE_SCRIPT)
+    args = [object_id,
+            _op(relation, user_id, object_id, True) if add else '',
+            _op(relation, user_id, object_id, False),
+            follow_state.FOLLOW_STATE_TIMEOUT]
+    while True:
+        key = follow_state.ensure_built(relation, user_id)
+        delta = script(keys=[key, QUEUE_KEY], args=args)
+        if delta is not None:
+            return int(delta)
+
+
+def toggle(user, relation, obj):
+    '''关注/取消关注, 返回计数变化: 1为关注, -1为取消关注, 0为状态不变'''
+    if write_behind():
+        return _run_script(relation, user.id, obj.id, True)
+    with transaction.atomic():
+        delta = follow_state.toggle(user.id, relation, obj.id)
+        if delta:
+            TOGGLES[relation][1](user, obj, delta)
+    return delta
+
+
+def unfollow(user, relation, obj):
+    '''取消关注, 返回删除的记录数, 没有关注时返回0'''
+    if write_behind():
+        return -_run_script(relation, user.id, obj.id, False)
+    with transaction.atomic():
+        deleted = follow_state.unfollow(user.id, relation, obj.id)
+        if deleted:
+            TOGGLES[relation][1](user, obj, -deleted)
+    return deleted
+
+
+def _apply_relation(relation, states):
+    '''states为{(用户id, 对象id): 是否关注}, 按最终状态写入数据库'''
+    model, user_field, object_field = follow_state.RELATIONS[relation]
+    target_model, changed, per_user = TOGGLES[relation]
+    users = object_cache.get_many(User, {pair[0] for pair in states})
+    objs = object_cache.get_many(target_model, {pair[1] for pair in states})
+    # 用户或对象已删除的操作丢弃
+    states = {pair: followed for pair, followed in states.items() if
+              pair[0] in users and pair[1] in objs}
+    if not states:
+        return
+
+    def pairs_filter(pairs):
+        return reduce(or_, [Q(**{user_field: user_id, object_field: object_id})
+                            for user_id, object_id in pairs])
+
+    existing = set(model.objects.filter(pairs_filter(states)).values_list(
+        user_field, object_field))
+    to_add = [pair for pair, followed in states.items() if
+              followed and pair not in existing]
+    to_remove = [pair for pair, followed in states.items() if
+                 not followed and pair in existing]
+    if to_add:
+        model.objects.bulk_create([
+            model(**{user_field: user_id, object_field: object_id}) for
+            user_id, object_id in to_add])
+        for record in model.objects.filter(pairs_filter(to_add)):
+            post_save.send(sender=model, instance=record, created=True,
+                           update_fields=None, raw=False, using='default')
+    if to_remove:
+        # 逐条发送post_delete信号, 与同步写入一致
+        model.objects.filter(pairs_filter(to_remove)).delete()
+    deltas = [(pair, 1) for pair in to_add] + [(pair, -1) for pair in
+                                               to_remove]
+    if per_user:
+        for (user_id, object_id), delta in deltas:
+            changed(users[user_id], objs[object_id], delta)
+    else:
+        object_deltas = {}
+        for (user_id, object_id), delta in deltas:
+            object_deltas[object_id] = object_deltas.get(object_id, 0) + delta
+        for object_id, delta in object_deltas.items():
+            if delta:
+                changed(None, objs[object_id], delta)
+
+
+def apply(ops):
+    '''按顺序写入一批操作, 每个(关系, 用户, 对象)只保留最后一次操作'''
+    states = {}
+    for op in ops:
+        states.setdefault(op['relation'], {})[
+            (op['user_id'], op['object_id'])] = op['followed']
+    with transaction.atomic():
+        for relation, relation_states in states.items():
+            _apply_relation(relation, relation_states)
+
+
+def drain():
+    '''把队列中的操作写入数据库, 返回写入的操作数, 由celery beat定时调用'''
+    lock = locks.Lock(DRAIN_LOCK, DRAIN_LOCK_TIMEOUT)
+    if not lock.acquire():
+        return 0
+    try:
+        conn = get_redis_connection('default')
+        move_batch = conn.register_script(MOVE_BATCH_SCRIPT)
+        finish_batch = conn.register_script(FINISH_BATCH_SCRIPT)
+        nums = 0
+        # 上次中断的一批先重放, rpoplpush移入时新的在前, ops按先后顺序
+        ops = list(reversed(conn.lrange(PROCESSING_KEY, 0, -1)))
+        for _ in range(MAX_BATCHES):
+            # 锁已丢失时其他任务可能正在处理, 停止
+            if not lock.extend():
+                break
+            if not ops:
+                ops = move_batch(keys=[lock.key, QUEUE_KEY, PROCESSING_KEY],
+                                 args=[lock.token, BATCH_SIZE])
+                if not ops:
+                    break
+            apply([json.loads(op.decode()) for op in ops])
+            if not finish_batch(keys=[lock.key, PROCESSING_KEY],
+                                args=[lock.token, lock.timeout_ms]):
+                break
+            nums += len(ops)
+            ops = None
+        return nums
+    finally:
+        lock.release()
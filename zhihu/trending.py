@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+# 热度排行(随时间衰减)
+# 点赞, 收藏, 浏览, 新回答等事件发生时给回答/问题加分, 分数按发生时间指数衰减,
+# 每过HALF_LIFE减半, 新内容可以超过早期的热门内容:
+#   加分 = 权重 * 2 ^ ((事件时间 - 基准时间) / HALF_LIFE)
+# 所有对象以同样的速度衰减, 只需给新事件乘以增长的系数, 排序与衰减后的分数一致,
+# 事件发生时用zincrby增量更新; 取消点赞/收藏时按原事件时间扣除, 回答, 问题删除后移出排行;
+# 浏览由counters.flush_read_nums随浏览量批量写入时一起加分(record_reads)
+# 系数随时间指数增长, 定时任务(rebase_trending)把基准时间移到当前时间,
+# 同时按比例缩小已有分数, 删除衰减到MIN_SCORE以下的对象
+# 全站和每个话题各保存一个回答排行和问题排行(redis有序集合), 只保留前SIZE个:
+#   trending:answers, trending:questions
+#   trending:answers:topic:<话题id>, trending:questions:topic:<话题id>
+
+import time
+from datetime import datetime, timedelta
+
+from django_redis import get_redis_connection
+
+from helper import object_cache, swr_cache, tag_cache
+from .models import Question, Answer, UserFollowAnswer, UserCollectAnswer
+from .rankings import SortedSetList
+from . import tasks
+
+# 分数半衰期
+HALF_LIFE = 24 * 60 * 60
+# 全站排行, 话题排行保留的对象数
+GLOBAL_SIZE = 1000
+TOPIC_SIZE = 200
+# 衰减到这个分数以下的对象在rebase时删除
+MIN_SCORE = 0.01
+# 没有排行时(首次部署, redis数据清除后)从数据库统计最近BUILD_DAYS天的事件
+BUILD_DAYS = 14
+# answered_questions每次从排行中取出的问题数
+SCAN_SIZE = 20
+
+EPOCH_KEY = 'trending:epoch'
+BUILT_KEY = 'trending_built'
+
+# 事件: (回答权重, 问题权重)
+WEIGHTS = {
+    'upvote': (1.0, 0.5),
+    'collect': (2.0, 1.0),
+    'answer': (1.0, 1.0),
+    'question': (0, 1.0),
+    'read': (0, 0.1),
+}
+
+
+def _answers_key(topic_id=None):
+    if topic_id is None:
+        return 'trending:answers'
+    return 'trending:answers:topic:%s' % topic_id
+
+
+def _questions_key(topic_id=None):
+    if topic_id is None:
+        return 'trending:questions'
+    return 'trending:questions:topic:%s' % topic_id
+
+
+def _timestamp(when):
+    if when is None:
+        return time.time()
+    return when.timestamp()
+
+
+def _epoch(conn):
+    epoch = conn.get(EPOCH_KEY)
+    if epoch is None:
+        conn.setnx(EPOCH_KEY, int(time.time()))
+        epoch = conn.get(EPOCH_KEY)
+    return float(epoch)
+
+
+def _boost(epoch, when):
+    return 2 ** ((_timestamp(when) - epoch) / HALF_LIFE)
+
+
+def question_topic_ids(question_id):
+    '''问题所属的话题id, 话题变化时由question标签失效'''
+    return tag_cache.get_or_set(
+        'question_topic_ids:%s' % question_id, ['question:%s' % question_id],
+        lambda: list(Question.topics.through.objects.filter(
+            question_id=question_id).values_list('topic_id', flat=True)))
+
+
+def _incr(pipe, key, member, score, size):
+    pipe.zincrby(key, member, score)
+    # 只保留前size个, 取消事件扣除后分数不为正的对象删除
+    pipe.zremrangebyrank(key, 0, -size - 1)
+    pipe.zremrangebyscore(key, '-inf', 0)
+
+
+def _add(pipe, scores, topic_ids, answer_id, question_id):
+    '''scores为(回答加分, 问题加分), 同时更新全站和话题排行'''
+    answer_score, question_score = scores
+    for topic_id in [None] + list(topic_ids):
+        size = GLOBAL_SIZE if topic_id is None else TOPIC_SIZE
+        if answer_id is not None and answer_score:
+            _incr(pipe, _answers_key(topic_id), answer_id, answer_score, size)
+        if question_score:
+            _incr(pipe, _questions_key(topic_id), question_id, question_score,
+                  size)
+
+
+def record(event, question_id, answer_id=None, when=None, sign=1):
+    '''记录一个事件, when为事件发生时间, 默认为当前时间; sign=-1时扣除'''
+    conn = get_redis_connection('default')
+    boost = _boost(_epoch(conn), when) * sign
+    scores = [weight * boost for weight in WEIGHTS[event]]
+    pipe = conn.pipeline()
+    _add(pipe, scores, question_topic_ids(question_id), answer_id, question_id)
+    pipe.execute()
+
+
+def record_reads(read_nums):
+    '''批量记录问题的浏览, read_nums为 问题id: 浏览次数, 按当前时间加分'''
+    conn = get_redis_connection('default')
+    boost = _boost(_epoch(conn), None)
+    topic_ids = {}
+    for question_id, topic_id in Question.topics.through.objects.filter(
+            question_id__in=list(read_nums)).values_list('question_id',
+                                                         'topic_id'):
+        topic_ids.setdefault(question_id, []).append(topic_id)
+    pipe = conn.pipeline()
+    for question_id, nums in read_nums.items():
+        scores = [weight * boost * nums for weight in WEIGHTS['read']]
+        _add(pipe, scores, topic_ids.get(question_id, []), None, question_id)
+    pipe.execute()
+
+
+def answer_deleted(answer_id, question_id):
+    '''回答删除后移出全站和所属问题话题的回答排行'''
+    pipe = get_redis_connection('default').pipeline()
+    for topic_id in [None] + list(question_topic_ids(question_id)):
+        pipe.zrem(_answers_key(topic_id), answer_id)
+    pipe.execute()
+
+
+def question_deleted(question_id):
+    '''问题删除后移出全站和全部话题的问题排行, 删除时话题关系已删除, 遍历话题排行'''
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    pipe.zrem(_questions_key(), question_id)
+    for key in conn.scan_iter(_questions_key('*')):
+        pipe.zrem(key, question_id)
+    pipe.execute()
+
+
+def answer_event(event, answer_id, when=None, sign=1):
+    '''回答的点赞, 收藏事件, 回答同时给问题加分'''
+    answer = object_cache.get(Answer, answer_id)
+    if answer is not None:
+        record(event, answer.question_id, answer_id, when, sign)
+
+
+def rebase():
+    '''基准时间移到当前时间, 按比例缩小已有分数, 删除衰减到MIN_SCORE以下的对象
+
+    由celery beat定时调用, 避免加分系数过大
+    '''
+    conn = get_redis_connection('default')
+    old_epoch = _epoch(conn)
+    new_epoch = int(time.time())
+    factor = 2 ** ((old_epoch - new_epoch) / HALF_LIFE)
+    keys = [key for key in conn.scan_iter('trending:*') if
+            key != EPOCH_KEY.encode()]
+    # 在一个事务中缩小分数并修改基准时间
+    pipe = conn.pipeline()
+    for key in keys:
+        pipe.zunionstore(key, {key: factor})
+        pipe.zremrangebyscore(key, '-inf', MIN_SCORE)
+    pipe.set(EPOCH_KEY, new_epoch)
+    pipe.execute()
+    return len(keys)
+
+
+def build():
+    '''从数据库统计最近BUILD_DAYS天的事件, 重新生成全部排行; 浏览没有时间记录, 不统计'''
+    since = datetime.now() - timedelta(days=BUILD_DAYS)
+    conn = get_redis_connection('default')
+    epoch = int(time.time())
+    # (key, 对象id): 分数
+    scores = {}
+    events = [('question', question_id, None, pub_time) for
+              question_id, pub_time in Question.objects.filter(
+                  pub_time__gte=since).values_list('id', 'pub_time')]
+    events += [('answer', question_id, answer_id, pub_time) for
+               answer_id, question_id, pub_time in Answer.objects.filter(
+                   pub_time__gte=since).values_list('id', 'question_id',
+                                                   'pub_time')]
+    for event, model in (('upvote', UserFollowAnswer),
+                         ('collect', UserCollectAnswer)):
+        events += [(event, question_id, answer_id, add_time) for
+                   answer_id, question_id, add_time in model.objects.filter(
+                       add_time__gte=since).values_list(
+                       'answer_id', 'answer__question_id', 'add_time')]
+    topic_ids = {}
+    for question_id, topic_id in Question.topics.through.objects.filter(
+            question_id__in={event[1] for event in events}).values_list(
+            'question_id', 'topic_id'):
+        topic_ids.setdefault(question_id, []).append(topic_id)
+    for event, question_id, answer_id, when in events:
+        boost = _boost(epoch, when)
+        answer_weight, question_weight = WEIGHTS[event]
+        for topic_id in [None] + topic_ids.get(question_id, []):
+            if answer_id is not None and answer_weight:
+                key = (_answers_key(topic_id), answer_id)
+                scores[key] = scores.get(key, 0) + answer_weight * boost
+            if question_weight:
+                key = (_questions_key(topic_id), question_id)
+                scores[key] = scores.get(key, 0) + question_weight * boost
+    pipe = conn.pipeline()
+    old_keys = list(conn.scan_iter('trending:*'))
+    if old_keys:
+        pipe.delete(*old_keys)
+    for (key, member), score in scores.items():
+        pipe.zadd(key, score, member)
+    for key in {key for key, member in scores}:
+        size = GLOBAL_SIZE if ':topic:' not in key else TOPIC_SIZE
+        pipe.zremrangebyrank(key, 0, -size - 1)
+    pipe.set(EPOCH_KEY, epoch)
+    pipe.set(BUILT_KEY, 1)
+    pipe.execute()
+
+
+def _ensure_built(conn):
+    '''热度排行已生成时返回True; 不存在时(新部署, redis被清空)交给celery后台生成,
+    不在请求中生成, 返回False'''
+    if conn.exists(BUILT_KEY):
+        return True
+    swr_cache.schedule_build(BUILT_KEY, tasks.build_trending)
+    # celery同步执行时(CELERY_ALWAYS_EAGER)已生成
+    return bool(conn.exists(BUILT_KEY))
+
+
+def answers(topic_id=None, related=()):
+    '''热门回答列表, topic_id为None时为全站排行, 排行未生成时为空列表'''
+    answer_list = SortedSetList(_answers_key(topic_id), Answer, related)
+    if not _ensure_built(answer_list.conn):
+        return []
+    return answer_list
+
+
+def questions(topic_id=None, related=()):
+    '''热门问题列表, topic_id为None时为全站排行, 排行未生成时为空列表'''
+    question_list = SortedSetList(_questions_key(topic_id), Question, related)
+    if not _ensure_built(question_list.conn):
+        return []
+    return question_list
+
+
+def answered_questions(num):
+    '''全站热度最高的num个有回答的问题, 每次取SCAN_SIZE个向后查找, 不足num个时返回全部'''
+    question_list = questions()
+    result = []
+    for start in range(0, len(question_list), SCAN_SIZE):
+        result += [question for question in
+                   question_list[start:start + SCAN_SIZE] if
+                   question.answer_nums > 0]
+        if len(result) >= num:
+            break
+    return result[:num]
@@ -1,40 +1,41 @@
 from datetime import datetime, timedelta
 
-import jieba  # 中文分词
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.core.cache import cache
-from django.db.models import Count, Q
+from django.db import transaction
 from django.http import JsonResponse
 from django.shortcuts import render, get_object_or_404, redirect
 from django.urls import reverse
 # cache
-from django.views.decorators.cache import cache_page
-
-from helper.paginator_helper import paginator_helper
-from user.models import User
+from django.views.decorators.cache import never_cache
+
+from helper import page_cache, result_cache, concurrency
+from helper.paginator_helper import paginator_helper, cursor_paginator_helper
+from . import counters, leaderboard, feed, follow_state, aggregates, \
+    rankings, rollups, trending, related, toggles
+from .recommend import attach_follow_est_answer
+from .search_index import SearchResults
 from .forms import CommentForm, AskQuestionForm, AnswerForm
-from .models import Question, Answer, Topic, UserFollowAnswer, AnswerComment, \
-    UserFollowQuestion, UserCollectAnswer
+from .models import Question, Answer, Topic, AnswerComment, \
+    attach_topic_names
+from .tasks import fanout_answer, rebuild_feed
 
 
+@page_cache.shared_cache_page(
+    60, key_prefix='index', tags=lambda request: ['answers'],
+    shared_if=lambda request: not feed.has_feed(request.user))
 def index(request):
     '''首页'''
-    # 2018.7.17
-    # 采取分页了, 没有必要使用聚合, 数据多时, 这样聚合查询很慢
-    # 也没有必要查询一个完整的对象, 查询字段少可以优化查询速度
-    # 在模板中可以使用属性或方法获取点赞数或者评论数
-    # all_answers = Answer.objects.all().order_by('-pub_time')
-    all_answers = Answer.objects.annotate(
-        comment_nums=Count('answercomment', distinct=True)) \
-        .annotate(
-        follow_nums=Count('userfollowanswer', distinct=True)).order_by(
-        '-pub_time')
-
-    # 分页
-    page = paginator_helper(request, all_answers,
-                            per_page=settings.ANSWER_PER_PAGE)
+    # 登录用户显示关注的用户和话题下的回答, 未登录或没有关注时显示全站最新回答
+    # 使用游标翻页, 每页只查询当前页的回答
+    cursor = request.GET.get('after')
+    page = None
+    if request.user.is_authenticated:
+        page = feed.get_feed_page(request.user, cursor,
+                                  per_page=settings.ANSWER_PER_PAGE)
+    if page is None:
+        page = feed.get_latest_page(cursor, per_page=settings.ANSWER_PER_PAGE)
 
     context = {}
     context['page'] = page
@@ -44,48 +45,38 @@ def index(request):
 def question_detail(request, question_id):
     '''问题详情'''
     question = get_object_or_404(Question, pk=question_id)
-    # get请求一次, 浏览量+1
-    question.read_nums += 1
-    question.save()
-
-    has_follow_question = False
-    if request.user.is_authenticated:
-        if UserFollowQuestion.objects.filter(user=request.user,
-                                             question=question):
-            has_follow_question = True
-
-    # 问题的回答
-    question_answers = cache.get('question_answers' + str(question_id))
-    if not question_answers:
-        question_answers = Answer.objects.filter(question=question).annotate(
-            follow_nums=Count('userfollowanswer', distinct=True)).annotate( \
-            comment_nums=Count('answercomment', distinct=True))
-        cache.set('question_answers' + str(question_id), question_answers,
-                  5 * 60)
+    # get请求一次, 浏览量+1, 先在redis中累加, 定时批量写入数据库
+    # 热度排行中的浏览加分在浏览量写入数据库时批量计算
+    question.read_nums += counters.incr_read_nums(question.id)
+
+    # 关注状态, 回答列表, 相关问题互不依赖, 并发读取
+    has_follow_question, answer_rows, relate_questions = concurrency.run(
+        lambda: follow_state.has_followed(request.user, 'follow_question',
+                                          question),
+        # 问题的回答, 缓存(id, 点赞数, 发布时间)
+        lambda: result_cache.cached_rows(
+            'question_answers' + str(question_id),
+            ['question:%s' % question_id],
+            Answer.objects.filter(question=question),
+            ('id', 'follow_nums', 'pub_time')),
+        # 相关问题, 取前5个, 从相关问题索引读取
+        lambda: related.related_questions(question.id, 5))
 
     # 问题下回答排序
     sort_type = request.GET.get('sort_type', '')
     # 如果按时间排序
     if sort_type == 'time':
-        question_answers = question_answers.order_by('-pub_time')
+        answer_ids = result_cache.sorted_ids(answer_rows, 2)
     # 默认排序, 按点赞数数排序
     else:
-        question_answers = question_answers.order_by('-follow_nums')
+        answer_ids = result_cache.sorted_ids(answer_rows, 1)
 
-    # 分页
-    page = paginator_helper(request, question_answers,
+    # 分页, 只取出当前页的回答
+    page = paginator_helper(request,
+                            result_cache.CachedIdList(Answer, answer_ids,
+                                                      related=('author',)),
                             per_page=settings.ANSWER_PER_PAGE)
 
-    # question归属话题, 取第一个话题
-    question_topic = question.topics.all().first()
-    # 话题相关question, 取前5个, 并排除自身
-    relate_questions = cache.get('relate_questions' + str(question_id))
-    if not relate_questions:
-        relate_questions = question_topic.question_set.exclude(
-            id=question_id).order_by('-read_nums')[:5]
-        cache.set('relate_questions' + str(question_id), relate_questions,
-                  5 * 60)
-
     context = {}
     context['question'] = question
     context['has_follow_question'] = has_follow_question
@@ -95,16 +86,18 @@ def question_detail(request, question_id):
     return render(request, 'zhihu/question_detail.html', context)
 
 
-@cache_page(5 * 60, key_prefix='follow_question_user')
+@page_cache.shared_cache_page(
+    key_prefix='follow_question_user',
+    tags=lambda request, question_id: ['question:%s' % question_id])
 def follow_question_user(request, question_id):
     '''关注问题的用户'''
     question = get_object_or_404(Question, id=question_id)
     if question.get_follow_nums() == 0:
         return redirect(reverse('question_detail', args=(question_id,)))
 
-    # 获取question关注记录, obj.user的方式获取记录中的user对象
-    follow_question_users = question.userfollowquestion_set.order_by(
-        '-add_time')
+    # 获取question关注记录, 记录中的user对象JOIN查询, 模板中obj.user不再逐条查询
+    follow_question_users = question.userfollowquestion_set.select_related(
+        'user').order_by('-add_time')
 
     follow_question_users_page = paginator_helper(request,
                                                   follow_question_users,
@@ -120,30 +113,29 @@ def answer_detail(request, answer_id):
     answer = get_object_or_404(Answer, pk=answer_id)
     question = answer.question
 
-    has_follow_question = False
-    has_collect_answer = False
-    if request.user.is_authenticated:
-        if UserFollowQuestion.objects.filter(user=request.user,
-                                             question=question):
-            has_follow_question = True
-        if UserCollectAnswer.objects.filter(user=request.user, answer=answer):
-            has_collect_answer = True
-
-    # 归属问题话题的相关问题, 按阅读量排序
-    # 回答归属question归属话题, 取第一个话题
-    question_topic = question.topics.all().first()
-    # 话题相关question, 取前5个, 并排除自身
-    relate_questions = cache.get('relate_questions' + str(answer_id))
-    if not relate_questions:
-        relate_questions = question_topic.question_set.exclude(
-            id=answer.question_id).order_by('-read_nums')[:5]
-        cache.set('relate_questions' + str(answer_id), relate_questions, 5 * 60)
+    def follow_states():
+        return (follow_state.has_followed(request.user, 'follow_question',
+                                          question),
+                follow_state.has_followed(request.user, 'collect_answer',
+                                          answer))
+
+    def comments_page():
+        '''评论分页, 取出当前页的评论'''
+        answer_comments = answer.answercomment_set.select_related(
+            'user').order_by('-add_time')
+        page = paginator_helper(request, answer_comments,
+                                per_page=settings.COMMENT_PER_PAGE)
+        page.object_list = list(page.object_list)
+        return page
+
+    # 关注状态, 相关问题(回答归属问题的, 取前5个), 评论互不依赖, 并发读取
+    (has_follow_question, has_collect_answer), relate_questions, page = \
+        concurrency.run(
+            follow_states,
+            lambda: related.related_questions(answer.question_id, 5),
+            comments_page)
     # 评论表单
     comment_form = CommentForm()
-    # 评论分页
-    answer_comments = answer.answercomment_set.all().order_by('-add_time')
-    page = paginator_helper(request, answer_comments,
-                            per_page=settings.COMMENT_PER_PAGE)
 
     context = {}
     context['answer'] = answer
@@ -156,40 +148,43 @@ def answer_detail(request, answer_id):
 
 
 # use cache
-@cache_page(10 * 60, key_prefix='explore')
+# 新问题, 新回答时失效; 列表中的赞同数只在缓存过期后更新
+# 排序结果由zhihu.aggregates缓存, 过期时返回旧结果并在后台刷新
+@page_cache.shared_cache_page(10 * 60, key_prefix='explore',
+                              tags=lambda request: ['questions', 'answers'])
 def explore(request):
     '''发现页'''
-    # 按浏览量取前5个
-    recommend_questions = Question.objects.all().order_by('-read_nums')[:5]
+    # 热度最高的5个问题, 排除没有回答的问题;
+    # 不足5个时(排行未生成, 最近没有新回答)用浏览量最多的问题补充
+    recommend_questions_list = trending.answered_questions(5)
+    if len(recommend_questions_list) < 5:
+        chosen = {question.id for question in recommend_questions_list}
+        recommend_questions_list += result_cache.hydrate(Question, [
+            question_id for question_id in
+            aggregates.explore_recommend_question_ids() if
+            question_id not in chosen])
+        recommend_questions_list = recommend_questions_list[:5]
     # 排名第一的问题获取点赞最多的回答
-    first_question = recommend_questions[0]
-    first_question.follow_est_answer = first_question.get_follow_est_answer()
-    recommend_questions_list = [first_question]
-    for question in recommend_questions[1:]:
-        recommend_questions_list.append(question)
-
-    # 本月推荐: 回答在本月有用户最多的点赞或收藏
-    today = datetime.today()
-    recommend_answer_month = Answer.objects.all().filter(
-        pub_time__year=today.year, pub_time__month= \
-            today.month).annotate(
-        follow_nums=Count('userfollowanswer')).order_by('-follow_nums')
+    attach_follow_est_answer(recommend_questions_list[:1])
+    attach_topic_names(recommend_questions_list)
+
+    # 本月推荐: 回答在本月收到的点赞最多
+    # 读取按时间分桶的点赞统计, 每页只取当前页的回答
+    recommend_answer_month = rollups.WindowRanking(
+        'month', related=('question', 'author'))
 
     page_month = paginator_helper(request, recommend_answer_month,
                                   per_page=settings.ANSWER_PER_PAGE)
 
-    # 今日推荐: 回答在今日有用户最多的点赞或收藏
-    recommend_answer_today = Answer.objects.all().filter(
-        pub_time__year=today.year, pub_time__month= \
-            today.month, pub_time__day=today.day).annotate(
-        follow_nums=Count('userfollowanswer')).order_by('-follow_nums')
+    # 今日推荐: 回答在今日收到的点赞最多
+    recommend_answer_today = rollups.WindowRanking(
+        'today', related=('question', 'author'))
 
     page_today = paginator_helper(request, recommend_answer_today,
                                   per_page=settings.ANSWER_PER_PAGE)
 
-    # 热门话题, 问题最多的话题
-    hot_topics = Topic.objects.annotate(
-        question_nums=Count('question')).order_by('-question_nums')[:5]
+    # 热门话题, 问题最多的话题, 读取物化排行
+    hot_topics = rankings.top('hot_topics', 5)
 
     context = {}
     context['recommend_questions'] = recommend_questions_list
@@ -200,29 +195,25 @@ def explore(request):
     return render(request, 'zhihu/explore.html', context)
 
 
-@cache_page(10 * 60, key_prefix='explore_recommend')
+@page_cache.shared_cache_page(10 * 60, key_prefix='explore_recommend',
+                              tags=lambda request: ['questions', 'answers'])
 def explore_recommend(request):
     '''发现页更多推荐'''
-    # 取最近3个月的问题, 按问题阅读量排序
+    # 取最近3个月的问题, 按问题阅读量排序, 排除没有回答的问题
+    # 在数据库中分页, 只查询当前页的问题
     recommend_questions = Question.objects.filter(
-        pub_time__gt=datetime.now() - timedelta(days=90)).order_by('-read_nums')
-    # 每个问题获取点赞最多的回答
-    recommend_questions_list = []
-    for question in recommend_questions:
-        follow_est_answer = question.get_follow_est_answer()
-        # 问题至少有回答, 排除没有问答的问题
-        if follow_est_answer:
-            question.follow_est_answer = follow_est_answer
-            recommend_questions_list.append(question)
-
-    # 热门话题, 回答最多的话题
-    # annotate聚合函数, 获取每个话题下问题的回答数
-    hot_topics = Topic.objects.annotate(
-        answer_nums=Count('question__answer')).order_by('-answer_nums')[:5]
+        pub_time__gt=datetime.now() - timedelta(days=90),
+        answer_nums__gt=0).order_by('-read_nums', '-id')
+
+    # 热门话题, 回答最多的话题, 读取物化排行
+    hot_topics = rankings.top('topics_by_answers', 5)
 
     recommend_questions_page = paginator_helper(request,
-                                                recommend_questions_list,
+                                                recommend_questions,
                                                 per_page=settings.QUESTION_PER_PAGE)
+    # 一条查询取出当前页问题点赞最多的回答id
+    recommend_questions_page.object_list = attach_follow_est_answer(
+        recommend_questions_page.object_list)
 
     context = {}
     context['recommend_questions_page'] = recommend_questions_page
@@ -230,15 +221,14 @@ def explore_recommend(request):
     return render(request, 'zhihu/explore_recommend.html', context)
 
 
-@cache_page(10 * 60, key_prefix='topic_list')
+@page_cache.shared_cache_page(key_prefix='topic_list',
+                              tags=lambda request: ['topics'])
 def topic_list(request):
     '''话题广场'''
-    # 话题根据关注用户的数量排序
-    all_topics = Topic.objects.annotate(user_nums=Count('users')).order_by(
-        '-user_nums')
-    # 热门话题, 提问最多的话题
-    hot_topics = Topic.objects.annotate(
-        question_nums=Count('question')).order_by('-question_nums')[:5]
+    # 话题根据关注用户的数量排序, 读取物化排行, 只取当前页的话题
+    all_topics = rankings.Ranking('topics_by_users')
+    # 热门话题, 提问最多的话题, 读取物化排行
+    hot_topics = rankings.top('hot_topics', 5)
     page = paginator_helper(request, all_topics,
                             per_page=settings.TOPIC_PER_PAGE)
 
@@ -253,96 +243,34 @@ def topic_detail(request, topic_id):
     '''话题详情'''
     topic = get_object_or_404(Topic, id=topic_id)
     context = {}
-    has_follow_topic = False
-    if request.user.is_authenticated:
-        if topic in request.user.topic_set.all():
-            has_follow_topic = True
-
-    # 话题下回答
-    topic_answers = cache.get('topic_answers' + str(topic_id))
-    if not topic_answers:
-        topic_answers = Answer.objects.filter(
-            question__in=topic.question_set.all()).annotate(follow_nums \
-            =Count(
-            'userfollowanswer', distinct=True)).annotate(
-            comment_nums=Count('answercomment', distinct=True))
-        cache.set('topic_answers' + str(topic_id), topic_answers, 5 * 60)
-
-    '''
-    # 话题下回答问题的最活跃回答者, 按用户的回答数排序
-    # 用distinct去除重复的user_id, 但mysql数据库不支持, 使用set类型集合去除重复的user_id
-    # 该话题下, 有回答的用户ID列表
-    user_ids = cache.get('user_ids'+'_topic_'+str(topic_id))
-    if not user_ids:
-        user_ids = set()
-        for answer in topic_answers:
-            user_ids.add(answer.author_id)
-        cache.set('user_ids'+'_topic_'+str(topic_id), user_ids, 5*60)
-
-    most_active_users = cache.get('most_active_users'+str(topic_id))
-    if not most_active_users:
-        # 所有用户在话题下的回答数列表
-        user_answer_nums_list = []
-        for user_id  in user_ids:
-            user_answer_nums = topic_answers.filter(author_id=user_id).count()
-            user_answer_nums_list.append({'user_id':user_id, 'user_answer_nums':user_answer_nums})
-
-        # 依据回答数排序, 排序函数sorted的key参数
-        def get_nums(obj):
-            return obj['user_answer_nums']
-        
-        user_answer_nums_list_sorted = sorted(user_answer_nums_list, key=get_nums, reverse=True)
-        # 最活跃用户取前3
-        most_active_users = []
-        for obj in user_answer_nums_list_sorted[:3]:
-            user = User.objects.get(id=obj['user_id'])
-            # 用户话题回答数
-            user.topic_answer_nums = obj['user_answer_nums']
-            # 用户话题下回答赞同数
-            user.topic_answer_follow_nums = UserFollowAnswer.objects.filter(answer__author=user, answer__in=topic_answers).count()
-            most_active_users.append(user)
-        cache.set('most_active_users'+str(topic_id), most_active_users, 10*60)
-    '''
-
-    user_answer_nums_list_sorted = cache.get(
-        'user_answer_nums_list_sorted' + str(topic_id))
-    if not user_answer_nums_list_sorted:
-        user_list = set()
-        for answer in topic_answers:
-            user_list.add(answer.author)
-        # 用户话题下回答列表
-        user_answer_nums_list = []
-        for user in user_list:
-            # 用户在话题下的回答
-            user_answers = topic_answers.filter(author=user)
-            # 用户在话题下的回答数
-            user.user_answer_nums = user_answers.count()
-            # 用户在话题下的回答赞同数
-            user.user_answer_follow_nums = UserFollowAnswer.objects.filter(
-                answer__in=user_answers).count()
-            user_answer_nums_list.append(user)
-
-        # 活跃用户按回答数排序
-        def get_nums(obj):
-            return obj.user_answer_nums
-
-        user_answer_nums_list_sorted = sorted(user_answer_nums_list,
-                                              key=get_nums, reverse=True)
-        cache.set('user_answer_nums_list_sorted' + str(topic_id),
-                  user_answer_nums_list_sorted, 10 * 60)
-    # 最活跃用户取前3
-    most_active_users = user_answer_nums_list_sorted[:3]
+    # 关注状态, 回答列表, 活跃用户, 热度排行互不依赖, 并发读取
+    has_follow_topic, answer_rows, most_active_users, trending_answers = \
+        concurrency.run(
+            lambda: follow_state.has_followed(request.user, 'follow_topic',
+                                              topic),
+            # 话题下回答, 缓存(id, 点赞数, 发布时间)
+            lambda: result_cache.cached_rows(
+                'topic_answers' + str(topic_id), ['topic:%s' % topic_id],
+                Answer.objects.filter(question__topics=topic),
+                ('id', 'follow_nums', 'pub_time')),
+            # 最活跃用户取前3
+            lambda: leaderboard.TopicAnswerers(topic)[:3],
+            # 精华: 话题热度排行, 点赞, 收藏越新越靠前
+            lambda: trending.answers(topic.id, related=('question', 'author')))
 
     topic_type = request.GET.get('topic_type', '')
-    # 话题下回答排序, 默认按时间排序
-    if topic_type == 'wonderful':
-        # 获取话题下精彩回答, 按点赞数排序
-        topic_answers = topic_answers.order_by('-follow_nums')
+    if topic_type == 'wonderful' and len(trending_answers):
+        page = trending_answers.cursor_page(request,
+                                            per_page=settings.ANSWER_PER_PAGE)
     else:
-        topic_answers = topic_answers.order_by('-pub_time')
-
-    page = paginator_helper(request, topic_answers,
-                            per_page=settings.ANSWER_PER_PAGE)
+        # 默认按时间排序; 话题最近没有热度时精华按点赞数排序
+        answer_ids = result_cache.sorted_ids(
+            answer_rows, 1 if topic_type == 'wonderful' else 2)
+        # 在缓存的id列表上游标翻页, 只取出当前页的回答
+        page = result_cache.cursor_page(
+            request, result_cache.CachedIdList(Answer, answer_ids,
+                                               related=('question', 'author')),
+            per_page=settings.ANSWER_PER_PAGE)
 
     context['topic'] = topic
     context['has_follow_topic'] = has_follow_topic
@@ -356,46 +284,17 @@ def topic_question(request, topic_id):
     '''话题下等待回答问题, 按时间排序'''
     topic = get_object_or_404(Topic, id=topic_id)
     context = {}
-    has_follow_topic = False
-    if request.user.is_authenticated:
-        if topic in request.user.topic_set.all():
-            has_follow_topic = True
-
-    topic_questions = cache.get('topic_questions' + str(topic_id))
-    if not topic_questions:
-        topic_questions = topic.question_set.all().order_by('-pub_time')
-        cache.set('topic_questions' + str(topic_id), topic_questions, 10 * 60)
-
-    # 话题下用户回答数排序
-    user_answer_nums_list_sorted = cache.get(
-        'user_answer_nums_list_sorted' + str(topic_id))
-    if not user_answer_nums_list_sorted:
-        topic_answers = Answer.objects.filter(question__in=topic_questions)
-        user_list = set()
-        for answer in topic_answers:
-            user_list.add(answer.author)
-        # 用户话题下回答列表
-        user_answer_nums_list = []
-        for user in user_list:
-            # 用户在话题下的回答
-            user_answers = topic_answers.filter(author=user)
-            # 用户在话题下的回答数
-            user.user_answer_nums = user_answers.count()
-            # 用户在话题下的回答赞同数
-            user.user_answer_follow_nums = UserFollowAnswer.objects.filter(
-                answer__in=user_answers).count()
-            user_answer_nums_list.append(user)
-
-        # 活跃用户按回答数排序
-        def get_nums(obj):
-            return obj.user_answer_nums
-
-        user_answer_nums_list_sorted = sorted(user_answer_nums_list,
-                                              key=get_nums, reverse=True)
-        cache.set('user_answer_nums_list_sorted' + str(topic_id),
-                  user_answer_nums_list_sorted, 10 * 60)
+    has_follow_topic = follow_state.has_followed(request.user, 'follow_topic',
+                                                 topic)
+
+    question_rows = result_cache.cached_rows(
+        'topic_questions' + str(topic_id), ['topic:%s' % topic_id],
+        topic.question_set.all(), ('id', 'pub_time'))
+    topic_questions = result_cache.CachedIdList(
+        Question, result_cache.sorted_ids(question_rows, 1))
+
     # 最活跃用户取前3
-    most_active_users = user_answer_nums_list_sorted[:3]
+    most_active_users = leaderboard.TopicAnswerers(topic)[:3]
 
     topic_questions_page = paginator_helper(request, topic_questions,
                                             per_page=settings.QUESTION_PER_PAGE)
@@ -409,42 +308,11 @@ def topic_question(request, topic_id):
 def topic_answerer(request, topic_id):
     '''话题下活跃回答者'''
     topic = get_object_or_404(Topic, id=topic_id)
-    has_follow_topic = False
-    if request.user.is_authenticated:
-        if topic in request.user.topic_set.all():
-            has_follow_topic = True
-
-    # 话题下用户回答数排序
-    user_answer_nums_list_sorted = cache.get(
-        'user_answer_nums_list_sorted' + str(topic_id))
-    if not user_answer_nums_list_sorted:
-        topic_answers = Answer.objects.filter(
-            question__in=topic.question_set.all())
-        user_list = set()
-        for answer in topic_answers:
-            user_list.add(answer.author)
-        # 用户话题下回答列表
-        user_answer_nums_list = []
-        for user in user_list:
-            # 用户在话题下的回答
-            user_answers = topic_answers.filter(author=user)
-            # 用户在话题下的回答数
-            user.user_answer_nums = user_answers.count()
-            # 用户在话题下的回答赞同数
-            user.user_answer_follow_nums = UserFollowAnswer.objects.filter(
-                answer__in=user_answers).count()
-            user_answer_nums_list.append(user)
-
-        # 活跃用户按回答数排序
-        def get_nums(obj):
-            return obj.user_answer_nums
-
-        user_answer_nums_list_sorted = sorted(user_answer_nums_list,
-                                              key=get_nums, reverse=True)
-        cache.set('user_answer_nums_list_sorted' + str(topic_id),
-                  user_answer_nums_list_sorted, 10 * 60)
-
-    page = paginator_helper(request, user_answer_nums_list_sorted,
+    has_follow_topic = follow_state.has_followed(request.user, 'follow_topic',
+                                                 topic)
+
+    # 话题下用户按回答数排序, 只取当前页的用户
+    page = paginator_helper(request, leaderboard.TopicAnswerers(topic),
                             settings.USER_PER_PAGE)
 
     context = {}
@@ -457,27 +325,20 @@ def topic_answerer(request, topic_id):
 def follow_topic_user(request, topic_id):
     '''关注话题的用户'''
     topic = get_object_or_404(Topic, id=topic_id)
-    has_follow_topic = False
-    if request.user.is_authenticated:
-        if topic in request.user.topic_set.all():
-            has_follow_topic = True
-
-    topic_users_list = cache.get('topic_users_list' + str(topic_id))
-    if not topic_users_list:
-        # 关注话题的用户
-        topic_users = topic.users.all()
-        # 话题下的回答
-        topic_answers = Answer.objects.filter(
-            question__in=topic.question_set.all())
-
-        topic_users_list = []
-        for user in topic_users:
-            user.answer_nums = topic_answers.filter(author=user).count()
-            topic_users_list.append(user)
-        cache.set('topic_users_list' + str(topic_id), topic_users_list, 10 * 60)
-
-    topic_users_page = paginator_helper(request, topic_users_list,
+    has_follow_topic = follow_state.has_followed(request.user, 'follow_topic',
+                                                 topic)
+
+    # 关注话题的用户, 先分页
+    topic_users_page = paginator_helper(request,
+                                        topic.users.all().order_by('id'),
                                         per_page=settings.USER_PER_PAGE)
+    topic_users = list(topic_users_page.object_list)
+    # 当前页用户在话题下的回答数, 从话题回答者排行中读取
+    answer_nums = leaderboard.user_answer_nums(
+        topic, [user.id for user in topic_users])
+    for user in topic_users:
+        user.topic_answer_nums = answer_nums[user.id]
+    topic_users_page.object_list = topic_users
 
     context = {}
     context['topic'] = topic
@@ -486,35 +347,26 @@ def follow_topic_user(request, topic_id):
     return render(request, 'zhihu/follow_topic_user.html', context)
 
 
+@never_cache
 @login_required
 def add_follow_answer(request):
-    '''赞同回答'''
+    '''赞同回答, 已赞同时取消赞同'''
     answer_id = int(request.GET.get('answer_id', ''))
     answer = get_object_or_404(Answer, id=answer_id)
-    answer_follow_existed = UserFollowAnswer.objects.filter(user=request.user,
-                                                            answer=answer)
-    print(answer_follow_existed.count())
-    if answer_follow_existed:
-        answer_follow_existed.delete()
+    if toggles.toggle(request.user, 'follow_answer', answer) < 0:
         return JsonResponse({'status': 'success', 'reason': 'cancel'})
-    else:
-        answer_follow = UserFollowAnswer(user=request.user, answer=answer)
-        answer_follow.save()
-        return JsonResponse({'status': 'success', 'reason': 'add'})
+    return JsonResponse({'status': 'success', 'reason': 'add'})
 
 
+@never_cache
 @login_required
 def cancel_follow_answer(request):
     '''取消赞同'''
     answer_id = int(request.GET.get('answer_id', ''))
     answer = get_object_or_404(Answer, id=answer_id)
-    answer_follow_existed = UserFollowAnswer.objects.filter(user=request.user,
-                                                            answer=answer)
-    if answer_follow_existed:
-        answer_follow_existed.delete()
+    if toggles.unfollow(request.user, 'follow_answer', answer):
         return JsonResponse({'status': 'success', 'reason': 'cancel'})
-    else:
-        return JsonResponse({'status': 'success', 'reason': 'nothing'})
+    return JsonResponse({'status': 'success', 'reason': 'nothing'})
 
 
 @login_required
@@ -527,56 +379,57 @@ def comment_answer(request, answer_id):
             answer = get_object_or_404(Answer, id=answer_id)
             answer_comment = AnswerComment(user=request.user, answer=answer,
                                            comment=comment)
-            answer_comment.save()
+            with transaction.atomic():
+                answer_comment.save()
+                counters.answer_commented(answer)
             return JsonResponse({'status': 'success', 'message': '你的评论已提交'})
         else:
             return JsonResponse({'status': 'fail', 'message': '评论不能为空'})
 
 
+@never_cache
 @login_required
 def follow_question(request):
-    '''关注问题'''
+    '''关注问题, 已关注时取消关注'''
     question_id = int(request.GET.get('question_id', ''))
     question = get_object_or_404(Question, id=question_id)
-    follow_question_existed = UserFollowQuestion.objects.filter(
-        user=request.user, question=question)
-    if follow_question_existed:
-        follow_question_existed.delete()
+    if toggles.toggle(request.user, 'follow_question', question) < 0:
         return JsonResponse({'status': 'success', 'message': '关注问题'})
-    else:
-        follow_question = UserFollowQuestion(user=request.user,
-                                             question=question)
-        follow_question.save()
-        return JsonResponse({'status': 'success', 'message': '已关注'})
+    return JsonResponse({'status': 'success', 'message': '已关注'})
 
 
+@never_cache
 @login_required
 def collect_answer(request):
-    '''收藏答案'''
+    '''收藏答案, 已收藏时取消收藏'''
     answer_id = int(request.GET.get('answer_id', ''))
     answer = get_object_or_404(Answer, id=answer_id)
-    collect_answer_existed = UserCollectAnswer.objects.filter(user=request.user,
-                                                              answer=answer)
-    if collect_answer_existed:
-        collect_answer_existed.delete()
+    if toggles.toggle(request.user, 'collect_answer', answer) < 0:
         return JsonResponse({'status': 'success', 'message': '收藏'})
-    else:
-        collect_answer = UserCollectAnswer(user=request.user, answer=answer)
-        collect_answer.save()
-        return JsonResponse({'status': 'success', 'message': '已收藏'})
+    return JsonResponse({'status': 'success', 'message': '已收藏'})
 
 
+@never_cache
 @login_required
 def follow_topic(request, topic_id):
     '''关注话题'''
     try:
         topic = get_object_or_404(Topic, id=topic_id)
-        if topic in request.user.topic_set.all():
-            request.user.topic_set.remove(topic)
-            return JsonResponse({'status': 'success', 'message': '关注话题'})
-        else:
-            request.user.topic_set.add(topic)
-            return JsonResponse({'status': 'success', 'message': '已关注'})
+        with transaction.atomic():
+            # 关注变化后重新生成首页动态
+            transaction.on_commit(lambda: rebuild_feed.delay(request.user.id))
+            if request.user.topic_set.filter(id=topic.id).exists():
+                request.user.topic_set.remove(topic)
+                counters.topic_followed(topic, request.user, -1)
+                follow_state.followed_changed(request.user.id, 'follow_topic',
+                                              topic.id, False)
+                return JsonResponse({'status': 'success', 'message': '关注话题'})
+            else:
+                request.user.topic_set.add(topic)
+                counters.topic_followed(topic, request.user)
+                follow_state.followed_changed(request.user.id, 'follow_topic',
+                                              topic.id)
+                return JsonResponse({'status': 'success', 'message': '已关注'})
     except Exception as e:
         return JsonResponse({'status': 'fail', 'message': '发生错误'})
 
@@ -595,9 +448,12 @@ def ask_question(request):
             question.content = ask_quesiton_form.cleaned_data.get('content')
             question.is_anonymous = ask_quesiton_form.cleaned_data.get(
                 'anonymous')
-            question.save()
-            # 保存多对多关系前保存question对象
-            question.topics.set(ask_quesiton_form.cleaned_data.get('topics'))
+            topics = ask_quesiton_form.cleaned_data.get('topics')
+            with transaction.atomic():
+                question.save()
+                # 保存多对多关系前保存question对象
+                question.topics.set(topics)
+                counters.question_created(question, topics)
             messages.info(request, '你的问题已提交')
             return redirect(reverse('question_detail', args=(question.id,)))
         messages.info(request, '你的输入有误')
@@ -607,26 +463,25 @@ def ask_question(request):
     return render(request, 'zhihu/ask_question.html', context)
 
 
-@cache_page(5 * 60, key_prefix='question_list')
+# 热门问题按关注数排序, 关注数变化不失效, 缓存5分钟
+@page_cache.shared_cache_page(5 * 60, key_prefix='question_list',
+                              tags=lambda request: ['questions'])
 def question_list(request):
     '''回答-问题列表'''
-    questions = Question.objects.all().order_by('-pub_time').annotate(
-        answer_nums=Count('answer', distinct=True),
-        follow_nums=Count('userfollowquestion', distinct=True))
-    hot_questions = Question.objects.all().annotate(
-        answer_nums=Count('answer', distinct=True),
-        follow_nums=Count('userfollowquestion', distinct=True)).order_by(
-        '-follow_nums')
-
-    # 分页
-    questions_page = paginator_helper(request, questions,
-                                      per_page=settings.QUESTION_PER_PAGE)
-    hot_questions_page = paginator_helper(request, hot_questions,
-                                          per_page=settings.QUESTION_PER_PAGE)
+    # 最新问题和热门问题两个标签页, 各自使用游标参数翻页
+    questions_page = cursor_paginator_helper(
+        request, Question.objects.all(), per_page=settings.QUESTION_PER_PAGE,
+        ordering=('-pub_time', '-id'), with_count=True)
+    # 热门问题读取物化排行, 不需要按关注数全表排序
+    hot_questions_page = rankings.cursor_page(
+        request, 'hot_questions', per_page=settings.QUESTION_PER_PAGE,
+        cursor_name='hot_after')
 
     context = {}
     context['questions_page'] = questions_page
     context['hot_questions_page'] = hot_questions_page
+    # 热门标签页翻页后仍显示热门标签页
+    context['hot_tab'] = 'hot_after' in request.GET
     return render(request, 'zhihu/question_list.html', context)
 
 
@@ -643,7 +498,12 @@ def answer_question(request, question_id):
             answer.author = request.user
             answer.content = answer_form.cleaned_data.get('content')
             answer.is_anonymous = answer_form.cleaned_data.get('anonymous')
-            answer.save()
+            with transaction.atomic():
+                answer.save()
+                counters.answer_created(answer)
+                leaderboard.answer_created(answer)
+                # 推送到关注者的首页动态
+                transaction.on_commit(lambda: fanout_answer.delay(answer.id))
             messages.info(request, '你的回答已提交')
             return redirect(reverse('question_detail', args=(question.id,)))
 
@@ -653,9 +513,9 @@ def answer_question(request, question_id):
     return render(request, 'zhihu/answer_question.html', context)
 
 
-@cache_page(5 * 60, key_prefix='search')
+@page_cache.shared_cache_page(5 * 60, key_prefix='search')
 def search(request):
-    '''简单的搜索功能, 使用数据库模糊查询, 记录较多时性能应该不好吧'''
+    '''搜索功能, 使用站内搜索索引'''
     search_type = request.GET.get('search_type')
     keywords = request.GET.get('keywords', '')
     search_type_list = ['question', 'answer', 'topic', 'user']
@@ -669,37 +529,8 @@ def search(request):
     if len(keywords) > 20:
         return redirect(reverse('index'))
 
-    # jieba分词(中文)
-    seg_list = jieba.cut(keywords, cut_all=False)  # 返回generator迭代器
-
-    # 2018.7.17
-    # 搜索功能直接对数据库搜索的话, 在数据库中,在要搜索的字段中上建立全文索引, 加快匹配速度
-    # 使用全文检索sql而不是模糊查询, 模糊查询太慢了, 全文检索还提供检索的匹配度
-
-    if search_type == 'question':
-        # Q对象
-        q = Q()
-        for word in seg_list:
-            q = q | Q(title__icontains=word)
-        search_results = Question.objects.filter(q).order_by('id')[:100]
-
-    if search_type == 'answer':
-        q = Q()
-        for word in seg_list:
-            q = q | Q(content__icontains=word)
-        search_results = Answer.objects.filter(q).order_by('id')[:100]
-
-    if search_type == 'topic':
-        q = Q()
-        for word in seg_list:
-            q = q | Q(name__icontains=word)
-        search_results = Topic.objects.filter(q).order_by('id')[:100]
-
-    if search_type == 'user':
-        q = Q()
-        for word in seg_list:
-            q = q | Q(nickname__icontains=word) | Q(username__icontains=word)
-        search_results = User.objects.filter(q).order_by('id')[:100]
+    # 使用jieba分词的倒排索引搜索, 按BM25相关度排序, 分页时只查询当前页的对象
+    search_results = SearchResults(search_type, keywords)
 
     search_results_page = paginator_helper(request, search_results,
                                            per_page=settings.SEARCH_PER_PAGE)
@@ -0,0 +1,28 @@
+"""
+ASGI config for zhihuer project.
+
+It exposes the ASGI application as a module-level variable named ``application``.
+django 2.0 has no ASGI handler, channels' AsgiHandler serves the http
+requests through the full middleware stack, running views in its thread
+pool (size set by the ASGI_THREADS environment variable).
+
+Run with:
+    daphne -b 127.0.0.1 -p 8000 zhihuer.asgi:application
+
+For more information on this file, see
+https://channels.readthedocs.io/en/2.1.2/deploying.html
+"""
+
+import os
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "zhihuer.settings")
+django.setup()
+
+from channels.http import AsgiHandler  # noqa: E402
+from channels.routing import ProtocolTypeRouter  # noqa: E402
+
+application = ProtocolTypeRouter({
+    'http': AsgiHandler,
+})
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.0/ref/settings/
 """
 
 import os
+from datetime import timedelta
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -45,8 +46,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
-    # caches
-    'django.middleware.cache.UpdateCacheMiddleware',
+    # 抽样统计查询数, SQL耗时, 缓存命中, 渲染耗时, 放在最外层, 见helper.metrics
+    'helper.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -54,15 +55,16 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    # caches
-    'django.middleware.cache.FetchFromCacheMiddleware',
+    # 页面缓存由视图上的helper.page_cache.shared_cache_page按数据标签失效,
+    # 不使用全站缓存中间件, 否则写入后仍会返回旧页面
 ]
 
 ROOT_URLCONF = 'zhihuer.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # 统计模板渲染耗时的DjangoTemplates
+        'BACKEND': 'helper.metrics.InstrumentedDjangoTemplates',
         'DIRS': [
             os.path.join(BASE_DIR, 'templates'),
         ],
@@ -163,6 +165,11 @@ TREND_PER_PAGE = 5
 USER_PER_PAGE = 5
 SEARCH_PER_PAGE = 5
 
+# 首页动态最多保存的回答数
+FEED_MAX_LENGTH = 1000
+# 关注者超过该数量的用户和话题, 新回答不推送, 读取首页时再查询
+FEED_FANOUT_LIMIT = 2000
+
 # 边缘显示页数
 MARGIN_PAGES = 2
 # 中间显示页数
@@ -207,13 +214,17 @@ CKEDITOR_CONFIGS = {
     }
 }
 
+# 站内搜索索引文件
+SEARCH_INDEX_PATH = os.path.join(BASE_DIR, 'search_index.sqlite3')
+
 # pythonanywhere nhttps
 # SECURE_SSL_REDIRECT = True
 
 # cache django-redis
 CACHES = {
     'default': {
-        'BACKEND': 'django_redis.cache.RedisCache',
+        # 统计缓存命中的django_redis后端
+        'BACKEND': 'helper.metrics.InstrumentedRedisCache',
         'LOCATION': 'redis://127.0.0.1:6379/1',
         'OPTIONS': {
             'CLIENT_CLASS': 'django_redis.client.DefaultClient',
@@ -228,6 +239,30 @@ CACHES = {
 # CACHE_MIDDLEWARE_SECONDS = 60
 # CACHE_MIDDLEWARE_KEY_PREFIX = 'zhihuer'
 
+# 带标签缓存的默认缓存时间, 数据变化时由信号失效, 可以设置得较长
+TAG_CACHE_TIMEOUT = 6 * 60 * 60
+# 对象缓存时间, 对象变化时失效
+OBJECT_CACHE_TIMEOUT = 24 * 60 * 60
+# 防击穿缓存过期后在后台刷新的celery任务, 见helper.swr_cache
+SWR_REFRESH_TASK = 'zhihu.tasks.refresh_cached'
+# 点赞, 收藏, 关注延迟写入: 视图只修改redis, celery定时任务批量写入数据库,
+# 见zhihu.toggles; 需要启动celery beat
+TOGGLE_WRITE_BEHIND = False
+
+# 性能统计抽样比例, 0为不统计, 见helper.metrics
+METRICS_SAMPLE_RATE = 0.01
+# prometheus抓取/metrics/时的token(Authorization: Bearer <token>),
+# 为空时只有管理员登录后可以访问
+METRICS_TOKEN = ''
+
+# 视图中互不依赖的查询并发执行, 见helper.concurrency
+CONCURRENT_LOOKUPS = True
+# 并发查询的线程数, 每个线程使用自己的数据库连接
+CONCURRENT_LOOKUP_WORKERS = 16
+# 并发查询线程的数据库连接保留的秒数, 不受DATABASES中CONN_MAX_AGE的影响,
+# 每个进程最多多占用CONCURRENT_LOOKUP_WORKERS个连接, 0为每次查询后关闭
+CONCURRENT_LOOKUP_CONN_MAX_AGE = 60
+
 # celery settings
 # celery中间人, 使用redis数据库
 BROKER_URL = 'redis://127.0.0.1:6379/2'
@@ -242,6 +277,36 @@ CELERY_RESULT_SERIALIZER = 'json'
 # celery时区设置
 CELERY_TIMEZONE = TIME_ZONE
 
+# celery定时任务
+# cmd运行: celery -A zhihuer beat -l info 启动定时任务调度
+CELERYBEAT_SCHEDULE = {
+    # 问题浏览量写入数据库
+    'flush_read_nums': {
+        'task': 'zhihu.tasks.flush_read_nums',
+        'schedule': timedelta(minutes=1),
+    },
+    # 延迟写入的点赞, 收藏, 关注操作写入数据库
+    'drain_toggles': {
+        'task': 'zhihu.tasks.drain_toggles',
+        'schedule': timedelta(seconds=5),
+    },
+    # 重新统计热门话题, 热门问题排行, 两次统计之间增量更新
+    'refresh_rankings': {
+        'task': 'zhihu.tasks.refresh_rankings',
+        'schedule': timedelta(minutes=10),
+    },
+    # 热度排行的基准时间前移, 缩小分数
+    'rebase_trending': {
+        'task': 'zhihu.tasks.rebase_trending',
+        'schedule': timedelta(hours=6),
+    },
+    # 全量统计相关问题索引, 两次统计之间增量更新
+    'rebuild_related': {
+        'task': 'zhihu.tasks.rebuild_related',
+        'schedule': timedelta(days=1),
+    },
+}
+
 # 尝试配置django的日志模块
 LOGGING = {
     'version': 1,
@@ -289,9 +354,9 @@ LOGGING = {
                                 # to its parent (will send if set to True)
         },
         'django.db': {
-            # log raw sql of django orm
+            # DEBUG级别会记录每条sql, 开销大且无法汇总, 查询数和耗时见/metrics/
             'handlers': ['console', 'rotating_file'],
-            'level': 'DEBUG',
+            'level': 'INFO',
             'propagate': False,
         },
     },
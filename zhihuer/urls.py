@@ -3,6 +3,7 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include, re_path
 
+from helper.metrics import metrics_view
 from user.views import register, user_login, user_logout, user_confirm, \
     resend_confirm_email, user_home, user_answer, user_question, reset_password, \
     get_check_code \
@@ -97,6 +98,9 @@ urlpatterns = [
 
     # 搜索
     path('search/', search, name='search'),
+
+    # 性能统计
+    path('metrics/', metrics_view, name='metrics'),
 ]
 
 # 第三方验证码url配置